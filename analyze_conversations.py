@@ -1,7 +1,7 @@
 import sys
 import os
-import pandas as pd
 import json
+import artifacts
 
 def count_roles_and_functions(json_data):
 	# Initialize a dictionary to keep the count of each role and function
@@ -24,23 +24,59 @@ def count_roles_and_functions(json_data):
 
 	return count
 
+# Prices in US dollars per 1,000 prompt and completion tokens. The longest matching model prefix wins.
+MODEL_PRICES = {
+	"gpt-4-1106-preview": (0.01, 0.03),
+	"gpt-4-turbo": (0.01, 0.03),
+	"gpt-4": (0.03, 0.06),
+	"gpt-3.5-turbo-1106": (0.001, 0.002),
+	"gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+def turn_cost(turn):
+	matches = [prefix for prefix in MODEL_PRICES if turn.get("model", "").startswith(prefix)]
+	if not matches:
+		return 0.0
+	prompt_price, completion_price = MODEL_PRICES[max(matches, key=len)]
+	return (turn["prompt_tokens"] * prompt_price + turn["completion_tokens"] * completion_price) / 1000
+
+def summarize_metrics(directory):
+	"""
+	Summarize the metrics.json file stored next to conversation.json, if there is one.
+	"""
+	summary = {"model": "", "tool_schema": "", "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0, "time_to_first_token": 0.0, "cost": 0.0}
+	metrics_path = os.path.join(directory, "metrics.json")
+	if not os.path.exists(metrics_path):
+		return summary
+
+	with open(metrics_path, 'r') as metrics_file:
+		turns = json.load(metrics_file)["turns"]
+	for turn in turns:
+		summary["model"] = turn.get("model", summary["model"])
+		summary["tool_schema"] = turn.get("tool_schema", summary["tool_schema"])
+		summary["prompt_tokens"] += turn["prompt_tokens"]
+		summary["completion_tokens"] += turn["completion_tokens"]
+		summary["latency"] += turn["latency"]
+		summary["time_to_first_token"] += turn["time_to_first_token"]
+		summary["cost"] += turn_cost(turn)
+	return summary
+
 # Function to create a DataFrame from a directory path
 def create_dataframe(directory_path):
+	# pandas is slow to import, so only load it once a DataFrame is needed.
+	import pandas as pd
+
 	summary_data = []
-	for root, dirs, files in os.walk(directory_path):
-		for file in files:
-			if file == "conversation.json":
-				file_path = os.path.join(root, file)
-				with open(file_path, 'r') as json_file:
-					data = json.load(json_file)
-					counts = count_roles_and_functions(data)
-					directory_segment = root.split('/')[-1].split('_')[0]
-					# Check for success.txt file in the same directory
-					success = 'succeeded.txt' in files
-					summary_data.append({"directory": root, 
-										 "directory_segment": directory_segment, 
-										 "success": success, 
-										 **counts})
+	for root, files in artifacts.find_conversations(directory_path):
+		counts = count_roles_and_functions(artifacts.iter_messages(root, fields=("role", "tool_calls")))
+		directory_segment = root.split('/')[-1].split('_')[0]
+		# Check for success.txt file in the same directory
+		success = 'succeeded.txt' in files
+		summary_data.append({"directory": root, 
+							 "directory_segment": directory_segment, 
+							 "success": success, 
+							 **summarize_metrics(root),
+							 **counts})
 
 	df = pd.DataFrame(summary_data)
 	functions_df = df['functions'].apply(pd.Series).fillna(0).astype(int)
@@ -51,6 +87,8 @@ def expand_function_counts(df):
 	"""
 	Expand the function counts in the 'functions' column into separate columns in the DataFrame.
 	"""
+	import pandas as pd
+
 	# Extract function counts as a separate DataFrame
 	functions_df = df['functions'].apply(pd.Series)
 
@@ -73,7 +111,7 @@ def add_directory_segment_column(df):
 def count_debugger_commands_extended(json_data):
 	"""
 	Count the number of different commands (first word) and subcommands (first two words) 
-	issued by the run_debugger_command function.
+	issued by the run_debugger_command and run_debugger_commands functions.
 	"""
 	# Initialize dictionaries to keep the count of each command and subcommand
 	command_counts = {}
@@ -86,7 +124,13 @@ def count_debugger_commands_extended(json_data):
 			for tool_call in entry["tool_calls"]:
 				if tool_call["function"]["name"] == "run_debugger_command":
 					# Extract the command
-					cmd = json.loads(tool_call["function"]["arguments"]).get("cmd", "")
+					cmds = [json.loads(tool_call["function"]["arguments"]).get("cmd", "")]
+				elif tool_call["function"]["name"] == "run_debugger_commands":
+					cmds = json.loads(tool_call["function"]["arguments"]).get("cmds", [])
+				else:
+					continue
+
+				for cmd in cmds:
 					words = cmd.split()
 
 					# Command name (first word)
@@ -111,24 +155,15 @@ def count_all_debugger_commands(directory_path):
 	all_subcommand_counts = {}
 	
 	# Walk through the directory and its subdirectories
-	for root, dirs, files in os.walk(directory_path):
-		for file in files:
-			# Check if the file is conversation.json
-			if file == "conversation.json":
-				file_path = os.path.join(root, file)
-	
-				# Open and load the JSON file
-				with open(file_path, 'r') as json_file:
-					data = json.load(json_file)
-	
-					# Count the debugger commands and subcommands in the current file
-					command_counts, subcommand_counts = count_debugger_commands_extended(data)
-	
-					# Update the overall command and subcommand counts
-					for command, count in command_counts.items():
-						all_command_counts[command] = all_command_counts.get(command, 0) + count
-					for subcommand, count in subcommand_counts.items():
-						all_subcommand_counts[subcommand] = all_subcommand_counts.get(subcommand, 0) + count
+	for root, files in artifacts.find_conversations(directory_path):
+		# Count the debugger commands and subcommands in the current conversation
+		command_counts, subcommand_counts = count_debugger_commands_extended(artifacts.iter_messages(root, fields=("role", "tool_calls")))
+
+		# Update the overall command and subcommand counts
+		for command, count in command_counts.items():
+			all_command_counts[command] = all_command_counts.get(command, 0) + count
+		for subcommand, count in subcommand_counts.items():
+			all_subcommand_counts[subcommand] = all_subcommand_counts.get(subcommand, 0) + count
 						
 	return all_command_counts, all_subcommand_counts
 
@@ -137,6 +172,8 @@ def aggregate_conversations_by_segment(directory_path, segment):
 	Aggregate the conversation.json files in the given directory and subdirectories,
 	returning aggregated summary statistics in a DataFrame for the specified directory path segment.
 	"""
+	import pandas as pd
+
 	aggregated_data = {
 		"directory_segment": segment,
 		"assistant": 0,
@@ -147,29 +184,23 @@ def aggregate_conversations_by_segment(directory_path, segment):
 	}
 
 	# Walk through the directory and its subdirectories
-	for root, dirs, files in os.walk(directory_path):
-		for file in files:
-			if file == "conversation.json":
-				# Check if the directory segment matches the specified segment
-				directory_segment = root.split('/')[-1].split('_')[0]
-				if directory_segment == segment:
-					file_path = os.path.join(root, file)
-
-					with open(file_path, 'r') as json_file:
-						data = json.load(json_file)
-						counts = count_roles_and_functions(data)
-						
-						# Aggregate the counts
-						aggregated_data["assistant"] += counts["assistant"]
-						aggregated_data["system"] += counts["system"]
-						aggregated_data["user"] += counts["user"]
-						aggregated_data["tool"] += counts["tool"]
-
-						# Aggregate function counts
-						for function, count in counts["functions"].items():
-							aggregated_data["function_counts"][function] = (
-								aggregated_data["function_counts"].get(function, 0) + count
-							)
+	for root, files in artifacts.find_conversations(directory_path):
+		# Check if the directory segment matches the specified segment
+		directory_segment = root.split('/')[-1].split('_')[0]
+		if directory_segment == segment:
+			counts = count_roles_and_functions(artifacts.iter_messages(root, fields=("role", "tool_calls")))
+			
+			# Aggregate the counts
+			aggregated_data["assistant"] += counts["assistant"]
+			aggregated_data["system"] += counts["system"]
+			aggregated_data["user"] += counts["user"]
+			aggregated_data["tool"] += counts["tool"]
+
+			# Aggregate function counts
+			for function, count in counts["functions"].items():
+				aggregated_data["function_counts"][function] = (
+					aggregated_data["function_counts"].get(function, 0) + count
+				)
 
 	# Create a DataFrame from the aggregated data
 	function_counts_df = pd.Series(aggregated_data["function_counts"]).to_frame().T.fillna(0).astype(int)
@@ -179,8 +210,7 @@ def aggregate_conversations_by_segment(directory_path, segment):
 	return aggregated_df
 
 def summarize_conversations_by_segment(df):
-	if 'directory' in df.columns:
-		df = df.drop(columns=['directory'])
+	df = df.drop(columns=[column for column in ['directory', 'model', 'tool_schema'] if column in df.columns])
 	
 	# Group by the directory segment and aggregate the counts
 	aggregated_df = df.groupby('directory_segment').sum()
@@ -190,6 +220,28 @@ def summarize_conversations_by_segment(df):
 	
 	return aggregated_df
 	
+def summarize_costs(df, group_by):
+	"""
+	Aggregate token usage, latency and cost for each value of the `group_by` column, including the cost per fixed crash.
+	"""
+	grouped = df.groupby(group_by)
+	summary = grouped[['prompt_tokens', 'completion_tokens', 'latency', 'time_to_first_token', 'cost', 'success']].sum()
+	summary['count'] = grouped.size()
+	summary['turns'] = grouped['assistant'].sum()
+	summary['mean_time_to_first_token'] = summary['time_to_first_token'] / summary['turns'].where(summary['turns'] > 0)
+	summary['cost_per_fixed_crash'] = summary['cost'] / summary['success'].where(summary['success'] > 0)
+	return summary.drop(columns=['time_to_first_token'])
+	
+# The functions stacked in the chart, with their legend labels and colors. Functions a set of results never called count as zero.
+CHART_FUNCTIONS = [
+	("run_debugger_command", "Run Debugger Command", "blue!50"),
+	("run_debugger_commands", "Run Debugger Commands", "purple!50"),
+	("get_source", "Get Source", "red!50"),
+	("modify_code", "Modify Code", "green!50"),
+	("restart", "Restart", "orange!50"),
+	("end_session", "End Session", "gray!50"),
+]
+
 def generate_latex_code_from_df(df):
 	template = """
 \\begin{{tikzpicture}}
@@ -215,7 +267,7 @@ def generate_latex_code_from_df(df):
 	xticklabel style={{rotate=0, anchor=north, align=center, text width=1.5cm,xshift=0pt}},
 	]
 {}
-\\legend{{Run Debugger Command, Get Source, Modify Code, Restart, End Session}}
+\\legend{{{}}}
 {}
 \\end{{axis}}
 
@@ -245,17 +297,17 @@ def generate_latex_code_from_df(df):
 \\end{{tikzpicture}}
 """
 
-	df_normalized = df[['run_debugger_command', 'get_source', 'modify_code', 'restart', 'end_session']].div(df['count'], axis=0)
+	stacks = [function for function, _, _ in CHART_FUNCTIONS]
+	df_normalized = df.reindex(columns=stacks, fill_value=0).div(df['count'], axis=0)
 
 	# Extract problem categories
 	categories = ', '.join(df_normalized.index)
 
 	# Prepare the data for each stack
-	stacks = ["run_debugger_command", "get_source", "modify_code", "restart", "end_session"]
 	stack_data = ""
-	colors = ["blue!50", "red!50", "green!50", "orange!50", "gray!50"]
+	legend = ', '.join(label for _, label, _ in CHART_FUNCTIONS)
 
-	for stack, color in zip(stacks, colors):
+	for stack, _, color in CHART_FUNCTIONS:
 		stack_data += "\\addplot+[ybar, fill={}] plot coordinates {{".format(color)
 		for category in df_normalized.index:
 			stack_data += "({}, {}) ".format(category, df_normalized.at[category, stack])
@@ -275,37 +327,34 @@ def generate_latex_code_from_df(df):
 	for category, percentage in success_percentages.items():
 		line_graph_data += f"({category}, {percentage:.2f}) "
 
-	return template.format(categories, stack_data, node_data, categories, line_graph_data)
+	return template.format(categories, stack_data, legend, node_data, categories, line_graph_data)
 
 # Generalized function with an exceptions list parameter to combine certain types of error messages
 	
 def count_errors_with_exceptions(directory, exceptions):
 	error_count = {}
 	prefix = "Command execution failed: error: "
-	for root, dirs, files in os.walk(directory):
-		if 'conversation.json' in files:
-			with open(os.path.join(root, 'conversation.json'), 'r') as file:
-				conversations = json.load(file)
-				for conversation in conversations:
-					content = conversation.get('content', '')
-					if content:
-						# Extract error string up to the first newline, strip the prefix and trailing period
-						error_msg = content.split("\n")[0]
-						if error_msg.startswith(prefix):
-							stripped_error_msg = error_msg[len(prefix):].rstrip(".")
-
-							# Check for exceptions and combine errors accordingly
-							combined = False
-							for exception, combined_key in exceptions.items():
-								if exception in stripped_error_msg:
-									combined_key_stripped = combined_key[len(prefix):].rstrip(".")
-									error_count[combined_key_stripped] = error_count.get(combined_key_stripped, 0) + 1
-									combined = True
-									break
-							
-							# If not combined, count as a unique error
-							if not combined:
-								error_count[stripped_error_msg] = error_count.get(stripped_error_msg, 0) + 1
+	for root, files in artifacts.find_conversations(directory):
+		for conversation in artifacts.iter_messages(root, fields=("content",)):
+			content = conversation.get('content', '')
+			if content:
+				# Extract error string up to the first newline, strip the prefix and trailing period
+				error_msg = content.split("\n")[0]
+				if error_msg.startswith(prefix):
+					stripped_error_msg = error_msg[len(prefix):].rstrip(".")
+
+					# Check for exceptions and combine errors accordingly
+					combined = False
+					for exception, combined_key in exceptions.items():
+						if exception in stripped_error_msg:
+							combined_key_stripped = combined_key[len(prefix):].rstrip(".")
+							error_count[combined_key_stripped] = error_count.get(combined_key_stripped, 0) + 1
+							combined = True
+							break
+					
+					# If not combined, count as a unique error
+					if not combined:
+						error_count[stripped_error_msg] = error_count.get(stripped_error_msg, 0) + 1
 
 	# Sort the dictionary by count in descending order
 	sorted_error_count = dict(sorted(error_count.items(), key=lambda item: item[1], reverse=True))
@@ -341,6 +390,15 @@ print("\nBy segment:")
 segment_df = summarize_conversations_by_segment(updated_df)
 print(segment_df)
 
+print("\nCost by segment:")
+print(summarize_costs(updated_df, 'directory_segment'))
+
+print("\nCost by model:")
+print(summarize_costs(updated_df, 'model'))
+
+print("\nCost by tool schema:")
+print(summarize_costs(updated_df, 'tool_schema'))
+
 print("\nAll debugger commands:")
 print(count_all_debugger_commands(directory_path))
 
@@ -0,0 +1,116 @@
+import io
+import os
+import json
+import gzip
+import subprocess
+
+CONVERSATION_FILE_NAME = "conversation.json"
+# Compressed conversations hold one message per line, so they can be read without loading the whole file.
+COMPRESSED_CONVERSATION_FILE_NAMES = {"conversation.jsonl.zst": "zstd", "conversation.jsonl.gz": "gzip"}
+
+def open_compressed(path, codec, mode='rt'):
+	if codec == "zstd":
+		import zstandard
+		if 'r' in mode:
+			stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+		else:
+			stream = zstandard.ZstdCompressor(level=10).stream_writer(open(path, 'wb'), closefd=True)
+		return io.TextIOWrapper(stream, encoding='utf-8')
+	return gzip.open(path, mode, encoding='utf-8')
+
+def conversation_path(directory):
+	"""
+	Return the path of the conversation stored in a results directory and its codec, which is None for
+	plain JSON. If the directory has no conversation, return (None, None).
+	"""
+	for name, codec in COMPRESSED_CONVERSATION_FILE_NAMES.items():
+		path = os.path.join(directory, name)
+		if os.path.exists(path):
+			return path, codec
+	path = os.path.join(directory, CONVERSATION_FILE_NAME)
+	if os.path.exists(path):
+		return path, None
+	return None, None
+
+def has_conversation(files):
+	"""Return whether a directory listing includes a conversation in any format."""
+	return CONVERSATION_FILE_NAME in files or any(name in files for name in COMPRESSED_CONVERSATION_FILE_NAMES)
+
+def find_conversations(directory_path):
+	"""Yield (root, files) for every directory under directory_path that contains a conversation."""
+	for root, dirs, files in os.walk(directory_path):
+		if '.git' in dirs:
+			dirs.remove('.git')
+		if has_conversation(files):
+			yield root, files
+
+def iter_messages(directory, fields=None):
+	"""
+	Yield the messages of the conversation in a results directory. Compressed conversations are
+	decompressed as they are read, and the file is closed once the messages run out or the caller
+	closes the generator.
+
+	:param fields: If given, each message is reduced to these keys.
+	"""
+	path, codec = conversation_path(directory)
+	if path is None:
+		return
+	if codec is None:
+		with open(path, 'r') as f:
+			messages = json.load(f)
+		for message in messages:
+			yield message if fields is None else {key: message[key] for key in fields if key in message}
+		return
+	with open_compressed(path, codec) as f:
+		for line in f:
+			if not line.strip():
+				continue
+			message = json.loads(line)
+			yield message if fields is None else {key: message[key] for key in fields if key in message}
+
+def load_conversation(directory, fields=None):
+	return list(iter_messages(directory, fields))
+
+def default_codec():
+	try:
+		import zstandard
+	except ImportError:
+		return "gzip"
+	return "zstd"
+
+def compress_conversation(directory, codec=None):
+	"""Replace conversation.json with a compressed JSON Lines copy. Return the new path, or None if there was nothing to compress."""
+	path = os.path.join(directory, CONVERSATION_FILE_NAME)
+	if not os.path.exists(path):
+		return None
+	codec = codec or default_codec()
+	with open(path, 'r') as f:
+		messages = json.load(f)
+	name = next(name for name, name_codec in COMPRESSED_CONVERSATION_FILE_NAMES.items() if name_codec == codec)
+	compressed_path = os.path.join(directory, name)
+	temp_path = f"{compressed_path}.{os.getpid()}.tmp"
+	with open_compressed(temp_path, codec, 'wt') as f:
+		for message in messages:
+			f.write(json.dumps(message, separators=(',', ':')) + "\n")
+	os.replace(temp_path, compressed_path)
+	os.remove(path)
+	return compressed_path
+
+def pack_snapshots(directory):
+	"""
+	Pack the loose objects of a results directory's snapshot repository into a single git pack.
+	The repository stays readable by git, but snapshot_store only reads loose objects, so a packed
+	repository can no longer be extended in-process.
+	"""
+	if not os.path.isdir(os.path.join(directory, '.git')):
+		return False
+	result = subprocess.run(["git", "repack", "-a", "-d", "-q"], cwd=directory, capture_output=True, text=True)
+	if result.returncode != 0:
+		print(f"Failed to pack snapshots in {directory}: {result.stderr}")
+		return False
+	return True
+
+def compact(directory, codec=None):
+	"""Compress the conversation and pack the snapshots of a results directory."""
+	compress_conversation(directory, codec)
+	pack_snapshots(directory)
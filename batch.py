@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import concurrent.futures
+import file_utilities
+import workspace
+import prebuild
+import querier
+from termcolor import colored
+
+# Each set of settings that changes the first turn's request has its own state, so a rerun with another model or schema doesn't reuse contexts.
+BATCH_STATE_FILE_NAME = "batch_first_turns.{key}.json"
+
+def gprint(input_str):
+	print(colored(input_str, 'light_grey'))
+
+def build_first_turn_request(code_path, compile_command, executable, model, tool_schema=querier.DEFAULT_TOOL_SCHEMA, build_directory=None):
+	"""
+	Run a program under the debugger up to its first stop and build the request the model would
+	receive for the first turn of its session.
+
+	:param build_directory: The program's cached build from prebuild, which is used instead of compiling it again.
+	:return: The request body, or None if the program doesn't stop.
+	"""
+	import debugging
+
+	session_workspace = workspace.create(code_path)
+	code_directory = session_workspace.path
+	try:
+		if build_directory:
+			prebuild.restore(build_directory, code_directory)
+		else:
+			returncode, stdout, stderr = file_utilities.execute_command(code_directory, *compile_command)
+			if returncode != 0:
+				print(f"Compilation failed for {code_path}: {stdout} {stderr}")
+				return None
+
+		session = debugging.DebuggingSession(os.path.join(code_directory, executable))
+		session.start(pause_at_start=False, working_directory=code_directory)
+		if session.has_exited():
+			return None
+		stop_info = session.stop_info()
+		session.process.Kill()
+	finally:
+		session_workspace.cleanup()
+
+	# This mirrors the input that OpenAIModelQuerier.get_output assembles for the first turn.
+	messages = [
+		{"role": "system", "content": querier.AIModelQuerier.initial_prompt()},
+		{"role": "user", "content": stop_info},
+		{"role": "system", "content": querier.AIModelQuerier.transient_prompt()},
+	]
+	return {"model": model, "max_tokens": 1000, "messages": messages, "tools": querier.OpenAIModelQuerier.get_tools(tool_schema)}
+
+class LocalBatchSubmitter:
+	"""
+	Stands in for a batch endpoint by sending each request through the shared rate limiter from a thread pool.
+	"""
+	def __init__(self, max_workers=8):
+		self.max_workers = max_workers
+
+	def submit(self, requests, state):
+		import openai
+		import rate_limiter
+
+		def run(body):
+			return rate_limiter.shared_rate_limiter().call(
+				lambda: openai.ChatCompletion.create(**body),
+				estimated_tokens=len(json.dumps(body)) // 4 + body["max_tokens"],
+				retryable_exceptions=(openai.error.APIError, openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.TryAgain),
+				rate_limit_exceptions=(openai.error.RateLimitError,),
+			)
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			futures = {executor.submit(run, body): custom_id for custom_id, body in requests.items()}
+			for future in concurrent.futures.as_completed(futures):
+				custom_id = futures[future]
+				try:
+					yield custom_id, future.result()
+				except openai.error.OpenAIError as e:
+					print(f"First turn request for {custom_id} failed: {e}")
+
+class OpenAIBatchSubmitter:
+	"""
+	Submits requests to the OpenAI batch endpoint and waits for the batch to finish. The batch
+	identifier is kept in the state so that an interrupted run resumes polling instead of resubmitting.
+	"""
+	def __init__(self, poll_interval=60):
+		self.poll_interval = poll_interval
+
+	def submit(self, requests, state):
+		import openai
+
+		requestor = openai.api_requestor.APIRequestor()
+		batch_id = state.get("batch_id")
+		if batch_id is None:
+			lines = [json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) for custom_id, body in requests.items()]
+			input_file = openai.File.create(file="\n".join(lines).encode(), purpose="batch", user_provided_filename="batch_first_turns.jsonl")
+			response, _, _ = requestor.request("post", "/batches", {"input_file_id": input_file["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"})
+			batch_id = response.data["id"]
+			state["batch_id"] = batch_id
+			state.save()
+			gprint(f"Submitted batch {batch_id} with {len(lines)} first turns")
+
+		while True:
+			response, _, _ = requestor.request("get", f"/batches/{batch_id}")
+			batch = response.data
+			if batch["status"] in ["completed", "failed", "expired", "cancelled"]:
+				break
+			gprint(f"Batch {batch_id} is {batch['status']}; checking again in {self.poll_interval}s…")
+			time.sleep(self.poll_interval)
+
+		state["batch_id"] = None
+		state.save()
+		if not batch.get("output_file_id"):
+			print(f"Batch {batch_id} ended with status {batch['status']} and no output.")
+			return
+
+		for line in openai.File.download(batch["output_file_id"]).decode().splitlines():
+			result = json.loads(line)
+			if result.get("error") or result["response"]["status_code"] != 200:
+				print(f"First turn request for {result['custom_id']} failed: {result.get('error') or result['response']}")
+				continue
+			yield result["custom_id"], result["response"]["body"]
+
+BATCH_SUBMITTERS = {
+	"local": LocalBatchSubmitter,
+	"openai": OpenAIBatchSubmitter,
+}
+
+class BatchState(dict):
+	"""
+	Tracks which cases already have a stored first-turn context, so reruns with the same settings don't submit them again.
+	"""
+	def __init__(self, path):
+		self.path = path
+		super().__init__({"contexts": {}, "usage": {}, "pending": {}, "batch_id": None})
+		if os.path.exists(path):
+			with open(path, 'r') as f:
+				self.update(json.load(f))
+
+	def save(self):
+		with open(self.path, 'w') as f:
+			f.write(json.dumps(self, indent=2))
+
+def state_key(compile_command, executable, model, tool_schema):
+	"""Hash the settings that decide what a first-turn request contains and which model answers it."""
+	settings = {
+		"compile_command": compile_command, "executable": executable, "model": model,
+		"tools": querier.SERIALIZED_TOOL_SCHEMAS[tool_schema],
+		"initial_prompt": querier.AIModelQuerier.initial_prompt(),
+		"transient_prompt": querier.AIModelQuerier.transient_prompt(),
+	}
+	return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+def prefetch_first_turns(cases, compile_command, executable, model, state_directory, submitter_name="local", tool_schema=querier.DEFAULT_TOOL_SCHEMA, builds=None):
+	"""
+	Request the first model turn of every case in one batch and store each response as a context
+	that the case's session can resume from.
+
+	:param cases: A dictionary mapping case names to the directories containing their code.
+	:param builds: An optional dictionary mapping case names to build directories from prebuild.prebuild_all.
+	:return: A tuple of dictionaries mapping case names to context identifiers and to the token usage of their first turns.
+	"""
+	builds = builds or {}
+	state = BatchState(os.path.join(state_directory, BATCH_STATE_FILE_NAME.format(key=state_key(compile_command, executable, model, tool_schema))))
+	requests = {}
+	if state["batch_id"] is None:
+		for case_name, code_path in cases.items():
+			if case_name in state["contexts"]:
+				continue
+			gprint(f"Preparing the first turn for {case_name}…")
+			request = build_first_turn_request(code_path, compile_command, executable, model, tool_schema, builds.get(case_name))
+			if request is None:
+				continue
+			requests[case_name] = request
+			# Keep the prompt without the transient system message, which sessions don't record.
+			pending_identifier = str(uuid.uuid4())
+			file_utilities.store_context(request["messages"][:-1], pending_identifier)
+			state["pending"][case_name] = pending_identifier
+		state.save()
+
+	if requests or state["batch_id"] is not None:
+		for case_name, response in BATCH_SUBMITTERS[submitter_name]().submit(requests, state):
+			context = file_utilities.retrieve_context(state["pending"].pop(case_name)) + [response["choices"][0]["message"]]
+			context_identifier = str(uuid.uuid4())
+			file_utilities.store_context(context, context_identifier)
+			state["contexts"][case_name] = context_identifier
+			# Sessions record the usage in their turn metrics when they replay the response.
+			state["usage"][case_name] = dict(response.get("usage") or {})
+			state.save()
+
+	contexts = {case_name: state["contexts"][case_name] for case_name in cases if case_name in state["contexts"]}
+	return contexts, {case_name: state["usage"][case_name] for case_name in contexts if case_name in state["usage"]}
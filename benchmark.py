@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import replay
+
+DEFAULT_RESULTS_PATHS = ["results-gpt4-turbo", "results-gpt3.5-turbo"]
+
+def current_commit():
+	result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+	return result.stdout.strip() if result.returncode == 0 else None
+
+def summarize(cases):
+	phases = {}
+	for case in cases:
+		for name, phase in case.get("phases", {}).items():
+			total = phases.setdefault(name, {"seconds": 0.0, "count": 0})
+			total["seconds"] += phase["seconds"]
+			total["count"] += phase["count"]
+	replayed = [case for case in cases if "error" not in case]
+	return {
+		"cases": len(replayed),
+		"errors": len(cases) - len(replayed),
+		"turns": sum(case["turns"] for case in replayed),
+		"wall_time": sum(case["wall_time"] for case in replayed),
+		"untraced": sum(case["untraced"] for case in replayed),
+		"phases": phases,
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description="Replay recorded conversations with a zero-latency stand-in model and report the time spent in each phase of a session.")
+	parser.add_argument('results_paths', nargs='*', default=DEFAULT_RESULTS_PATHS, help=f"The results directories holding the recorded conversations. Defaults to {DEFAULT_RESULTS_PATHS}.")
+	parser.add_argument('--programs_path', default="juliet", help=f"The directory containing one directory per program, named like the results directories.")
+	parser.add_argument('--compile_command', nargs='*', default=["make"], help=f"The command to run to compile each program.")
+	parser.add_argument('--executable', default="main", help=f"The executable to run, relative to the program directory.")
+	parser.add_argument('--limit', type=int, required=False, help=f"Replay at most this many conversations.")
+	parser.add_argument('--output', required=False, help=f"The path to write the results to as JSON. By default they are printed.")
+	args = parser.parse_args()
+
+	# Keep the replayed sessions out of the real session database.
+	database_directory = tempfile.mkdtemp(prefix="benchmark-database-")
+	os.environ["GENERATIVE_DEBUGGING_DATABASE"] = os.path.join(database_directory, "sessions.sqlite3")
+
+	cases = []
+	try:
+		for results_name, case_name, conversation_directory, code_path in replay.find_cases(args.results_paths, args.programs_path):
+			if args.limit is not None and len(cases) >= args.limit:
+				break
+			print(f"Replaying {results_name}/{case_name}…", file=sys.stderr)
+			case = {"results": results_name, "case": case_name}
+			try:
+				case.update(replay.replay(conversation_directory, code_path, args.compile_command, args.executable))
+			except Exception as e:
+				case["error"] = str(e)
+			cases.append(case)
+	finally:
+		shutil.rmtree(database_directory, ignore_errors=True)
+
+	results = {
+		"commit": current_commit(),
+		"python": sys.version.split()[0],
+		"platform": sys.platform,
+		"summary": summarize(cases),
+		"cases": cases,
+	}
+	output = json.dumps(results, indent=2)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(output)
+	else:
+		print(output)
+
+if __name__ == "__main__":
+	main()
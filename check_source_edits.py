@@ -0,0 +1,61 @@
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+import source_buffer
+
+LINES = ["int main(void) {", "\tint *pointer = NULL;", "\treturn *pointer;", "}"]
+
+CHANGES = [{
+	"from-file-range": {"start-line": 2, "code": "int *pointer = NULL;"},
+	"to-file-range": {"start-line": 2, "code": "\tint value = 0;\n\tint *pointer = &value;"},
+}]
+
+EXPECTED_LINES = ["int main(void) {", "\tint value = 0;", "\tint *pointer = &value;", "\treturn *pointer;", "}"]
+
+def check_edit(directory, name, newline, trailing_newline):
+	"""Edit a file with the given line ending and return a list of problems with the written file."""
+	with open(os.path.join(directory, name), 'w', newline='') as f:
+		f.write(newline.join(LINES) + (newline if trailing_newline else ''))
+	edit = source_buffer.SourceEdit(directory, name, CHANGES)
+	if not edit.valid:
+		return [f"the edit was rejected: {edit.message}"]
+	succeeded, error = edit.apply()
+	if not succeeded:
+		return [f"the edit wasn't written: {error}"]
+
+	with open(os.path.join(directory, name), 'rb') as f:
+		written = f.read().decode()
+	expected = newline.join(EXPECTED_LINES) + (newline if trailing_newline else '')
+	if written == expected:
+		return []
+	return [f"expected {expected!r} but the file contains {written!r}"]
+
+def main():
+	parser = argparse.ArgumentParser(description="Apply an edit to files with LF and CRLF line endings and check that only the edited lines change.")
+	parser.parse_args()
+
+	directory = tempfile.mkdtemp(prefix="check-source-edits-")
+	failures = {}
+	try:
+		for name, newline, trailing_newline in [
+			("lf.c", '\n', True),
+			("crlf.c", '\r\n', True),
+			("crlf_no_trailing_newline.c", '\r\n', False),
+		]:
+			problems = check_edit(directory, name, newline, trailing_newline)
+			if problems:
+				failures[name] = problems
+	finally:
+		source_buffer.release_cache(directory)
+		shutil.rmtree(directory, ignore_errors=True)
+
+	for name, problems in failures.items():
+		for problem in problems:
+			print(f"{name}: {problem}")
+	print(f"{3 - len(failures)}/3 edits kept the file's line endings")
+	sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+	main()
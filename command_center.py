@@ -1,4 +1,6 @@
 import file_utilities
+import source_buffer
+import tracing
 from abc import ABC, abstractmethod
 import sys
 import textwrap
@@ -27,6 +29,7 @@ class CommandCenter:
 				self.modelQuerier.append_user_message(f"The process exited with code {debug_session.exit_status_code()}.")
 				file_utilities.store_success_sentinel(self.globalContext.workingDirectory)
 				file_utilities.store_json_context(self.globalContext.workingDirectory, self.modelQuerier.messages)
+				file_utilities.store_json_metrics(self.globalContext.workingDirectory, self.modelQuerier.turn_metrics)
 				file_utilities.add_commit(self.globalContext.workingDirectory, f"Final commit after process exited with code {debug_session.exit_status_code()}.")
 				break
 			if self.modelQuerier.gave_up:
@@ -35,7 +38,7 @@ class CommandCenter:
 			function_calls = self.modelQuerier.get_output(self.globalContext.workingDirectory)
 
 			for function_call in function_calls:
-				cmd = Command.get_command_object(function_call.type, function_call.context, self.globalContext)
+				cmd = Command.get_command_object(function_call.type, function_call.context, self.globalContext, function_call.payload)
 				cmd.run()
 				
 				printable_context = '\n' + colored(textwrap.indent(function_call.context, '\t'), 'blue') if function_call.context else "(none)"
@@ -46,23 +49,27 @@ class CommandCenter:
 				self.modelQuerier.append_function_call_response(function_call, command_output)
 				
 			file_utilities.store_json_context(self.globalContext.workingDirectory, self.modelQuerier.messages)
+			file_utilities.store_json_metrics(self.globalContext.workingDirectory, self.modelQuerier.turn_metrics)
 			
 			
 
 				
 class Command(ABC):
-	def __init__(self, context, globalContext):
+	def __init__(self, context, globalContext, payload=None):
 		self.context = context
 		self.globalContext = globalContext
+		self.payload = payload
 		self.success = False
 		self.command_output = ""
 
 	@staticmethod
-	def get_command_object(type, context, globalContext):
+	def get_command_object(type, context, globalContext, payload=None):
 		if type == "patch":
-			return PatchCommand(context, globalContext)
+			return PatchCommand(context, globalContext, payload)
 		elif type == "lldb":
 			return DebuggerCommand(context, globalContext)
+		elif type == "lldb_batch":
+			return BatchDebuggerCommand(context, globalContext, payload)
 		elif type == "source":
 			return SourceCommand(context, globalContext)
 		elif type == "compile":
@@ -86,7 +93,11 @@ class Command(ABC):
 
 class PatchCommand(Command):
 	def run(self):
-		self.success, command_output = file_utilities.apply_patch_from_string(self.globalContext.workingDirectory, self.context)
+		if self.payload is not None:
+			# The edit was validated in memory, so it can be written directly without running patch.
+			self.success, command_output = self.payload.apply()
+		else:
+			self.success, command_output = file_utilities.apply_patch_from_string(self.globalContext.workingDirectory, self.context)
 		
 		if self.success:
 			
@@ -116,47 +127,43 @@ class DebuggerCommand(Command):
 		else:
 			self.command_output = f"Command execution failed: {command_output}"
 
-class SourceCommand(Command):
+class BatchDebuggerCommand(Command):
 	def run(self):
-		def prepend_line_numbers(text):
-			lines = text.splitlines()  # Split the text into lines
-			numbered_lines = [f"{i + 1}: {line}" for i, line in enumerate(lines)]  # Prepend line numbers
-			return "\n".join(numbered_lines)  # Join the lines back into a single string
-
-		def get_line_with_context(text, line_number, context):
-			# Split the text into lines
-			lines = text.split('\n')
-		
-			# Check if the line number is valid
-			if line_number < 1 or line_number > len(lines):
-				return "Line number out of range."
-		
-			# Adjust line number to 0-indexed
-			line_number -= 1
+		commands = self.payload["commands"]
+		results = self.globalContext.debugSession.execute_commands(commands, self.payload["stop_on_error"])
+		self.success = len(results) == len(commands) and all(success for _, success, _ in results)
 		
-			# Calculate the start and end indices for context
-			start = max(0, line_number - context)
-			end = min(len(lines), line_number + context + 1)
-		
-			# Extract the lines and join them back into a string
-			return '\n'.join(lines[start:end])
+		sections = []
+		for command_str, success, command_output in results:
+			if not success:
+				command_output = f"Command execution failed: {command_output}"
+			elif len(command_output.strip()) == 0:
+				command_output = "The command produced no output."
+			sections.append(f"(lldb) {command_str}\n{command_output.rstrip()}")
+		for command_str in commands[len(results):]:
+			sections.append(f"(lldb) {command_str}\nSkipped because a previous command failed.")
+		self.command_output = "\n\n".join(sections)
 
+class SourceCommand(Command):
+	@tracing.traced("source")
+	def run(self):
 		split_context = self.context.split(":")
 		file_name = split_context[0]
 		line_number = int(split_context[1])
 		context_lines = int(split_context[2])
 		
-		self.command_output = file_utilities.get_source_code(self.globalContext.workingDirectory, file_name)
+		# The buffer is cached per workspace and reloaded only when the file changes on disk.
+		buffer = source_buffer.get_buffer(self.globalContext.workingDirectory, file_name)
 		
-		if self.command_output:
-			self.command_output = prepend_line_numbers(self.command_output)
-			self.command_output = get_line_with_context(self.command_output, line_number, context_lines)
+		if buffer and buffer.text:
+			self.command_output = buffer.numbered_window(line_number, context_lines) or "Line number out of range."
 
 		else:
 			self.success = False
 			self.command_output = f"Failed to get contents of source file {self.context}."
 
 class CompileCommand(Command):
+	@tracing.traced("compile")
 	def run(self):
 		returncode, stdout, stderr = file_utilities.execute_command(self.globalContext.workingDirectory, *self.globalContext.compileCommand)
 		self.success = (returncode == 0)
@@ -171,6 +178,7 @@ class GiveUpCommand(Command):
 	def run(self):
 		self.globalContext.modelQuerier.append_user_message(f"The model gave up.")
 		file_utilities.store_json_context(self.globalContext.workingDirectory, self.globalContext.modelQuerier.messages)
+		file_utilities.store_json_metrics(self.globalContext.workingDirectory, self.globalContext.modelQuerier.turn_metrics)
 		file_utilities.store_failure_sentinel(self.globalContext.workingDirectory)
 		file_utilities.add_commit(self.globalContext.workingDirectory, f"Final commit after the model gave up.")
 		self.globalContext.modelQuerier.gave_up = True
@@ -187,6 +195,7 @@ class FatalErrorCommand(Command):
 	def run(self):
 		self.globalContext.modelQuerier.append_user_message(f"Ending session due to a fatal error: {self.context}")
 		file_utilities.store_json_context(self.globalContext.workingDirectory, self.globalContext.modelQuerier.messages)
+		file_utilities.store_json_metrics(self.globalContext.workingDirectory, self.globalContext.modelQuerier.turn_metrics)
 		file_utilities.store_failure_sentinel(self.globalContext.workingDirectory)
 		file_utilities.add_commit(self.globalContext.workingDirectory, f"Final commit after ending due to a fatal error: {self.context}.")
 		self.globalContext.modelQuerier.gave_up = True
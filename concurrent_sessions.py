@@ -0,0 +1,114 @@
+import argparse
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import concurrent.futures
+import querier
+import replay
+
+CRASHING_PROGRAM = """#include <stdio.h>
+
+int main(void) {
+	int *pointer = NULL;
+	printf("%d\\n", *pointer);
+	return 0;
+}
+"""
+
+MAKEFILE = """main: main.c
+	cc -g main.c -o main
+"""
+
+def tool_call(call_identifier, name, arguments):
+	return {"id": call_identifier, "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+
+def recorded_conversation():
+	"""A session that reads the crashing line, then fixes it, which the stand-in model replays."""
+	return [
+		{"role": "assistant", "content": "Let me look at the crashing line.", "tool_calls": [
+			tool_call("call_source", "get_source", {"file_path": "main.c", "line_number": 5, "context_lines": 3}),
+		]},
+		{"role": "assistant", "content": "The pointer is NULL, so point it at a value.", "tool_calls": [
+			tool_call("call_patch", "modify_code", {"file_path": "main.c", "changes": [{
+				"from-file-range": {"start-line": 4, "code": "int *pointer = NULL;"},
+				"to-file-range": {"start-line": 4, "code": "\tint value = 0;\n\tint *pointer = &value;"},
+			}]}),
+		]},
+	]
+
+def check_session(output_path):
+	"""Return a list of problems with a finished session's results directory."""
+	problems = []
+	with open(os.path.join(output_path, 'main.c'), 'r') as f:
+		if "int *pointer = &value;" not in f.read():
+			problems.append("main.c wasn't patched")
+	if not os.path.exists(os.path.join(output_path, 'succeeded.txt')):
+		problems.append("succeeded.txt is missing")
+	log = subprocess.run(["git", "log", "--format=%s"], cwd=output_path, capture_output=True, text=True)
+	if "Applying patch from model." not in log.stdout:
+		problems.append(f"the patch wasn't committed: {log.stdout or log.stderr}")
+	return problems
+
+def main():
+	parser = argparse.ArgumentParser(description="Run several debugging sessions as threads of one process, each replaying the same recorded conversation, and check that they didn't interfere with each other or with the process working directory.")
+	parser.add_argument('--sessions', type=int, default=8, help=f"The number of sessions to run at once.")
+	parser.add_argument('--keep', action='store_true', help=f"Keep the sessions' results directories for inspection.")
+	args = parser.parse_args()
+
+	# Imported here so that the help can be shown without lldb.
+	import debug_program
+
+	root = tempfile.mkdtemp(prefix="concurrent-sessions-")
+	os.environ["GENERATIVE_DEBUGGING_DATABASE"] = os.path.join(root, "sessions.sqlite3")
+	code_path = os.path.join(root, "program")
+	os.makedirs(code_path)
+	with open(os.path.join(code_path, 'main.c'), 'w') as f:
+		f.write(CRASHING_PROGRAM)
+	with open(os.path.join(code_path, 'Makefile'), 'w') as f:
+		f.write(MAKEFILE)
+
+	working_directory = os.getcwd()
+	queriers = [querier.ReplayModelQuerier(recorded_conversation()) for _ in range(args.sessions)]
+	output_paths = [os.path.join(root, f"session-{index}") for index in range(args.sessions)]
+	failures = {}
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=args.sessions) as executor:
+			futures = {executor.submit(debug_program.debug_executable, code_path, ["make"], "main", ["replay"], None, output_path, model_querier=model_querier): index
+				for index, (model_querier, output_path) in enumerate(zip(queriers, output_paths))}
+			for future in concurrent.futures.as_completed(futures):
+				index = futures[future]
+				try:
+					status = future.result()
+				except Exception as e:
+					failures[index] = [f"{type(e).__name__}: {e}"]
+					continue
+				problems = [] if status == "exited" else [f"ended with status {status}"]
+				problems += check_session(output_paths[index])
+				if problems:
+					failures[index] = problems
+
+		if os.getcwd() != working_directory:
+			failures["process"] = [f"the working directory changed to {os.getcwd()}"]
+
+		# Every session ran the same program and calls, so any difference in their outputs means they interfered.
+		for index, model_querier in enumerate(queriers[1:], start=1):
+			comparison = replay.compare_outputs(queriers[0].messages, model_querier.messages)
+			if comparison["differed"] or comparison["missing"] or comparison["extra"]:
+				failures.setdefault(index, []).append(f"its outputs differ from session 0: {json.dumps(comparison, indent=2)}")
+	finally:
+		if args.keep:
+			print(f"Results are in {root}")
+		else:
+			shutil.rmtree(root, ignore_errors=True)
+
+	for index, problems in sorted(failures.items(), key=lambda item: str(item[0])):
+		for problem in problems:
+			print(f"Session {index}: {problem}")
+	print(f"{args.sessions - len([index for index in failures if index != 'process'])}/{args.sessions} sessions succeeded")
+	sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+	main()
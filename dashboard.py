@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import threading
+from termcolor import colored
+
+STATUS_FILE_NAME = "status.json"
+
+def percentile(values, p):
+	"""Return the nearest-rank percentile of a list of values, or None if it is empty."""
+	if not values:
+		return None
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+def format_duration(seconds):
+	if seconds is None:
+		return "-"
+	hours, remainder = divmod(int(seconds), 3600)
+	minutes, seconds = divmod(remainder, 60)
+	return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+class Dashboard:
+	"""
+	Summarizes the progress of a batch run from the runs recorded in the session store, which include
+	the turns and tokens from each session's metrics. The summary is printed and, if `status_path` is
+	set, written as JSON every `interval` seconds and whenever a session finishes.
+	"""
+	def __init__(self, store, model, config_hash, total_cases, status_path=None, interval=60):
+		self.store = store
+		self.model = model
+		self.config_hash = config_hash
+		self.total_cases = total_cases
+		self.status_path = status_path
+		self.interval = interval
+		self.start_time = time.time()
+		self.in_progress = set()
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self.run, daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		self.update()
+
+	def run(self):
+		while not self._stopped.wait(self.interval):
+			self.update()
+
+	def session_started(self, entry):
+		with self._lock:
+			self.in_progress.add(entry)
+
+	def session_finished(self, entry):
+		with self._lock:
+			self.in_progress.discard(entry)
+		self.update()
+
+	def snapshot(self):
+		now = time.time()
+		elapsed = now - self.start_time
+		# Only runs finished since the dashboard started count, so that rates describe this invocation.
+		runs = [run for run in self.store.runs_finished_since(self.model, self.config_hash, self.start_time) if run["duration"] is not None]
+		durations = [run["duration"] for run in runs]
+		turns = [run["turns"] for run in runs if run["turns"] is not None]
+		tokens = sum(run["total_tokens"] or 0 for run in runs)
+		debugged = [run for run in runs if run["status"] in ["exited", "gave_up", "failed"]]
+		succeeded = [run for run in debugged if run["status"] == "exited"]
+
+		cases_per_hour = len(runs) / elapsed * 3600 if elapsed > 0 else 0
+		remaining = max(0, self.total_cases - len(runs))
+		with self._lock:
+			in_progress = len(self.in_progress)
+		return {
+			"updated_at": now,
+			"elapsed": elapsed,
+			"total_cases": self.total_cases,
+			"finished": len(runs),
+			"in_progress": in_progress,
+			"remaining": remaining,
+			"statuses": {status: sum(1 for run in runs if run["status"] == status) for status in sorted({run["status"] for run in runs})},
+			"cases_per_hour": cases_per_hour,
+			"duration_p50": percentile(durations, 50),
+			"duration_p95": percentile(durations, 95),
+			"turns_per_case": sum(turns) / len(turns) if turns else None,
+			"tokens_per_second": tokens / elapsed if elapsed > 0 else 0,
+			"success_rate": len(succeeded) / len(debugged) if debugged else None,
+			"eta": remaining / cases_per_hour * 3600 if cases_per_hour > 0 else None,
+		}
+
+	def update(self):
+		status = self.snapshot()
+		if self.status_path:
+			temp_path = f"{self.status_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+			with open(temp_path, 'w') as f:
+				f.write(json.dumps(status, indent=2))
+			os.replace(temp_path, self.status_path)
+
+		success_rate = f"{status['success_rate'] * 100:.0f}%" if status['success_rate'] is not None else "-"
+		turns_per_case = f"{status['turns_per_case']:.1f}" if status['turns_per_case'] is not None else "-"
+		print(colored(
+			f"[{status['finished']}/{status['total_cases']} done, {status['in_progress']} running] "
+			f"{status['cases_per_hour']:.1f} cases/h, p50 {format_duration(status['duration_p50'])}, p95 {format_duration(status['duration_p95'])}, "
+			f"{turns_per_case} turns/case, {status['tokens_per_second']:.1f} tokens/s, success {success_rate}, ETA {format_duration(status['eta'])}",
+			'cyan'))
+		return status
@@ -1,52 +1,122 @@
 import argparse
 import querier
-import debugging
 from functools import partial
 import file_utilities
 import os
 import command_center
+import rate_limiter
+import batch
+import workspace
+import source_buffer
+import session_store
+import artifacts
+import runner
+import tempfile
+import shutil
+import time
+import work_queue
+import prebuild
+import triage
+import dashboard
+import tracing
 from termcolor import colored
 
 def gprint(input_str):
 	print(colored(input_str, 'light_grey'))
 
-def debug_executable(code_path, compile_command, executable, model, context_identifier, output_path):
-	modelQuerier = querier.AIModelQuerier.resolve_queriers([model])[0]
+def session_config(compile_command, executable, models, tool_schema, hedge_percentile=None, prompts=None):
+	"""Return the settings that affect a session's outcome, which runs are recorded under in the manifest."""
+	prompts = prompts or {}
+	return {
+		"compile_command": compile_command, "executable": executable, "models": models,
+		"tool_schema": tool_schema, "hedge_percentile": hedge_percentile,
+		"initial_prompt": prompts.get("initial_prompt") or querier.AIModelQuerier.initial_prompt(),
+		"transient_prompt": prompts.get("transient_prompt") or querier.AIModelQuerier.transient_prompt(),
+	}
+
+def debug_executable(code_path, compile_command, executable, models, context_identifier, output_path, hedge_percentile=None, tool_schema=querier.DEFAULT_TOOL_SCHEMA, compress_artifacts=False, build_directory=None, model_querier=None, prompts=None, context_usage=None):
+	# Imported here so that lldb is only loaded once there is something to debug.
+	import debugging
+
+	# A querier can be passed in to drive the session with something other than a model, like a recorded conversation.
+	modelQuerier = model_querier or querier.AIModelQuerier.resolve_queriers(models[:1])[0]
+	modelQuerier.tool_schema = tool_schema
+	if prompts:
+		modelQuerier.set_prompts(prompts.get("initial_prompt"), prompts.get("transient_prompt"))
+	if hedge_percentile is not None:
+		# A second model, if given, receives the hedged requests; otherwise the first model is asked again.
+		modelQuerier.enable_hedging(models[1] if len(models) > 1 else None, hedge_percentile)
 	gprint(f"***Using context identifier {modelQuerier.get_context_identifier()}")
-	
-	code_directory = file_utilities.copy_to_temp(code_path)
-	file_utilities.initialize_git_repository(code_directory)
-	gprint(f"Copied code to {code_directory}")	
-	
-	file_utilities.execute_command(code_directory, *compile_command)
-	gprint(f"Compiled with {compile_command}")
-	executable_path = os.path.join(code_directory, executable)
-	gprint(f"Running {executable_path}…")
-	
-	commandCenter = command_center.CommandCenter(modelQuerier, code_directory, compile_command)
-	if context_identifier:
-		modelQuerier.load_context(context_identifier)
-	
-	session = debugging.DebuggingSession(executable_path)
-	session.start(pause_at_start=False, working_directory=code_directory)
-	
-	if session.has_exited():
-		print(f"Process ran to completion. Skipping…")
-		return
-	
-	while True:
-		gprint(f"Process status: {session.process}")
+	# Sessions are recorded under the identifier their contexts are saved with.
+	session_identifier = str(modelQuerier.get_context_identifier())
+	store = session_store.shared_store()
+	session_workspace = None
+	status = "failed"
+	try:
+		# Started inside the try, so a session whose workspace can't be created is marked failed rather than left running.
+		store.start_session(session_identifier, os.path.basename(os.path.normpath(code_path)), models[0], output_path)
+		session_workspace = workspace.create(code_path)
+		code_directory = session_workspace.path
+		file_utilities.initialize_git_repository(code_directory)
+		gprint(f"Copied code to {code_directory}")	
+		
+		build_record = None
+		if build_directory:
+			build_record = prebuild.restore(build_directory, code_directory)
+			gprint(f"Restored the cached build from {build_directory}")
+		else:
+			with tracing.phase("compile"):
+				file_utilities.execute_command(code_directory, *compile_command)
+			gprint(f"Compiled with {compile_command}")
+		executable_path = os.path.join(code_directory, executable)
+		gprint(f"Running {executable_path}…")
+		
+		commandCenter = command_center.CommandCenter(modelQuerier, code_directory, compile_command)
+		if context_identifier:
+			modelQuerier.load_context(context_identifier, context_usage)
+		
+		session = debugging.DebuggingSession(executable_path)
+		if build_record and build_record.get("build_path"):
+			# The cached binary's debug information points at the directory it was built in, which no longer exists.
+			session.execute_command(f'settings set target.source-map "{build_record["build_path"]}" "{code_directory}"')
+		session.start(pause_at_start=False, working_directory=code_directory)
+		
 		if session.has_exited():
-			print(f"Process exited with return code {session.exit_status_code()}")
-			break
-		if modelQuerier.gave_up:
-			print(f"Model gave up.")
-			break
-		commandCenter.on_stop(session)
-		
-	# Copy git repository to the output directory
-	if output_path:
-		file_utilities.copy_dir(code_directory, output_path)
+			print(f"Process ran to completion. Skipping…")
+			status = "skipped"
+			store.update_session(session_identifier, status, session.exit_status_code())
+			return status
+		
+		while True:
+			gprint(f"Process status: {session.process}")
+			if session.has_exited():
+				print(f"Process exited with return code {session.exit_status_code()}")
+				status = "exited"
+				store.update_session(session_identifier, status, session.exit_status_code())
+				break
+			if modelQuerier.gave_up:
+				print(f"Model gave up.")
+				status = "gave_up"
+				store.update_session(session_identifier, status)
+				break
+			commandCenter.on_stop(session)
+			
+		# Move the git repository to the output directory
+		file_utilities.release_git_repository(code_directory)
+		source_buffer.release_cache(code_directory)
+		if output_path:
+			session_workspace.export(output_path)
+			if compress_artifacts:
+				artifacts.compact(output_path)
+		return status
+	finally:
+		if status == "failed":
+			store.update_session(session_identifier, status)
+		# Pool and queue workers outlive their sessions, so a workspace left behind would never be evicted.
+		if session_workspace is not None:
+			file_utilities.release_git_repository(session_workspace.path)
+			source_buffer.release_cache(session_workspace.path)
+			session_workspace.cleanup()
 
 def main():
 	parser = argparse.ArgumentParser(description="Run specified phases of the grading process.")
@@ -54,24 +124,91 @@ def main():
 	parser.add_argument('--code_directory_path', required=False, help=f"A directory containing multiple directories, one for each executable to be debugged.")
 	parser.add_argument('--compile_command', nargs='*', required=True, help=f"The command to run to compile the code. This command will be run with the code path as the current working directory.")
 	parser.add_argument('--executable', required=True, help=f"The executable to run, relative to the code directory.")
-	parser.add_argument('--model', required=True, help=f"The model(s) to use debugging the program. The following model names can be queried through the OpenAI API: {querier.OpenAIModelQuerier.supported_model_names()}")
+	cached_model_names = querier.OpenAIModelQuerier.supported_model_names(allow_network=False)
+	model_help = f"The following model names can be queried through the OpenAI API: {cached_model_names}" if cached_model_names else "The list of OpenAI models is fetched and cached the first time a model is resolved."
+	parser.add_argument('--model', nargs='+', required=True, help=f"The model(s) to use debugging the program. The first model drives the session and the second, if given, receives hedged requests. {model_help}")
 	parser.add_argument('--context_identifier', required=False, help=f"The stored context to resume from.")
 	parser.add_argument('--output_path', required=False, help=f"The path to store completed git repositories at.")
+	parser.add_argument('--requests_per_minute', type=int, required=False, help=f"The maximum number of model requests to issue per minute across all sessions.")
+	parser.add_argument('--tokens_per_minute', type=int, required=False, help=f"The maximum number of model tokens to consume per minute across all sessions.")
+	parser.add_argument('--max_concurrent_requests', type=int, default=8, help=f"The upper bound for the adaptive number of model requests in flight at once.")
+	parser.add_argument('--hedge_percentile', type=float, required=False, help=f"Send a hedged request when a turn takes longer than this percentile of recent latencies. The first response with tool calls wins.")
+	parser.add_argument('--tool_schema', choices=sorted(querier.TOOL_SCHEMAS), default=querier.DEFAULT_TOOL_SCHEMA, help=f"The variant of the tool schema to send to the model. Use prompt_report.py to compare their sizes.")
+	parser.add_argument('--batch_first_turns', choices=sorted(batch.BATCH_SUBMITTERS), required=False, help=f"With --code_directory_path, request the first model turn of every pending program in one batch before starting any sessions. 'local' sends the batch through the rate limiter; 'openai' uses the OpenAI batch endpoint.")
+	parser.add_argument('--context_retention_days', type=float, required=False, help=f"Delete stored contexts older than this many days before starting. By default, stored contexts are kept forever.")
+	parser.add_argument('--compress_artifacts', action='store_true', help=f"Store each conversation as compressed JSON Lines and pack its snapshot repository once the session ends. analyze_conversations.py reads both formats.")
+	parser.add_argument('--scratch_root', required=False, help=f"A directory, such as /dev/shm, in which to create session workspaces. Workspaces fall back to the default temporary directory when it is full.")
+	parser.add_argument('--scratch_size_limit', type=int, required=False, help=f"The maximum number of megabytes that workspaces may use under --scratch_root.")
+	parser.add_argument('--jobs', type=int, default=1, help=f"With --code_directory_path, the number of programs to debug at once, each in its own process. Each session's output goes to a log file instead of the terminal.")
+	parser.add_argument('--shard', required=False, help=f"With --code_directory_path, only debug the programs in shard i/N, for example 0/4. Programs are assigned to shards by a hash of their directory name.")
+	parser.add_argument('--work_queue', action='store_true', help=f"With --code_directory_path, coordinate with other workers using lease files under the output path, so that several processes or hosts sharing the output path can debug one suite together. Failed sessions are retried.")
+	parser.add_argument('--max_attempts', type=int, default=3, help=f"With --work_queue, the number of times a session is attempted before its program is marked as failed.")
+	parser.add_argument('--lease_duration', type=int, default=300, help=f"With --work_queue, the number of seconds a worker's lease on a program lasts without being renewed.")
+	parser.add_argument('--prebuild', action='store_true', help=f"With --code_directory_path, compile every pending program in parallel before debugging starts. Builds are cached by a hash of the sources and compile command, and programs that fail to compile are recorded in {prebuild.PREBUILD_MANIFEST_FILE_NAME} and skipped.")
+	parser.add_argument('--build_cache_days', type=float, required=False, help=f"Delete cached builds that haven't been used for this many days before starting. By default, cached builds are kept forever.")
+	parser.add_argument('--build_cache_size_limit', type=int, required=False, help=f"Delete the least recently used cached builds before starting until the build cache takes up at most this many megabytes.")
+	parser.add_argument('--build_jobs', type=int, required=False, help=f"With --prebuild, the number of programs to compile at once. Defaults to the number of CPUs.")
+	parser.add_argument('--triage', action='store_true', help=f"With --code_directory_path, run every pending program natively in parallel first and only debug the ones that crash. Implies --prebuild. Results are recorded in {triage.TRIAGE_MANIFEST_FILE_NAME}.")
+	parser.add_argument('--triage_timeout', type=float, default=10, help=f"With --triage, the number of seconds a program may run before it is considered hung. Hung programs are run again by --resume, so a longer timeout can decide them.")
+	parser.add_argument('--resume', action='store_true', help=f"With --code_directory_path, use the run manifest to skip programs that already finished with the same model and settings. Interrupted runs are started again, unless the process that started them is still running or is on another host.")
+	parser.add_argument('--retry_failed', action='store_true', help=f"Like --resume, but also run programs whose sessions failed with an error again.")
+	parser.add_argument('--only_status', nargs='+', required=False, help=f"With --code_directory_path, only run programs whose status in the run manifest is one of these, for example failed or running. Use 'pending' for programs that have no status yet.")
+	parser.add_argument('--status_interval', type=float, default=60, help=f"With --code_directory_path, the number of seconds between progress summaries. With --output_path, each summary is also written to {dashboard.STATUS_FILE_NAME} there.")
 	args = parser.parse_args()
 	
-	output_path = os.path.abspath(args.output_path)
+	rate_limiter.configure(args.requests_per_minute, args.tokens_per_minute, args.max_concurrent_requests)
+	scratch_size_limit = args.scratch_size_limit * 1024 * 1024 if args.scratch_size_limit is not None else None
+	workspace.configure_scratch_root(args.scratch_root, scratch_size_limit)
+	
+	max_checkpoint_age = args.context_retention_days * 24 * 60 * 60 if args.context_retention_days is not None else None
+	deleted_checkpoints, deleted_messages = file_utilities.collect_garbage_contexts(max_checkpoint_age)
+	if deleted_checkpoints or deleted_messages:
+		gprint(f"Deleted {deleted_checkpoints} stored contexts and {deleted_messages} unreferenced messages")
+	if args.build_cache_days is not None or args.build_cache_size_limit is not None:
+		max_build_age = args.build_cache_days * 24 * 60 * 60 if args.build_cache_days is not None else None
+		max_build_cache_size = args.build_cache_size_limit * 1024 * 1024 if args.build_cache_size_limit is not None else None
+		gprint(f"Deleted {prebuild.evict_builds(max_build_age, max_build_cache_size)} cached builds")
+	
+	output_path = os.path.abspath(args.output_path) if args.output_path else None
 	
 	if args.code_path:
-		debug_executable(args.code_path, args.compile_command, args.executable, args.model, args.context_identifier, output_path)
+		debug_executable(args.code_path, args.compile_command, args.executable, args.model, args.context_identifier, output_path, args.hedge_percentile, args.tool_schema, args.compress_artifacts)
 	elif args.code_directory_path:
 		code_directory_path = os.path.abspath(args.code_directory_path)
 		if not os.path.exists(code_directory_path):
 			print(f"The directory '{code_directory_path}' does not exist.")
 			return
 			
-		context_identifier = args.context_identifier
+		shard = None
+		if args.shard:
+			try:
+				shard = work_queue.parse_shard(args.shard)
+			except ValueError as e:
+				parser.error(str(e))
+		queue = None
+		if args.work_queue:
+			if not output_path:
+				parser.error("--work_queue requires --output_path to hold the leases.")
+			queue = work_queue.LeaseQueue(os.path.join(output_path, "queue"), args.lease_duration, args.max_attempts)
+		
+		# Runs are recorded under the settings that affect their outcome, so changing any of them starts a fresh set of runs.
+		store = session_store.shared_store()
+		run_model = args.model[0]
+		run_config = session_config(args.compile_command, args.executable, args.model, args.tool_schema, args.hedge_percentile)
+		run_config_hash = session_store.config_hash(run_config)
+		store.record_config(run_config_hash, run_config)
+		run_statuses = None
+		live_runs = {}
+		if args.resume or args.retry_failed or args.only_status:
+			run_statuses = store.run_statuses(run_model, run_config_hash)
+			live_runs = store.live_runs(run_model, run_config_hash)
+			gprint(f"Loaded {len(run_statuses)} runs from the manifest for configuration {run_config_hash}")
+		
+		pending_entries = []
 		# Iterate over the entries in the directory
 		for entry in os.listdir(code_directory_path):
+			if shard and not work_queue.in_shard(entry, *shard):
+				continue
 			# Construct the full path
 			full_path = os.path.join(code_directory_path, entry)
 			print(full_path)
@@ -79,11 +216,26 @@ def main():
 			if os.path.isdir(full_path):
 				print(full_path)
 				
+				run_status = run_statuses.get(entry, "pending") if run_statuses is not None else None
+				if args.only_status:
+					if run_status not in args.only_status:
+						continue
+				elif run_status in session_store.FINISHED_RUN_STATUSES or (run_status == "failed" and not args.retry_failed):
+					print(f"Skipping debugging for {entry} since its run status is {run_status}")
+					continue
+				if entry in live_runs:
+					# Only runs whose process is gone were interrupted; others are still being debugged elsewhere.
+					print(f"Skipping debugging for {entry} since process {live_runs[entry][1]} on {live_runs[entry][0]} is still running it")
+					continue
+				
 				this_output_path = None
 				if output_path:
 					this_output_path = os.path.join(output_path, entry)
 					
-					if os.path.exists(this_output_path) and os.path.isdir(this_output_path) and os.listdir(this_output_path):
+					if run_status in session_store.UNFINISHED_RUN_STATUSES and os.path.isdir(this_output_path):
+						# The manifest shows this run's output is from an attempt that didn't finish, so start over.
+						shutil.rmtree(this_output_path)
+					elif os.path.exists(this_output_path) and os.path.isdir(this_output_path) and os.listdir(this_output_path):
 						print(f"Skipping debugging for {entry} since its output directory already exists")
 						continue
 				
@@ -91,10 +243,90 @@ def main():
 						# Create the directory, including any intermediate directories
 						os.makedirs(this_output_path)
 				
-				gprint(f"Starting debugging process for {entry}…")
-				debug_executable(full_path, args.compile_command, args.executable, args.model, context_identifier, this_output_path)
-				# Assume that the context identifier is intended to be used only for the first program, since they aren't transferrable across programs being debugged.
-				context_identifier = None
+				pending_entries.append((entry, full_path, this_output_path))
+		
+		builds = None
+		# Triage runs the cached builds, so it always builds first.
+		if args.prebuild or args.triage:
+			builds = prebuild.prebuild_all({entry: full_path for entry, full_path, _ in pending_entries}, args.compile_command, output_path or os.getcwd(), args.build_jobs)
+			for entry, _, _ in pending_entries:
+				if entry not in builds:
+					store.finish_run(entry, run_model, run_config_hash, "compile_failed")
+			pending_entries = [pending_entry for pending_entry in pending_entries if pending_entry[0] in builds]
+		
+		if args.triage:
+			triage_results = triage.triage_all({entry: full_path for entry, full_path, _ in pending_entries}, args.compile_command, args.executable, output_path or os.getcwd(), args.triage_timeout, args.build_jobs, builds)
+			crashed = set()
+			for entry, _, _ in pending_entries:
+				status = triage.run_status(triage_results[entry])
+				if status is None:
+					crashed.add(entry)
+				else:
+					store.finish_run(entry, run_model, run_config_hash, status, error=triage_results[entry].get("error"))
+			pending_entries = [pending_entry for pending_entry in pending_entries if pending_entry[0] in crashed]
+		
+		first_turn_contexts, first_turn_usage = {}, {}
+		if args.batch_first_turns:
+			if not output_path:
+				parser.error("--batch_first_turns requires --output_path to keep track of submitted batches.")
+			first_turn_contexts, first_turn_usage = batch.prefetch_first_turns({entry: full_path for entry, full_path, _ in pending_entries}, args.compile_command, args.executable, args.model[0], output_path, args.batch_first_turns, args.tool_schema, builds)
+		
+		context_identifier = args.context_identifier
+		sessions = {}
+		for entry, full_path, this_output_path in pending_entries:
+			sessions[entry] = (full_path, args.compile_command, args.executable, args.model, first_turn_contexts.get(entry, context_identifier), this_output_path, args.hedge_percentile, args.tool_schema, args.compress_artifacts, builds.get(entry) if builds else None, None, None, first_turn_usage.get(entry))
+			# Assume that the context identifier is intended to be used only for the first program, since they aren't transferrable across programs being debugged.
+			context_identifier = None
+		
+		if queue:
+			session_source = (None if entry is None else (entry, sessions[entry]) for entry in queue.claim(list(sessions)))
+		else:
+			session_source = sessions.items()
+		
+		progress = dashboard.Dashboard(store, run_model, run_config_hash, len(sessions), os.path.join(output_path, dashboard.STATUS_FILE_NAME) if output_path else None, args.status_interval)
+		progress.start()
+		
+		def on_started(entry):
+			store.start_run(entry, run_model, run_config_hash, sessions[entry][5])
+			progress.session_started(entry)
+		
+		def on_finished(entry, status, duration, error):
+			metrics = file_utilities.retrieve_json_metrics(sessions[entry][5]) if sessions[entry][5] else None
+			store.finish_run(entry, run_model, run_config_hash, status, duration, error, metrics["turns"] if metrics else None, metrics["total_tokens"] if metrics else None)
+			progress.session_finished(entry)
+			if queue and status != "failed":
+				queue.complete(entry)
+			elif queue:
+				queue.fail(entry, error)
+		
+		if args.jobs > 1:
+			log_directory = os.path.join(output_path, "logs") if output_path else tempfile.mkdtemp(prefix="generative-debugging-logs-")
+			failures = runner.run_sessions(session_source, args.jobs, log_directory, args.requests_per_minute, args.tokens_per_minute, args.max_concurrent_requests, args.scratch_root, scratch_size_limit, on_started, on_finished, queue.poll_interval if queue else 30)
+			progress.stop()
+			for entry, error in failures.items():
+				print(f"{entry}: {error} (see {os.path.join(log_directory, entry + '.log')})")
+			return
+		
+		for session in session_source:
+			if session is None:
+				gprint(f"Waiting for programs leased by other workers…")
+				time.sleep(queue.poll_interval)
+				continue
+			entry, arguments = session
+			gprint(f"Starting debugging process for {entry}…")
+			on_started(entry)
+			start_time = time.time()
+			try:
+				status = debug_executable(*arguments)
+			except Exception as e:
+				on_finished(entry, "failed", time.time() - start_time, f"{type(e).__name__}: {e}")
+				if not queue:
+					raise
+				# With a queue, a failed session is recorded and retried rather than ending the run.
+				print(f"Debugging {entry} failed: {e}")
+			else:
+				on_finished(entry, status, time.time() - start_time, None)
+		progress.stop()
 
 if __name__ == "__main__":
 	main()
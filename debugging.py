@@ -1,4 +1,5 @@
 import lldb
+import tracing
 
 class DebuggingSession:
 	def __init__(self, executable_path, args=[]):
@@ -11,6 +12,7 @@ class DebuggingSession:
 		if not self.target:
 			raise Exception(f"Failed to create target for executable {executable_path}")
 
+	@tracing.traced("launch")
 	def start(self, pause_at_start=False, entry_function_name="main", working_directory=None, use_libgmalloc=True):
 		if pause_at_start:
 			self.target.BreakpointCreateByName(entry_function_name)
@@ -32,6 +34,7 @@ class DebuggingSession:
 	def process(self):
 		return self.__process
 
+	@tracing.traced("command")
 	def execute_command(self, command_str):
 		command_interpreter = self.debugger.GetCommandInterpreter()
 		command_interpreter.HandleCommand('settings set auto-confirm 1', lldb.SBCommandReturnObject())
@@ -43,6 +46,27 @@ class DebuggingSession:
 		else:
 			return False, result.GetError()
 
+	@tracing.traced("command")
+	def execute_commands(self, commands, stop_on_error=False):
+		"""
+		Execute several commands in order through one command interpreter.
+
+		:return: A list of (command, success, output) tuples for the commands that were run.
+		"""
+		command_interpreter = self.debugger.GetCommandInterpreter()
+		command_interpreter.HandleCommand('settings set auto-confirm 1', lldb.SBCommandReturnObject())
+		results = []
+		for command_str in commands:
+			result = lldb.SBCommandReturnObject()
+			command_interpreter.HandleCommand(command_str, result)
+			if result.Succeeded():
+				results.append((command_str, True, result.GetOutput()))
+			else:
+				results.append((command_str, False, result.GetError()))
+				if stop_on_error:
+					break
+		return results
+
 	def restart(self, pause_at_start=False, entry_function_name="main", working_directory=None):
 		if self.process.IsValid() and self.process.GetState() != lldb.eStateExited:
 			self.process.Kill()
@@ -6,34 +6,30 @@ def git_diff_initial_final(repo_path, file_extensions):
 	"""
 	Get the diffs including the complete file for any file that was changed and the annotated diff showing changes.
 	"""
-	original_dir = os.getcwd()  # Save the original working directory
 	output = ''
 	try:
-		os.chdir(repo_path)
-	
 		# Get the hash of the initial commit
-		initial_commit = subprocess.check_output(["git", "rev-list", "--max-parents=0", "HEAD"], text=True).strip()
+		initial_commit = subprocess.check_output(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=repo_path, text=True).strip()
 	
 		# Get the hash of the final commit
-		final_commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+		final_commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_path, text=True).strip()
 	
 		# Get the list of changed files between the initial and final commit
 		changed_files = subprocess.check_output(
 			["git", "diff", "--name-only", initial_commit, final_commit] + [f'*.{ext}' for ext in file_extensions],
+			cwd=repo_path,
 			text=True
 		).splitlines()
 	
 		# Show the complete file and then the diff for each changed file
 		for file in changed_files:
-			file_contents = subprocess.check_output(["git", "show", f"{final_commit}:{file}"], text=True)
-			file_diff = subprocess.check_output(["git", "diff", initial_commit, final_commit, file], text=True)
+			file_contents = subprocess.check_output(["git", "show", f"{final_commit}:{file}"], cwd=repo_path, text=True)
+			file_diff = subprocess.check_output(["git", "diff", initial_commit, final_commit, file], cwd=repo_path, text=True)
 			output += f"--- {file} (Full File) ---\n{file_contents}\n"
 			output += f"--- {file} (Diff) ---\n{file_diff}\n"
 	
 	except subprocess.CalledProcessError as e:
 		output = f"Error processing repository at {repo_path}: {e}"
-	finally:
-		os.chdir(original_dir)  # Change back to the original directory
 	
 	return output
 
@@ -64,7 +60,8 @@ def process_repositories(base_directory, file_extensions):
 	
 	for directory in os.listdir(base_directory):
 		repo_path = os.path.join(base_directory, directory)
-		if os.path.isdir(repo_path) and '.git' in os.listdir(repo_path) and 'succeeded.txt' in os.listdir(repo_path):
+		# Snapshot repositories packed by --compress_artifacts are read by git just like loose ones.
+		if os.path.isdir(repo_path) and {'.git', 'succeeded.txt'} <= set(os.listdir(repo_path)):
 			print(f"Processing repository: {directory}")
 			diff_output = git_diff_initial_final(repo_path, file_extensions)
 			if diff_output:
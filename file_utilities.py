@@ -1,26 +1,13 @@
-import shutil
-import tempfile
 import os
 import subprocess
 import pickle
 import json
-
-def copy_dir(source_dir, dest_dir):
-	# Copy the entire content of the source directory to the destination directory
-	for item in os.listdir(source_dir):
-		s = os.path.join(source_dir, item)
-		d = os.path.join(dest_dir, item)
-		if os.path.isdir(s):
-			shutil.copytree(s, d)
-		else:
-			shutil.copy2(s, d)
-
-def copy_to_temp(source_dir):
-	# Create a temporary directory
-	temp_dir = tempfile.mkdtemp()
-	copy_dir(source_dir, temp_dir)
-			
-	return temp_dir
+import time
+import threading
+import workspace
+import snapshot_store
+import session_store
+import tracing
 
 def store_success_sentinel(working_directory):
 	sentinel_path = os.path.join(working_directory, "succeeded.txt")
@@ -47,13 +34,20 @@ def execute_command(directory_path, command, *args):
 	
 	return result.returncode, result.stdout, result.stderr
 	
+@tracing.traced("git")
 def reset_to_last_commit(working_directory):
-	os.chdir(working_directory)
-	subprocess.run(['git', 'reset', '--hard', 'HEAD'])
-	
+	snapshot_store.repository_for(working_directory).reset()
+
 
+@tracing.traced("patch")
 def apply_patch_from_string(working_directory, patch_string):
 	try:
+		# Files in a workspace may share their inode with the original program, so give every
+		# file the patch touches a private copy in case patch rewrites it in place.
+		for line in patch_string.splitlines():
+			if line.startswith('+++ '):
+				workspace.materialize(os.path.join(working_directory, line[4:].split('\t')[0].strip()))
+
 		# Dry run to check if the patch can be applied
 		dry_run_process = subprocess.Popen(['patch', '-s', '-p0', '--dry-run', '--batch'], cwd=working_directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 		dry_run_stdout, dry_run_stderr = dry_run_process.communicate(input=patch_string.encode())
@@ -91,43 +85,112 @@ def get_source_code(working_directory, file_path):
 		print(e)
 		return None
 		
-# Define the base directory in the macOS cache location
-BASE_DIR = os.path.join(os.path.expanduser('~'), 'Library', 'Caches', 'com.yourcompany.yourappname')
-		
+# Contexts are stored in the session store. Older versions wrote one pickle per context to this
+# directory in the macOS cache location, and those can still be read.
+LEGACY_BASE_DIR = os.path.join(os.path.expanduser('~'), 'Library', 'Caches', 'com.yourcompany.yourappname')
 
 def get_file_path(context_id):
-	"""Return the file path associated with the given context_id."""
-	return os.path.join(BASE_DIR, f"{context_id}.pkl")
-
-def store_context(context, context_id):
-	"""Store the context to a file associated with the given context_id."""
-	if not os.path.exists(BASE_DIR):
-		os.makedirs(BASE_DIR)
-	with open(get_file_path(context_id), 'wb') as f:
-		pickle.dump(context, f)
+	"""Return the legacy pickle path associated with the given context_id."""
+	return os.path.join(LEGACY_BASE_DIR, f"{context_id}.pkl")
+
+def write_atomically(path, data):
+	# Include the thread so that concurrent sessions in one process never share a temporary file.
+	temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+	with open(temp_path, 'wb') as f:
+		f.write(data)
+	os.replace(temp_path, path)
+
+def update_json_manifest(path, entries):
+	"""
+	Merge entries into the JSON manifest at the given path, keeping the entries of earlier runs that
+	aren't replaced, and return the merged manifest.
+	"""
+	try:
+		with open(path, 'r') as f:
+			manifest = json.load(f)
+	except (OSError, ValueError):
+		manifest = {}
+	manifest.update(entries)
+	write_atomically(path, json.dumps(manifest, indent=2, sort_keys=True).encode())
+	return manifest
+
+@tracing.traced("serialization")
+def store_context(context, context_id, session_id=None):
+	"""Store the context under the given context_id, optionally recording the session it belongs to."""
+	session_store.shared_store().store_checkpoint(str(context_id), context, None if session_id is None else str(session_id))
 		
+@tracing.traced("serialization")
 def store_json_context(directory_path, context):
 	with open(os.path.join(directory_path, 'conversation.json'), 'w') as f:
 		f.write(json.dumps(context, indent=2))
 
+@tracing.traced("serialization")
+def store_json_metrics(directory_path, turn_metrics):
+	"""Store per-turn token usage and latency next to conversation.json."""
+	totals = {key: sum(turn[key] for turn in turn_metrics) for key in ["prompt_tokens", "completion_tokens", "total_tokens", "latency"]}
+	totals["turns"] = len(turn_metrics)
+	with open(os.path.join(directory_path, 'metrics.json'), 'w') as f:
+		f.write(json.dumps({"turns": turn_metrics, "totals": totals}, indent=2))
+
+def retrieve_json_metrics(directory_path):
+	"""Return the totals from the metrics.json file in a directory, or None if there isn't one."""
+	try:
+		with open(os.path.join(directory_path, 'metrics.json'), 'r') as f:
+			return json.load(f)["totals"]
+	except (OSError, ValueError, KeyError):
+		return None
+
 def retrieve_context(context_id):
 	"""Retrieve the context associated with the given context_id."""
+	context = session_store.shared_store().retrieve_checkpoint(str(context_id))
+	if context is not None:
+		return context
+
+	# Contexts saved before the session store was introduced are stored as a single pickle.
 	with open(get_file_path(context_id), 'rb') as f:
 		return pickle.load(f)
+
+def collect_garbage_contexts(max_checkpoint_age=None):
+	"""
+	Delete stored messages that are no longer referenced by any checkpoint.
+
+	:param max_checkpoint_age: If set, checkpoints older than this many seconds are deleted first.
+	:return: A tuple containing the number of checkpoints and messages deleted.
+	"""
+	return session_store.shared_store().collect_garbage(max_checkpoint_age)
+
+MODEL_CACHE_PATH = os.path.join(session_store.CACHE_DIR, 'models.json')
+
+def store_model_names(model_names):
+	"""Cache the list of available model names along with the time it was fetched."""
+	os.makedirs(session_store.CACHE_DIR, exist_ok=True)
+	write_atomically(MODEL_CACHE_PATH, json.dumps({"fetched_at": time.time(), "models": model_names}).encode())
+
+def retrieve_model_names(max_age=None):
+	"""
+	Return the cached list of model names, or None if there is no usable cache.
+
+	:param max_age: The maximum age of the cache in seconds. If None, a cache of any age is returned.
+	"""
+	try:
+		with open(MODEL_CACHE_PATH, 'r') as f:
+			cache = json.load(f)
+	except (OSError, ValueError):
+		return None
+	if max_age is not None and time.time() - cache.get("fetched_at", 0) > max_age:
+		return None
+	return cache.get("models")
 		
+@tracing.traced("git")
 def initialize_git_repository(directory_path):
-	os.chdir(directory_path)
-	
-	# Initialize the Git repository
-	subprocess.run(['git', 'init'])
-	
-	# Add all files to staging
-	subprocess.run(['git', 'add', '.'])
-	
-	# Make the initial commit
-	subprocess.run(['git', 'commit', '-m', 'Initial commit'])
+	# Snapshots are written as git objects in-process, which is much faster than running git for every step.
+	repository = snapshot_store.repository_for(directory_path)
+	repository.initialize()
+	repository.commit('Initial commit')
 	
+@tracing.traced("git")
 def add_commit(directory_path, commit_message):
-	os.chdir(directory_path)
-	subprocess.run(['git', 'add', '.'])
-	subprocess.run(['git', 'commit', '-m', commit_message])
+	snapshot_store.repository_for(directory_path).commit(commit_message)
+
+def release_git_repository(directory_path):
+	snapshot_store.release_repository(directory_path)
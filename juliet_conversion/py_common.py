@@ -382,10 +382,11 @@ def print_with_timestamp(contents):
 	"""
 	print("[" + time.ctime(None) + "] " + contents)
 	
-def run_commands(commands, use_shell=False):
+def run_commands(commands, use_shell=False, cwd=None):
 	"""
 	Runs a command as if it were run in the command prompt.  If you need to use commands such as
-	"cd, dir, etc", set use_shell to True.
+	"cd, dir, etc", set use_shell to True.  Pass cwd to run the command in a different directory
+	without changing the working directory of this process.
 	"""
 	command = " && ".join(commands)
 	
@@ -394,7 +395,7 @@ def run_commands(commands, use_shell=False):
 	print("[" + time.ctime(time_started) + "] Started command: \"" + command + "\"")
 	sys.stdout.flush()
 	
-	subprocess.check_call(command, shell=use_shell, stderr=sys.stderr, stdout=sys.stdout)
+	subprocess.check_call(command, shell=use_shell, stderr=sys.stderr, stdout=sys.stdout, cwd=cwd)
 	
 	# Not using print_with_timestamp() here since we want to capture the time for the time diff
 	time_ended = time.time()
@@ -407,6 +408,8 @@ def run_analysis(test_case_path, build_file_regex, run_analysis_fx):
 	"""
 	Helper method to run an analysis using a tool.  
 	Takes a test case path, build file regex and a function pointer.
+	The function is called with the absolute path of each build file and should
+	run any commands in that file's directory (for example, with run_commands' cwd).
 	"""
 
 	time_started = time.time()
@@ -417,16 +420,8 @@ def run_analysis(test_case_path, build_file_regex, run_analysis_fx):
 	# run all the files using the function pointer
 	for file in files:
 
-		# change into directory with the file
-		dir = os.path.dirname(file)
-		os.chdir(dir)
-
 		# run the the file
-		file = os.path.basename(file)
 		run_analysis_fx(file)
-
-		# return to original working directory
-		os.chdir(sys.path[0])
 	
 	time_ended = time.time()
 
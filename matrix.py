@@ -0,0 +1,226 @@
+import argparse
+import os
+import re
+import json
+import shutil
+import fnmatch
+import itertools
+import querier
+import session_store
+import workspace
+import prebuild
+import triage
+import runner
+import file_utilities
+import debug_program
+from termcolor import colored
+
+MATRIX_SUMMARY_FILE_NAME = "matrix.json"
+
+def gprint(input_str):
+	print(colored(input_str, 'light_grey'))
+
+def load_matrix(path):
+	"""
+	Load an experiment matrix from a JSON file like this one:
+
+	{
+		"code_directory_path": "juliet",
+		"compile_command": ["make"],
+		"executable": "main",
+		"models": ["gpt-4-1106-preview", "gpt-3.5-turbo-1106"],
+		"prompts": {"default": {}, "terse": {"transient_prompt": "Decide what to do next."}},
+		"tool_schemas": ["full"],
+		"case_filters": {"all": ["*"], "null_pointers": ["CWE476_*", "!*_18"]}
+	}
+
+	A model may be a list of names, in which case the second receives hedged requests. A prompt variant
+	may set initial_prompt, transient_prompt or neither; unset prompts keep their defaults. A case filter
+	is a list of glob patterns matched against the program directory names, where patterns starting with
+	'!' exclude programs.
+	"""
+	with open(path, 'r') as f:
+		matrix = json.load(f)
+	for key in ["code_directory_path", "compile_command", "executable", "models"]:
+		if key not in matrix:
+			raise ValueError(f"The matrix is missing '{key}'")
+	matrix.setdefault("prompts", {"default": {}})
+	matrix.setdefault("tool_schemas", [querier.DEFAULT_TOOL_SCHEMA])
+	matrix.setdefault("case_filters", {"all": ["*"]})
+	matrix.setdefault("hedge_percentile", None)
+	matrix["models"] = [model if isinstance(model, list) else [model] for model in matrix["models"]]
+	for tool_schema in matrix["tool_schemas"]:
+		if tool_schema not in querier.TOOL_SCHEMAS:
+			raise ValueError(f"Unknown tool schema '{tool_schema}'; expected one of {sorted(querier.TOOL_SCHEMAS)}")
+	for prompt_name, prompts in matrix["prompts"].items():
+		unknown = set(prompts) - {"initial_prompt", "transient_prompt"}
+		if unknown:
+			raise ValueError(f"Prompt variant '{prompt_name}' has unknown keys {sorted(unknown)}")
+	return matrix
+
+def match_cases(entries, patterns):
+	"""Return the entries matched by at least one pattern and excluded by none of the '!' patterns."""
+	included = [pattern for pattern in patterns if not pattern.startswith('!')]
+	excluded = [pattern[1:] for pattern in patterns if pattern.startswith('!')]
+	return [entry for entry in entries
+		if any(fnmatch.fnmatchcase(entry, pattern) for pattern in included)
+		and not any(fnmatch.fnmatchcase(entry, pattern) for pattern in excluded)]
+
+def matrix_cells(matrix, entries):
+	"""
+	Return one cell for every combination of model, prompt variant, tool schema and case filter. Cells
+	that differ only in their case filter share a configuration, so a program they both select runs once.
+	"""
+	cells = []
+	for models, (prompt_name, prompts), tool_schema, (filter_name, patterns) in itertools.product(
+			matrix["models"], matrix["prompts"].items(), matrix["tool_schemas"], matrix["case_filters"].items()):
+		config = debug_program.session_config(matrix["compile_command"], matrix["executable"], models, tool_schema, matrix["hedge_percentile"], prompts)
+		cells.append({
+			"name": re.sub(r'[^\w.+-]+', '_', f"{'+'.join(models)}.{prompt_name}.{tool_schema}"),
+			"models": models,
+			"prompt": prompt_name,
+			"prompts": prompts,
+			"tool_schema": tool_schema,
+			"case_filter": filter_name,
+			"cases": match_cases(entries, patterns),
+			"config": config,
+			"config_hash": session_store.config_hash(config),
+		})
+	return cells
+
+def summarize_cell(store, cell):
+	cases = set(cell["cases"])
+	runs = [run for run in store.runs_finished_since(cell["models"][0], cell["config_hash"], 0) if run["test_case"] in cases]
+	statuses = {}
+	for run in runs:
+		statuses[run["status"]] = statuses.get(run["status"], 0) + 1
+	debugged = [run for run in runs if run["status"] in ["exited", "gave_up", "failed"]]
+	turns = [run["turns"] for run in runs if run["turns"] is not None]
+	return {
+		"cases": len(cell["cases"]),
+		"finished": len(runs),
+		"statuses": statuses,
+		"success_rate": statuses.get("exited", 0) / len(debugged) if debugged else None,
+		"turns_per_case": sum(turns) / len(turns) if turns else None,
+		"total_tokens": sum(run["total_tokens"] or 0 for run in runs),
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description="Debug programs with every combination of the models, prompt variants, tool schemas and case filters in an experiment matrix. Programs are built and triaged once for all combinations, and every run is recorded in the session store under its configuration.")
+	parser.add_argument('matrix', help=f"The JSON file describing the matrix. See load_matrix in matrix.py for its format.")
+	parser.add_argument('--output_path', required=True, help=f"The path to store results at, in one directory per combination of model, prompt variant and tool schema. A summary is written to {MATRIX_SUMMARY_FILE_NAME} there.")
+	parser.add_argument('--jobs', type=int, default=1, help=f"The number of sessions to run at once, each in its own process. Each session's output goes to a log file.")
+	parser.add_argument('--build_cache_days', type=float, required=False, help=f"Delete cached builds that haven't been used for this many days before starting.")
+	parser.add_argument('--build_cache_size_limit', type=int, required=False, help=f"Delete the least recently used cached builds before starting until the build cache takes up at most this many megabytes.")
+	parser.add_argument('--build_jobs', type=int, required=False, help=f"The number of programs to compile or triage at once. Defaults to the number of CPUs.")
+	parser.add_argument('--triage', action='store_true', help=f"Run every program natively first and only debug the ones that crash.")
+	parser.add_argument('--triage_timeout', type=float, default=10, help=f"With --triage, the number of seconds a program may run before it is considered hung.")
+	parser.add_argument('--retry_failed', action='store_true', help=f"Run sessions whose earlier attempts failed with an error again. Finished runs are always skipped.")
+	parser.add_argument('--dry_run', action='store_true', help=f"Print the cells of the matrix and how many sessions each would run, without running any.")
+	parser.add_argument('--requests_per_minute', type=int, required=False, help=f"The maximum number of model requests to issue per minute across all sessions.")
+	parser.add_argument('--tokens_per_minute', type=int, required=False, help=f"The maximum number of model tokens to consume per minute across all sessions.")
+	parser.add_argument('--max_concurrent_requests', type=int, default=8, help=f"The upper bound for the adaptive number of model requests in flight at once.")
+	parser.add_argument('--compress_artifacts', action='store_true', help=f"Store each conversation as compressed JSON Lines and pack its snapshot repository once the session ends.")
+	parser.add_argument('--scratch_root', required=False, help=f"A directory, such as /dev/shm, in which to create session workspaces.")
+	parser.add_argument('--scratch_size_limit', type=int, required=False, help=f"The maximum number of megabytes that workspaces may use under --scratch_root.")
+	args = parser.parse_args()
+
+	try:
+		matrix = load_matrix(args.matrix)
+	except (OSError, ValueError) as e:
+		parser.error(str(e))
+	scratch_size_limit = args.scratch_size_limit * 1024 * 1024 if args.scratch_size_limit is not None else None
+	workspace.configure_scratch_root(args.scratch_root, scratch_size_limit)
+	if args.build_cache_days is not None or args.build_cache_size_limit is not None:
+		max_build_age = args.build_cache_days * 24 * 60 * 60 if args.build_cache_days is not None else None
+		max_build_cache_size = args.build_cache_size_limit * 1024 * 1024 if args.build_cache_size_limit is not None else None
+		gprint(f"Deleted {prebuild.evict_builds(max_build_age, max_build_cache_size)} cached builds")
+	output_path = os.path.abspath(args.output_path)
+	os.makedirs(output_path, exist_ok=True)
+
+	code_directory_path = os.path.abspath(matrix["code_directory_path"])
+	entries = sorted(entry for entry in os.listdir(code_directory_path) if os.path.isdir(os.path.join(code_directory_path, entry)))
+	cells = matrix_cells(matrix, entries)
+
+	# A run is identified by its program, model and configuration, so cells that select the same program with the same configuration share it.
+	store = session_store.shared_store()
+	runs = {}
+	previous_statuses = {}
+	for cell in cells:
+		store.record_config(cell["config_hash"], cell["config"])
+		run_statuses = store.run_statuses(cell["models"][0], cell["config_hash"])
+		live_runs = store.live_runs(cell["models"][0], cell["config_hash"])
+		for entry in cell["cases"]:
+			run_status = run_statuses.get(entry)
+			if run_status in session_store.FINISHED_RUN_STATUSES or (run_status == "failed" and not args.retry_failed):
+				continue
+			if entry in live_runs:
+				print(f"Skipping {cell['name']} for {entry} since process {live_runs[entry][1]} on {live_runs[entry][0]} is still running it")
+				continue
+			runs.setdefault((entry, cell["models"][0], cell["config_hash"]), cell)
+			previous_statuses[(entry, cell["models"][0], cell["config_hash"])] = run_status
+
+	for cell in cells:
+		pending = sum(1 for (_, model, config_hash), run_cell in runs.items() if run_cell is cell)
+		gprint(f"{cell['name']} [{cell['case_filter']}] {cell['config_hash']}: {len(cell['cases'])} programs, {pending} to run")
+	if args.dry_run:
+		return
+
+	# Builds and triage results depend only on the programs, so they're shared by every cell.
+	pending_entries = sorted({entry for entry, _, _ in runs})
+	builds = prebuild.prebuild_all({entry: os.path.join(code_directory_path, entry) for entry in pending_entries}, matrix["compile_command"], output_path, args.build_jobs)
+	triage_results = {}
+	if args.triage:
+		triage_results = triage.triage_all({entry: os.path.join(code_directory_path, entry) for entry in builds}, matrix["compile_command"], matrix["executable"], output_path, args.triage_timeout, args.build_jobs, builds)
+	for entry, model, config_hash in list(runs):
+		if entry not in builds:
+			status = "compile_failed"
+		elif entry in triage_results:
+			status = triage.run_status(triage_results[entry])
+		else:
+			status = None
+		if status is not None:
+			store.finish_run(entry, model, config_hash, status, error=triage_results.get(entry, {}).get("error"))
+			del runs[(entry, model, config_hash)]
+
+	# Sessions are ordered by program so that every cell progresses at the same rate and partial results can be compared.
+	sessions = {}
+	run_keys = {}
+	for (entry, model, config_hash), cell in sorted(runs.items(), key=lambda item: (item[0][0], cells.index(item[1]))):
+		this_output_path = os.path.join(output_path, cell["name"], entry)
+		if previous_statuses[(entry, model, config_hash)] in session_store.UNFINISHED_RUN_STATUSES and os.path.isdir(this_output_path):
+			# The manifest shows this output is from an attempt that didn't finish, so start over.
+			shutil.rmtree(this_output_path)
+		elif os.path.isdir(this_output_path) and os.listdir(this_output_path):
+			print(f"Skipping {cell['name']} for {entry} since its output directory already exists")
+			continue
+		os.makedirs(this_output_path, exist_ok=True)
+		session_name = f"{cell['name']}.{entry}"
+		sessions[session_name] = (os.path.join(code_directory_path, entry), matrix["compile_command"], matrix["executable"], cell["models"], None, this_output_path, matrix["hedge_percentile"], cell["tool_schema"], args.compress_artifacts, builds[entry], None, cell["prompts"])
+		run_keys[session_name] = (entry, model, config_hash)
+
+	def on_started(session_name):
+		store.start_run(*run_keys[session_name], sessions[session_name][5])
+
+	def on_finished(session_name, status, duration, error):
+		metrics = file_utilities.retrieve_json_metrics(sessions[session_name][5])
+		store.finish_run(*run_keys[session_name], status, duration, error, metrics["turns"] if metrics else None, metrics["total_tokens"] if metrics else None)
+
+	if sessions:
+		log_directory = os.path.join(output_path, "logs")
+		failures = runner.run_sessions(sessions.items(), args.jobs, log_directory, args.requests_per_minute, args.tokens_per_minute, args.max_concurrent_requests, args.scratch_root, scratch_size_limit, on_started, on_finished)
+		for session_name, error in failures.items():
+			print(f"{session_name}: {error} (see {os.path.join(log_directory, session_name + '.log')})")
+
+	summary = []
+	for cell in cells:
+		cell_summary = summarize_cell(store, cell)
+		summary.append({key: cell[key] for key in ["name", "models", "prompt", "tool_schema", "case_filter", "config_hash"]} | cell_summary)
+		success_rate = f"{cell_summary['success_rate'] * 100:.0f}%" if cell_summary['success_rate'] is not None else "-"
+		turns_per_case = f"{cell_summary['turns_per_case']:.1f}" if cell_summary['turns_per_case'] is not None else "-"
+		print(f"{cell['name']} [{cell['case_filter']}]: {cell_summary['finished']}/{cell_summary['cases']} finished, success {success_rate}, {turns_per_case} turns/case, {cell_summary['total_tokens']} tokens, {cell_summary['statuses']}")
+	with open(os.path.join(output_path, MATRIX_SUMMARY_FILE_NAME), 'w') as f:
+		f.write(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import concurrent.futures
+import file_utilities
+import session_store
+import workspace
+import tracing
+from termcolor import colored
+
+BUILD_CACHE_DIR = os.path.join(session_store.CACHE_DIR, 'builds')
+PREBUILD_MANIFEST_FILE_NAME = "prebuild.json"
+
+def gprint(input_str):
+	print(colored(input_str, 'light_grey'))
+
+def source_hash(code_path, compile_command):
+	"""Hash the compile command and the path, mode and contents of every file in a program's directory."""
+	digest = hashlib.sha256(json.dumps(compile_command).encode())
+	for root, dirs, files in os.walk(code_path):
+		dirs.sort()
+		if '.git' in dirs:
+			dirs.remove('.git')
+		for file in sorted(files):
+			full_path = os.path.join(root, file)
+			digest.update(os.path.relpath(full_path, code_path).encode() + b'\0')
+			digest.update(oct(os.lstat(full_path).st_mode).encode() + b'\0')
+			with open(full_path, 'rb') as f:
+				digest.update(hashlib.sha256(f.read()).digest())
+	return digest.hexdigest()
+
+def file_signatures(directory):
+	signatures = {}
+	for root, dirs, files in os.walk(directory):
+		for file in files:
+			full_path = os.path.join(root, file)
+			file_stat = os.lstat(full_path)
+			signatures[os.path.relpath(full_path, directory)] = (file_stat.st_size, file_stat.st_mtime_ns)
+	return signatures
+
+def build_directory(build_hash):
+	return os.path.join(BUILD_CACHE_DIR, build_hash[:2], build_hash)
+
+def build(code_path, compile_command):
+	"""
+	Compile a program in a scratch workspace unless a build of the same sources is cached, and cache the
+	files that the compile command created or changed.
+
+	:return: The build's cache directory and its record, which holds the return code and output of the compiler.
+	"""
+	build_hash = source_hash(code_path, compile_command)
+	directory = build_directory(build_hash)
+	record_path = os.path.join(directory, 'build.json')
+	if os.path.exists(record_path):
+		with open(record_path, 'r') as f:
+			return directory, json.load(f)
+
+	build_workspace = workspace.create(code_path)
+	try:
+		before = file_signatures(build_workspace.path)
+		returncode, stdout, stderr = file_utilities.execute_command(build_workspace.path, *compile_command)
+		outputs = [path for path, signature in file_signatures(build_workspace.path).items() if before.get(path) != signature]
+
+		# Assemble the entry next to its final location and rename it into place, so concurrent builds never see a partial entry.
+		temp_directory = f"{directory}.{os.getpid()}.{threading.get_ident()}.tmp"
+		os.makedirs(os.path.join(temp_directory, 'outputs'))
+		for path in outputs:
+			destination = os.path.join(temp_directory, 'outputs', path)
+			os.makedirs(os.path.dirname(destination), exist_ok=True)
+			workspace.clone_or_copy(os.path.join(build_workspace.path, path), destination)
+		# Debug information refers to sources by the directory they were compiled in, which sessions map to their own workspace.
+		record = {"returncode": returncode, "stdout": stdout, "stderr": stderr, "outputs": outputs, "build_path": os.path.realpath(build_workspace.path)}
+		with open(os.path.join(temp_directory, 'build.json'), 'w') as f:
+			json.dump(record, f)
+		try:
+			os.rename(temp_directory, directory)
+		except OSError:
+			# Another process cached the same build first.
+			shutil.rmtree(temp_directory, ignore_errors=True)
+	finally:
+		build_workspace.cleanup()
+	return directory, record
+
+@tracing.traced("compile")
+def restore(directory, working_directory):
+	"""
+	Copy the outputs of a cached build into a workspace, keeping their timestamps so make sees them as up to date.
+
+	:return: The build's record. Its build_path is the directory the build ran in, which the debugger's source
+	map should point at the workspace.
+	"""
+	record_path = os.path.join(directory, 'build.json')
+	with open(record_path, 'r') as f:
+		record = json.load(f)
+	# The record's modification time marks when the build was last used, for evict_builds.
+	os.utime(record_path)
+	for path in record["outputs"]:
+		destination = os.path.join(working_directory, path)
+		os.makedirs(os.path.dirname(destination), exist_ok=True)
+		if os.path.lexists(destination):
+			os.remove(destination)
+		workspace.clone_or_copy(os.path.join(directory, 'outputs', path), destination)
+	return record
+
+def prebuild_all(cases, compile_command, manifest_directory, jobs=None):
+	"""
+	Build every case in parallel and record the results in a manifest, merged with those of earlier runs.
+
+	:param cases: A dictionary mapping case names to the directories containing their code.
+	:return: A dictionary mapping the cases that compiled to their build directories.
+	"""
+	jobs = jobs or os.cpu_count()
+	gprint(f"Building {len(cases)} programs with {jobs} jobs…")
+	manifest = {}
+	builds = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		futures = {executor.submit(build, code_path, compile_command): case_name for case_name, code_path in cases.items()}
+		for future in concurrent.futures.as_completed(futures):
+			case_name = futures[future]
+			try:
+				directory, record = future.result()
+			except OSError as e:
+				manifest[case_name] = {"status": "error", "error": str(e)}
+				continue
+			if record["returncode"] == 0:
+				builds[case_name] = directory
+				manifest[case_name] = {"status": "built", "build": directory}
+			else:
+				manifest[case_name] = {"status": "failed", "build": directory, "returncode": record["returncode"], "stderr": record["stderr"][-2000:]}
+
+	failures = [case_name for case_name, entry in manifest.items() if entry["status"] != "built"]
+	gprint(f"Built {len(builds)} programs; {len(failures)} failed to compile")
+	# A rerun only builds the pending cases, so the results of earlier runs are kept.
+	file_utilities.update_json_manifest(os.path.join(manifest_directory, PREBUILD_MANIFEST_FILE_NAME), manifest)
+	return builds
+
+def evict_builds(max_age=None, max_size=None):
+	"""
+	Delete cached builds that haven't been used for `max_age` seconds, then the least recently used
+	builds until the cache takes up at most `max_size` bytes.
+
+	:return: The number of builds deleted.
+	"""
+	if not os.path.isdir(BUILD_CACHE_DIR):
+		return 0
+	now = time.time()
+	builds = []
+	for prefix in os.listdir(BUILD_CACHE_DIR):
+		for name in os.listdir(os.path.join(BUILD_CACHE_DIR, prefix)):
+			directory = os.path.join(BUILD_CACHE_DIR, prefix, name)
+			try:
+				last_used = os.stat(os.path.join(directory, 'build.json')).st_mtime
+			except OSError:
+				# A build that is being assembled, or was abandoned, has no record yet.
+				try:
+					last_used = os.stat(directory).st_mtime
+				except OSError:
+					continue
+			builds.append((last_used, directory))
+	builds.sort()
+
+	evicted = 0
+	total_size = sum(workspace.directory_size(directory) for _, directory in builds) if max_size is not None else 0
+	for last_used, directory in builds:
+		expired = max_age is not None and now - last_used > max_age
+		# Builds that are still being assembled only go once they're old enough to be abandoned.
+		over_size = max_size is not None and total_size > max_size and not directory.endswith('.tmp')
+		if not expired and not over_size:
+			continue
+		size = workspace.directory_size(directory) if max_size is not None else 0
+		# Rename the build away first, so other processes see it either whole or not at all.
+		evicting_path = f"{directory}.{os.getpid()}.evicting"
+		try:
+			os.rename(directory, evicting_path)
+		except OSError:
+			continue
+		shutil.rmtree(evicting_path, ignore_errors=True)
+		total_size -= size
+		evicted += 1
+	return evicted
@@ -0,0 +1,56 @@
+import argparse
+import json
+import querier
+
+def count_tokens(text, model):
+	"""
+	Count tokens with tiktoken when it is installed, falling back to the four-characters-per-token estimate.
+
+	:return: A tuple containing the token count and whether it is exact.
+	"""
+	try:
+		import tiktoken
+	except ImportError:
+		return len(text) // 4, False
+
+	try:
+		encoding = tiktoken.encoding_for_model(model)
+	except KeyError:
+		encoding = tiktoken.get_encoding("cl100k_base")
+	return len(encoding.encode(text)), True
+
+def fixed_payload_parts(tool_schema):
+	"""Return the parts of every request that don't depend on the conversation."""
+	return {
+		"initial prompt": querier.AIModelQuerier.initial_prompt(),
+		"transient prompt": querier.AIModelQuerier.transient_prompt(),
+		"tool schema": querier.SERIALIZED_TOOL_SCHEMAS[tool_schema],
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description="Report the size of the fixed prompt and tool schema payload sent with every model request.")
+	parser.add_argument('--model', default="gpt-4", help=f"The model whose tokenizer to use.")
+	parser.add_argument('--json', action='store_true', help=f"Print the report as JSON.")
+	args = parser.parse_args()
+
+	report = {}
+	for tool_schema in querier.TOOL_SCHEMAS:
+		parts = {}
+		for name, text in fixed_payload_parts(tool_schema).items():
+			tokens, exact = count_tokens(text, args.model)
+			parts[name] = {"characters": len(text), "tokens": tokens, "exact": exact}
+		parts["total"] = {key: sum(part[key] for part in parts.values()) for key in ["characters", "tokens"]}
+		report[tool_schema] = parts
+
+	if args.json:
+		print(json.dumps(report, indent=2))
+		return
+
+	for tool_schema, parts in report.items():
+		print(f"Tool schema '{tool_schema}':")
+		for name, part in parts.items():
+			approximate = "" if part.get("exact", True) else " (estimated)"
+			print(f"\t{name}: {part['characters']} characters, {part['tokens']} tokens{approximate}")
+
+if __name__ == "__main__":
+	main()
@@ -1,27 +1,258 @@
 from abc import ABC, abstractmethod
 from typing import List
-import openai
 import os
 import sys
 import subprocess
 import re
 import json
-import difflib
 import file_utilities
+import rate_limiter
+import source_buffer
+import tracing
 import uuid
 import pprint
+import time
+import threading
+import collections
+import concurrent.futures
 from termcolor import colored
 
 class FunctionCall():
-	def __init__(self, type, function_identifier, call_identifier, context):
+	def __init__(self, type, function_identifier, call_identifier, context, payload=None):
 		self.type = type
 		self.function_identifier = function_identifier
 		self.call_identifier = call_identifier
 		self.context = context
+		# Anything the command needs beyond its printable context, such as a prepared source edit.
+		self.payload = payload
 
 	def __str__(self):
 		return f"FunctionCall(type={self.type}, function_identifier={self.function_identifier}, call_identifier={self.call_identifier}, context={self.context})"
 
+TOOLS = [
+	{
+		"type": "function",
+		"function":  {
+			"name": "run_debugger_command",
+			"description": "Run a command using the lldb debugger. Issue only a single command per function call.",
+			"parameters": {
+				"type": "object",
+				"properties": {
+					"cmd": {
+						"type": "string",
+						"description": "The command to run.",
+					},
+				},
+				"required": ["cmd"],
+			},
+		}
+	},
+	{
+		"type": "function",
+		"function":  {
+			"name": "run_debugger_commands",
+			"description": "Run an ordered list of lldb commands in a single call and receive the output of each command in its own section. Use this for short sequences of related commands, such as selecting a frame and then inspecting its variables.",
+			"parameters": {
+				"type": "object",
+				"properties": {
+					"cmds": {
+						"type": "array",
+						"items": {
+							"type": "string",
+						},
+						"description": "The commands to run, in order. Each entry must be a single command.",
+					},
+					"stop_on_error": {
+						"type": "boolean",
+						"description": "Whether to skip the remaining commands once a command fails. Defaults to false.",
+					},
+				},
+				"required": ["cmds"],
+			},
+		}
+	},
+	{
+		"type": "function",
+		"function":  {
+			"name": "get_source",
+			"description": "Retrieve the contents of a particular source file, centered around a given line number.",
+			"parameters": {
+				"type": "object",
+				"properties": {
+					"file_path": {
+						"type": "string",
+						"description": "The path of the source file to read.",
+					},
+					"line_number": {
+						"type": "integer",
+						"description": "The line number of interest.",
+					},
+					"context_lines": {
+						"type": "integer",
+						"description": "The number of lines before and after the line of interest to display. Defaults to 50.",
+					},
+				},
+				"required": ["file_path", "line_number"],
+			},
+		}
+	},
+	{
+		"type": "function",
+		"function": {
+			"name": "modify_code",
+			"description": "Modify the source code, recompile, and restart the debugger to test changes.",
+			"parameters": {
+				"type": "object",
+				"properties": {
+					"file_path": {
+						"type": "string",
+						"description": "The path of the file to modify as shown in the debugger output.",
+					},
+					"changes": {
+						"type": "array",
+						"items": {
+							"type": "object",
+							"properties": {
+								"from-file-range": {
+									"type": "object",
+									"properties": {
+										"start-line": {
+											"type": "integer",
+											"description": "The first line in the original file that should be replaced. Line numbers start at 1.",
+										},
+										"code": {
+											"type": "string",
+											"description": "The code that should be replaced by the code in to-file-range.",
+										}
+									},
+									"required": ["start-line", "code"]
+								},
+								"to-file-range": {
+									"type": "object",
+									"properties": {
+										"start-line": {
+											"type": "integer",
+											"description": "The first line in the updated file that should be replaced. This should be the line number after previous changes in the array are applied. Line numbers start at 1.",
+										},
+										"code": {
+											"type": "string",
+											"description": "The code to replace the code in from-file-range.",
+										}
+									},
+									"required": ["start-line", "code"]
+								},
+			
+							}
+						}
+					}
+				},
+				"required": ["file_path", "changes"]
+			},
+		}
+	},
+	{
+		"type": "function",
+		"function": {
+			"name": "restart",
+			"description": "Restart debugging from the beginning.",
+			"parameters": {
+				"type": "object",
+				"properties": {}
+			}					
+		}
+	},
+	{
+		"type": "function",
+		"function":  {
+			"name": "end_session",
+			"description": "Run this function to end the debugging session only if you cannot continue debugging and there are no other reasonable debugging steps to take to investigate further.",
+			"parameters": {
+				"type": "object",
+				"properties": {},
+				"required": [],
+			},
+		}
+	},
+
+]
+
+def first_sentence(text):
+	sentence_end = text.find(". ")
+	return text if sentence_end == -1 else text[:sentence_end + 1]
+
+def compact_tools(tools, keep_parameter_descriptions=True):
+	"""
+	Return a copy of a tool schema with every description cut to its first sentence and,
+	optionally, parameter descriptions removed entirely.
+	"""
+	def compact(node, is_parameter):
+		if isinstance(node, list):
+			return [compact(item, is_parameter) for item in node]
+		if not isinstance(node, dict):
+			return node
+		compacted = {}
+		for key, value in node.items():
+			if key == "description":
+				if is_parameter and not keep_parameter_descriptions:
+					continue
+				value = first_sentence(value)
+			compacted[key] = compact(value, is_parameter or key == "parameters")
+		return compacted
+	return compact(tools, False)
+
+# Tool schema variants that can be compared against each other for latency, cost and success rate.
+TOOL_SCHEMAS = {
+	"full": TOOLS,
+	"compact": compact_tools(TOOLS),
+	"minimal": compact_tools(TOOLS, keep_parameter_descriptions=False),
+}
+DEFAULT_TOOL_SCHEMA = "full"
+
+# Serialized once so that request size estimates don't re-encode the schema on every turn.
+SERIALIZED_TOOL_SCHEMAS = {name: json.dumps(tools) for name, tools in TOOL_SCHEMAS.items()}
+
+class LatencyTracker():
+	"""
+	Keeps a window of recent request latencies for one model, shared by every querier in the process.
+	"""
+	MINIMUM_SAMPLES = 5
+	_trackers = {}
+	_trackers_lock = threading.Lock()
+
+	def __init__(self, window=200):
+		self._latencies = collections.deque(maxlen=window)
+		self._lock = threading.Lock()
+
+	@classmethod
+	def for_model(cls, model_identifier):
+		with cls._trackers_lock:
+			if model_identifier not in cls._trackers:
+				cls._trackers[model_identifier] = cls()
+			return cls._trackers[model_identifier]
+
+	def record(self, latency):
+		with self._lock:
+			self._latencies.append(latency)
+
+	def percentile(self, percentile):
+		"""Return the given percentile of recent latencies, or None until enough requests have completed."""
+		with self._lock:
+			if len(self._latencies) < self.MINIMUM_SAMPLES:
+				return None
+			latencies = sorted(self._latencies)
+		index = min(len(latencies) - 1, int(round(percentile / 100 * (len(latencies) - 1))))
+		return latencies[index]
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+def hedge_executor():
+	global _hedge_executor
+	with _hedge_executor_lock:
+		if _hedge_executor is None:
+			_hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedged-request")
+		return _hedge_executor
+
 class AIModelQuerier(ABC):
 	"""
 	Abstract base class for AI models.
@@ -75,15 +306,42 @@ class AIModelQuerier(ABC):
 		return f"{self.__class__.__name__}(model_identifier={self.model_identifier})"
 
 class OpenAIModelQuerier(AIModelQuerier):
+	# How long the on-disk model list is trusted before asking the API again.
+	MODEL_CACHE_TTL = 24 * 60 * 60
+	_model_names = None
+
 	@classmethod
-	def supported_model_names(cls):
+	def supported_model_names(cls, allow_network=True):
+		if cls._model_names is not None:
+			return cls._model_names
+
+		model_names = file_utilities.retrieve_model_names(max_age=cls.MODEL_CACHE_TTL)
+		if model_names is None and allow_network:
+			model_names = cls.fetch_model_names()
+		if model_names is not None:
+			cls._model_names = model_names
+			return model_names
+
+		# Offline fallback: a stale list is better than no list at all.
+		return file_utilities.retrieve_model_names() or []
+
+	@classmethod
+	def fetch_model_names(cls):
 		# Make sure this key is set before trying to interact with the OpenAI API
-		if 'OPENAI_API_KEY' in os.environ:
-			response = openai.Model.list()
-			return [item['id'] for item in response['data']]
-		else:
+		if 'OPENAI_API_KEY' not in os.environ:
 			print("Warning: No OpenAI API key found in environment. Set the OPENAI_API_KEY environment variable.")
-			return []
+			return None
+
+		import openai
+		try:
+			response = openai.Model.list()
+		except openai.error.OpenAIError as e:
+			print(f"Warning: Unable to list OpenAI models: {e}")
+			return None
+
+		model_names = [item['id'] for item in response['data']]
+		file_utilities.store_model_names(model_names)
+		return model_names
 			
 	def __init__(self, model_identifier: str):
 		super().__init__(model_identifier)
@@ -91,14 +349,33 @@ class OpenAIModelQuerier(AIModelQuerier):
 		print(f"***Initial prompt: {colored(initial_prompt, 'cyan')}")
 		self.messages = [{"role": "system", "content": initial_prompt}]
 		self._pending_context = []
+		self._pending_context_usage = None
 		self._output_context_identifier = uuid.uuid4()
+		self.turn_metrics = []
+		self.hedge_model_identifier = None
+		self.hedge_percentile = None
+		self.tool_schema = DEFAULT_TOOL_SCHEMA
+		self.transient_prompt_text = AIModelQuerier.transient_prompt()
 
+	def set_prompts(self, initial_prompt=None, transient_prompt=None):
+		"""Replace the default prompts for this session, for example to compare prompt variants."""
+		if initial_prompt is not None:
+			print(f"***Initial prompt: {colored(initial_prompt, 'cyan')}")
+			self.messages[0] = {"role": "system", "content": initial_prompt}
+		if transient_prompt is not None:
+			self.transient_prompt_text = transient_prompt
 		
-	def load_context(self, context_identifier):
+	def load_context(self, context_identifier, usage=None):
+		"""
+		Resume from a stored context, whose assistant messages are replayed before the model is queried.
+
+		:param usage: The token usage of the context's first response, if it was requested outside the session, as in a batch.
+		"""
 		self._pending_context = file_utilities.retrieve_context(context_identifier)
+		self._pending_context_usage = usage
 		
 	def save_context(self, context_identifier):
-		file_utilities.store_context(self.messages, context_identifier)
+		file_utilities.store_context(self.messages, context_identifier, self._output_context_identifier)
 		
 	def get_context_identifier(self):
 		return self._output_context_identifier
@@ -122,200 +399,22 @@ class OpenAIModelQuerier(AIModelQuerier):
 		
 		return ('', response)
 
-	def get_tools(self):
-		return [
-			{
-				"type": "function",
-				"function":  {
-					"name": "run_debugger_command",
-					"description": "Run a command using the lldb debugger. Issue only a single command per function call.",
-					"parameters": {
-						"type": "object",
-						"properties": {
-							"cmd": {
-								"type": "string",
-								"description": "The command to run.",
-							},
-						},
-						"required": ["cmd"],
-					},
-				}
-			},
-			{
-				"type": "function",
-				"function":  {
-					"name": "get_source",
-					"description": "Retrieve the contents of a particular source file, centered around a given line number.",
-					"parameters": {
-						"type": "object",
-						"properties": {
-							"file_path": {
-								"type": "string",
-								"description": "The path of the source file to read.",
-							},
-							"line_number": {
-								"type": "integer",
-								"description": "The line number of interest.",
-							},
-							"context_lines": {
-								"type": "integer",
-								"description": "The number of lines before and after the line of interest to display. Defaults to 50.",
-							},
-						},
-						"required": ["file_path", "line_number"],
-					},
-				}
-			},
-			{
-				"type": "function",
-				"function": {
-					"name": "modify_code",
-					"description": "Modify the source code, recompile, and restart the debugger to test changes.",
-					"parameters": {
-						"type": "object",
-						"properties": {
-							"file_path": {
-								"type": "string",
-								"description": "The path of the file to modify as shown in the debugger output.",
-							},
-							"changes": {
-								"type": "array",
-								"items": {
-									"type": "object",
-									"properties": {
-										"from-file-range": {
-											"type": "object",
-											"properties": {
-												"start-line": {
-													"type": "integer",
-													"description": "The first line in the original file that should be replaced. Line numbers start at 1.",
-												},
-												"code": {
-													"type": "string",
-													"description": "The code that should be replaced by the code in to-file-range.",
-												}
-											},
-											"required": ["start-line", "code"]
-										},
-										"to-file-range": {
-											"type": "object",
-											"properties": {
-												"start-line": {
-													"type": "integer",
-													"description": "The first line in the updated file that should be replaced. This should be the line number after previous changes in the array are applied. Line numbers start at 1.",
-												},
-												"code": {
-													"type": "string",
-													"description": "The code to replace the code in from-file-range.",
-												}
-											},
-											"required": ["start-line", "code"]
-										},
-					
-									}
-								}
-							}
-						},
-						"required": ["file_path", "changes"]
-					},
-				}
-			},
-			{
-				"type": "function",
-				"function": {
-					"name": "restart",
-					"description": "Restart debugging from the beginning.",
-					"parameters": {
-						"type": "object",
-						"properties": {}
-					}					
-				}
-			},
-			{
-				"type": "function",
-				"function":  {
-					"name": "end_session",
-					"description": "Run this function to end the debugging session only if you cannot continue debugging and there are no other reasonable debugging steps to take to investigate further.",
-					"parameters": {
-						"type": "object",
-						"properties": {},
-						"required": [],
-					},
-				}
-			},
-
-		]
-		
-	def validate_changes(self, source_code, change_dict):
-		lines = source_code.splitlines()
-		for change in change_dict["changes"]:
-			if not "from-file-range" in change:
-				return False, "from-file-range is missing"
-			from_range = change["from-file-range"]
-			if not "start-line" in from_range:
-				return False, "start-line is missing in from-file-range"
-			if not "code" in from_range:
-				return False, "code is missing in from-file-range"
-			
-			if not "to-file-range" in change:
-				return False, "to-file-range missing"
-			to_range = change["to-file-range"]
-			if not "start-line" in to_range:
-				return False, "start-line is missing in from-file-range"
-			if not "code" in to_range:
-				return False, "code is missing in to-file-range"
-
-			start_line = from_range["start-line"] - 1
-			num_lines = len(from_range["code"].splitlines())
-			extracted_lines = [line.lstrip().rstrip() for line in lines[start_line:start_line + num_lines]]
-			
-			expected_lines = [line.lstrip().rstrip() for line in change["from-file-range"]["code"].splitlines()]
-			
-			# Direct line-by-line comparison
-			if extracted_lines != expected_lines:
-				error_message = "Mismatch starting at line {}. Expected: '{}' but found: '{}'".format(
-					start_line + 1, "\n".join(expected_lines), "\n".join(extracted_lines))
-				return False, error_message
+	@classmethod
+	def get_tools(cls, tool_schema=DEFAULT_TOOL_SCHEMA):
+		# The schemas are built once at import; callers must not modify the returned list.
+		return TOOL_SCHEMAS[tool_schema]
 		
-		return True, "Changes are valid"
-
-	def validate_changes_and_generate_unified_diff(self, data, base_path, context_lines=3):
+	@tracing.traced("patch")
+	def prepare_source_edit(self, data, base_path, context_lines=3):
 		file_path = data["file_path"]
-		source_code = file_utilities.get_source_code(base_path, file_path)
-		if source_code is None:
-			return False, f"Unable to get source code. Base path: {base_path}, file_path: {file_path}"
-	
-		# Step 1: Validate the changes
-		is_valid, message = self.validate_changes(source_code, data)
-		if not is_valid:
-			return False, message
-		
-		# Split the source code into lines for easy access
-		source_lines = source_code.splitlines()
-		
-	    # Initialize to_code as a full copy of source_lines
-		to_code = source_lines.copy()
-		
-		# Apply each change to the to_code list
-		for change in data["changes"]:
-			start_line = change["from-file-range"]["start-line"] - 1
-			end_line = start_line + len(change["from-file-range"]["code"].splitlines())
-		
-			change_lines = change["to-file-range"]["code"].splitlines()
-			to_code[start_line:end_line] = change_lines
-
-		# Generate unified diff using difflib with full source and modified code
-		diff = difflib.unified_diff(
-			source_lines, 
-			to_code, 
-			fromfile=file_path, 
-			tofile=file_path, 
-			lineterm='',
-			n=context_lines
-		)
-		
-		# Return the patch
-		return True, "\n".join(diff)
+		try:
+			edit = source_buffer.SourceEdit(base_path, file_path, data["changes"], context_lines)
+		except (OSError, UnicodeDecodeError) as e:
+			return False, f"Unable to get source code. Base path: {base_path}, file_path: {file_path}: {e}"
+
+		if not edit.valid:
+			return False, edit.message
+		return True, edit
 
 	def strip_assistant_content(self, assistant_content):
 		stripped_content = []
@@ -432,6 +531,94 @@ class OpenAIModelQuerier(AIModelQuerier):
 	# 	
 	# 	return merged_object
 
+	def estimate_tokens(self, messages, include_tools=False):
+		# Roughly four characters per token for English text and JSON; good enough for rate limiting.
+		tools_length = len(SERIALIZED_TOOL_SCHEMAS[self.tool_schema]) if include_tools else 0
+		return (len(json.dumps(messages)) + tools_length) // 4
+
+	def request_completion(self, model_identifier, input_messages, tools, max_tokens, stream=False):
+		import openai
+
+		return rate_limiter.shared_rate_limiter().call(
+			lambda: openai.ChatCompletion.create(
+				model=model_identifier,
+				max_tokens=max_tokens,
+				messages=input_messages,
+				tools=tools,
+				# function_call={"name": "run_debugger_command"},
+				stream=stream
+			),
+			estimated_tokens=self.estimate_tokens(input_messages, include_tools=True) + max_tokens,
+			retryable_exceptions=(openai.error.APIError, openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.TryAgain),
+			rate_limit_exceptions=(openai.error.RateLimitError,),
+			token_counter=None if stream else lambda response: response.get('usage', {}).get('total_tokens')
+		)
+
+	def enable_hedging(self, hedge_model_identifier=None, hedge_percentile=95):
+		"""
+		Send a second request when a turn takes longer than the given percentile of recent latencies.
+
+		:param hedge_model_identifier: The model to send the second request to. Defaults to this querier's model.
+		:param hedge_percentile: The latency percentile, between 0 and 100, after which to send the second request.
+		"""
+		self.hedge_model_identifier = hedge_model_identifier or self.model_identifier
+		self.hedge_percentile = hedge_percentile
+
+	def hedged_request_completion(self, input_messages, tools, max_tokens):
+		"""
+		Issue a request and, if it is slower than the hedge percentile, the same request to the hedge
+		model. The first response containing tool calls wins and the other request is abandoned.
+
+		:return: A tuple containing the response and the identifier of the model that produced it.
+		"""
+		def timed_request(model_identifier):
+			start_time = time.monotonic()
+			response = self.request_completion(model_identifier, input_messages, tools, max_tokens)
+			LatencyTracker.for_model(model_identifier).record(time.monotonic() - start_time)
+			return response
+
+		executor = hedge_executor()
+		futures = {executor.submit(timed_request, self.model_identifier): self.model_identifier}
+		hedge_delay = LatencyTracker.for_model(self.model_identifier).percentile(self.hedge_percentile)
+		if hedge_delay is not None:
+			done, _ = concurrent.futures.wait(futures, timeout=hedge_delay)
+			if not done:
+				print(colored(f"***No response after {hedge_delay:.1f}s, sending a hedged request to {self.hedge_model_identifier}", 'light_grey'))
+				futures[executor.submit(timed_request, self.hedge_model_identifier)] = self.hedge_model_identifier
+
+		fallback = None
+		pending = set(futures)
+		while pending:
+			done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				if future.exception() is None and future.result().choices[0].message.get("tool_calls"):
+					# A request that is already running can't be interrupted, so its response is simply ignored.
+					for other in pending:
+						other.cancel()
+					return future.result(), futures[future]
+				if fallback is None:
+					fallback = future
+
+		# No response contained tool calls, so use whichever finished first, raising its error if it failed.
+		return fallback.result(), futures[fallback]
+
+	def record_turn_metrics(self, usage, start_time, first_token_time=None, model_identifier=None):
+		end_time = time.monotonic()
+		prompt_tokens = usage.get("prompt_tokens", 0)
+		completion_tokens = usage.get("completion_tokens", 0)
+		self.turn_metrics.append({
+			"turn": len(self.turn_metrics) + 1,
+			"model": model_identifier or self.model_identifier,
+			"tool_schema": self.tool_schema,
+			"prompt_tokens": prompt_tokens,
+			"completion_tokens": completion_tokens,
+			"total_tokens": prompt_tokens + completion_tokens,
+			"usage_estimated": usage.get("estimated", False),
+			"latency": end_time - start_time,
+			# Without streaming the first token arrives with the rest of the response.
+			"time_to_first_token": (first_token_time or end_time) - start_time,
+		})
+
 	def append_function_call_response(self, function_call, response):
 		new_message = {"role": "tool", "name": function_call.function_identifier, "tool_call_id": function_call.call_identifier, "content": response}
 		self.messages.append(new_message)
@@ -440,10 +627,58 @@ class OpenAIModelQuerier(AIModelQuerier):
 		new_message = {"role": "user", "content": message}
 		self.messages.append(new_message)
 
+	def parse_function_calls(self, response_message, base_path):
+		"""Turn the tool calls in a model response into FunctionCalls for the command center."""
+		function_calls = []
+		if response_message.get("tool_calls"):
+			for tool_call in response_message["tool_calls"]:
+				function_call = tool_call["function"]
+				call_id = tool_call["id"]
+				print(f"***Function call: {function_call['name']}\n{function_call['arguments']}")
+				function_name = function_call["name"]
+				try:
+					function_arguments = json.loads(function_call["arguments"])
+				except json.decoder.JSONDecodeError as e:
+					function_calls.append(FunctionCall("error", function_name, call_id,  f"Error parsing function call arguments json: {str(e)}. Please retry with correct json."))
+					continue
+					
+				print(function_call)
+				if function_name == "run_debugger_command":
+					command = function_arguments["cmd"]
+					function_calls.append(FunctionCall("lldb", function_name, call_id, command))
+				elif function_name == "run_debugger_commands":
+					commands = function_arguments["cmds"]
+					stop_on_error = function_arguments.get("stop_on_error", False)
+					function_calls.append(FunctionCall("lldb_batch", function_name, call_id, "\n".join(commands), payload={"commands": commands, "stop_on_error": stop_on_error}))
+				elif function_name == "get_source":
+					print(function_arguments)
+					file_path = function_arguments["file_path"]
+					line_number = function_arguments.get("line_number", 25)
+					context_lines = function_arguments.get("context_lines", 50)
+					context = f"{file_path}:{line_number}:{context_lines}"
+					function_calls.append(FunctionCall("source", function_name, call_id, context))
+				elif function_name == "modify_code":
+					success, result = self.prepare_source_edit(function_arguments, base_path)
+					print(function_arguments)
+					if success:
+						function_calls.append(FunctionCall("patch", function_name, call_id, result.diff, payload=result))
+					else:
+						function_calls.append(FunctionCall("error", function_name, call_id,  f"Error generating diff for this change: {result}"))
+				elif function_name == "restart":
+					function_calls.append(FunctionCall("restart", function_name, call_id, None))
+				elif function_name == "end_session":
+					function_calls.append(FunctionCall("give_up", function_name, call_id, None))
+				else:
+					function_calls.append(FunctionCall("none", function_name, call_id, None))
+		return function_calls
+
+	@tracing.traced("model")
 	def get_output(self, base_path, stream=False):
+		import openai
+
 		input_messages = self.messages.copy() #self.strip_assistant_content(self.messages)		
 		# Transient system message
-		input_messages.append({"role": "system", "content": AIModelQuerier.transient_prompt()})
+		input_messages.append({"role": "system", "content": self.transient_prompt_text})
 		
 		function_calls = []
 
@@ -451,23 +686,30 @@ class OpenAIModelQuerier(AIModelQuerier):
 			response_message = self.get_next_response_from_context()
 			if response_message is not None:
 				print(f"***Using response from context: {response_message.get('content')}")
+				if self._pending_context_usage is not None:
+					# The response was paid for before the session started, so count it as this session's turn.
+					self.record_turn_metrics(self._pending_context_usage, time.monotonic())
+					self._pending_context_usage = None
 			else:
-				response = openai.ChatCompletion.create(
-					model=self.model_identifier,
-					max_tokens=1000,
-					messages=input_messages,
-					tools=self.get_tools(),
-					# function_call={"name": "run_debugger_command"},
-					stream=stream
-				)
+				max_tokens = 1000
+				tools = self.get_tools(self.tool_schema)
+				start_time = time.monotonic()
+				model_identifier = self.model_identifier
+				if self.hedge_percentile is not None and not stream:
+					response, model_identifier = self.hedged_request_completion(input_messages, tools, max_tokens)
+				else:
+					response = self.request_completion(self.model_identifier, input_messages, tools, max_tokens, stream)
 	
 				if stream:
 					# create variables to collect the stream of chunks
 					collected_chunks = []
 					
 					printed_response_header = False
+					first_token_time = None
 					# iterate through the stream of events
 					for chunk in response:
+						if first_token_time is None:
+							first_token_time = time.monotonic()
 						collected_chunks.append(chunk.choices[0])  # save the event response
 						chunk_message = chunk['choices'][0]  # extract the message
 						
@@ -482,10 +724,16 @@ class OpenAIModelQuerier(AIModelQuerier):
 					# print(f"collected chunks: {collected_chunks}")
 					# print the time delay and text received
 					response_message = self.merge_chunks(collected_chunks)
+					# Streamed responses don't report usage, so estimate it from the text.
+					usage = {"prompt_tokens": self.estimate_tokens(input_messages, include_tools=True), "completion_tokens": self.estimate_tokens([response_message]), "estimated": True}
 				else:
+					first_token_time = None
 					response_message = response.choices[0].message
+					usage = response.get("usage", {})
 					print("***Response from model: ", end = "")
 					print(colored(response_message.content, 'red'))
+				
+				self.record_turn_metrics(usage, start_time, first_token_time, model_identifier)
 			
 			# Extract the generated code
 			self.messages.append(response_message)
@@ -495,43 +743,9 @@ class OpenAIModelQuerier(AIModelQuerier):
 			print(colored(f"Saved interim state as {interimUUID}", 'light_grey'))
 			# print(response_message)
 	
-			if response_message.get("tool_calls"):
-				for tool_call in response_message["tool_calls"]:
-					function_call = tool_call["function"]
-					call_id = tool_call["id"]
-					print(f"***Function call: {function_call['name']}\n{function_call['arguments']}")
-					function_name = function_call["name"]
-					try:
-						function_arguments = json.loads(function_call["arguments"])
-					except json.decoder.JSONDecodeError as e:
-						function_calls.append(FunctionCall("error", function_name, call_id,  f"Error parsing function call arguments json: {str(e)}. Please retry with correct json."))
-						continue
-						
-					print(function_call)
-					if function_name == "run_debugger_command":
-						command = function_arguments["cmd"]
-						function_calls.append(FunctionCall("lldb", function_name, call_id, command))
-					elif function_name == "get_source":
-						print(function_arguments)
-						file_path = function_arguments["file_path"]
-						line_number = function_arguments.get("line_number", 25)
-						context_lines = function_arguments.get("context_lines", 50)
-						context = f"{file_path}:{line_number}:{context_lines}"
-						function_calls.append(FunctionCall("source", function_name, call_id, context))
-					elif function_name == "modify_code":
-						success, result = self.validate_changes_and_generate_unified_diff(function_arguments, base_path)
-						print(function_arguments)
-						if success:
-							function_calls.append(FunctionCall("patch", function_name, call_id, result))			
-						else:
-							function_calls.append(FunctionCall("error", function_name, call_id,  f"Error generating diff for this change: {result}"))
-					elif function_name == "restart":
-						function_calls.append(FunctionCall("restart", function_name, call_id, None))
-					elif function_name == "end_session":
-						function_calls.append(FunctionCall("give_up", function_name, call_id, None))
-					else:
-						function_calls.append(FunctionCall("none", function_name, call_id, None))			
-		except openai.error.InvalidRequestError as e:
+			function_calls = self.parse_function_calls(response_message, base_path)
+		except openai.error.OpenAIError as e:
+			# Transient errors have already been retried by the rate limiter, so anything left is fatal.
 			function_calls.append(FunctionCall("fatal_error", "fatal_error", None, str(e)))
 			
 		return function_calls
@@ -543,3 +757,26 @@ class OpenAIModelQuerier(AIModelQuerier):
 		
 		# print(f"***Extracted solution:\n{solution}")
 		# return LLMSolution(problem_input.problem_id, self.model_identifier, problem_input.prompt_id, solution)
+
+class ReplayModelQuerier(OpenAIModelQuerier):
+	"""
+	Answers each turn with the next assistant message of a recorded conversation instead of querying a
+	model, so that sessions can be replayed without network access or model latency. The session ends
+	once the recording runs out of assistant messages.
+	"""
+	def __init__(self, messages, model_identifier="replay"):
+		super().__init__(model_identifier)
+		self._pending_context = list(messages)
+
+	@tracing.traced("model")
+	def get_output(self, base_path, stream=False):
+		start_time = time.monotonic()
+		response_message = self.get_next_response_from_context()
+		if response_message is None:
+			return [FunctionCall("give_up", "end_session", None, None)]
+		self.record_turn_metrics({}, start_time)
+		self.messages.append(response_message)
+		# Save the same checkpoints as a real turn, so replays include their serialization cost.
+		self.save_context(self._output_context_identifier)
+		self.save_context(uuid.uuid4())
+		return self.parse_function_calls(response_message, base_path)
@@ -0,0 +1,159 @@
+import random
+import threading
+import time
+
+class TokenBucket:
+	"""
+	A thread-safe token bucket that refills continuously at a fixed rate per minute.
+	"""
+	def __init__(self, rate_per_minute, capacity=None):
+		self.rate_per_second = rate_per_minute / 60.0
+		self.capacity = capacity if capacity is not None else rate_per_minute
+		self._tokens = self.capacity
+		self._updated_at = time.monotonic()
+		self._lock = threading.Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+		self._updated_at = now
+
+	def acquire(self, amount=1):
+		"""Block until `amount` tokens are available, then take them."""
+		# A request larger than the bucket could never be satisfied, so cap it at the capacity.
+		amount = min(amount, self.capacity)
+		while True:
+			with self._lock:
+				self._refill()
+				if self._tokens >= amount:
+					self._tokens -= amount
+					return
+				wait = (amount - self._tokens) / self.rate_per_second
+			time.sleep(wait)
+
+	def adjust(self, amount):
+		"""Give back (positive) or take away (negative) tokens once the real cost of a request is known."""
+		with self._lock:
+			self._refill()
+			self._tokens = min(self.capacity, self._tokens + amount)
+
+class AdaptiveConcurrencyLimit:
+	"""
+	Limits the number of requests in flight, growing the limit additively while requests succeed
+	quickly and shrinking it multiplicatively on rate limiting or when latency degrades.
+	"""
+	def __init__(self, initial_limit=4, min_limit=1, max_limit=32, latency_tolerance=2.0):
+		self.limit = initial_limit
+		self.min_limit = min_limit
+		self.max_limit = max_limit
+		self.latency_tolerance = latency_tolerance
+		self.in_flight = 0
+		self._successes = 0
+		self._baseline_latency = None
+		self._condition = threading.Condition()
+
+	def acquire(self):
+		with self._condition:
+			while self.in_flight >= self.limit:
+				self._condition.wait()
+			self.in_flight += 1
+
+	def release(self, latency=None, rate_limited=False):
+		with self._condition:
+			self.in_flight -= 1
+			if rate_limited:
+				self.limit = max(self.min_limit, self.limit // 2)
+				self._successes = 0
+			elif latency is not None:
+				if self._baseline_latency is None or latency < self._baseline_latency:
+					self._baseline_latency = latency
+				else:
+					# Let the baseline drift slowly so that one fast outlier doesn't pin it forever.
+					self._baseline_latency = 0.95 * self._baseline_latency + 0.05 * latency
+
+				if latency > self._baseline_latency * self.latency_tolerance:
+					self.limit = max(self.min_limit, self.limit - 1)
+					self._successes = 0
+				else:
+					self._successes += 1
+					if self._successes >= self.limit:
+						self.limit = min(self.max_limit, self.limit + 1)
+						self._successes = 0
+			self._condition.notify_all()
+
+class RateLimiter:
+	"""
+	Client-side limiter for model requests. Combines a requests-per-minute bucket, a tokens-per-minute
+	bucket and an adaptive concurrency limit, and retries rate-limited or transient failures with
+	exponential backoff and full jitter.
+	"""
+	def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrent_requests=8, max_retries=6, base_delay=1.0, max_delay=60.0):
+		self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+		self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+		self.concurrency = AdaptiveConcurrencyLimit(initial_limit=min(4, max_concurrent_requests), max_limit=max_concurrent_requests)
+		self.max_retries = max_retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+
+	def backoff_delay(self, attempt):
+		return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+	def call(self, request_function, estimated_tokens=0, retryable_exceptions=(), rate_limit_exceptions=(), token_counter=None):
+		"""
+		Call `request_function` once capacity is available, retrying retryable exceptions.
+
+		:param request_function: A function taking no arguments that issues the request.
+		:param estimated_tokens: The number of tokens the request is expected to consume.
+		:param retryable_exceptions: Exception types that indicate a transient failure.
+		:param rate_limit_exceptions: Exception types that indicate the quota was exceeded.
+		:param token_counter: An optional function returning the actual number of tokens used by a response.
+		:return: The return value of `request_function`.
+		"""
+		attempt = 0
+		while True:
+			self.concurrency.acquire()
+			if self.request_bucket:
+				self.request_bucket.acquire()
+			if self.token_bucket:
+				self.token_bucket.acquire(estimated_tokens)
+
+			start_time = time.monotonic()
+			try:
+				result = request_function()
+			except rate_limit_exceptions + retryable_exceptions as e:
+				rate_limited = isinstance(e, rate_limit_exceptions)
+				self.concurrency.release(rate_limited=rate_limited)
+				if attempt >= self.max_retries:
+					raise
+				delay = self.backoff_delay(attempt)
+				print(f"Model request failed ({e.__class__.__name__}: {e}). Retrying in {delay:.1f}s…")
+				time.sleep(delay)
+				attempt += 1
+				continue
+			except Exception:
+				self.concurrency.release()
+				raise
+
+			self.concurrency.release(latency=time.monotonic() - start_time)
+			if self.token_bucket and token_counter:
+				actual_tokens = token_counter(result)
+				if actual_tokens is not None:
+					self.token_bucket.adjust(estimated_tokens - actual_tokens)
+			return result
+
+_shared_rate_limiter = None
+_shared_rate_limiter_lock = threading.Lock()
+
+def configure(requests_per_minute=None, tokens_per_minute=None, max_concurrent_requests=8):
+	"""Replace the limiter shared by every querier in this process."""
+	global _shared_rate_limiter
+	with _shared_rate_limiter_lock:
+		_shared_rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute, max_concurrent_requests)
+	return _shared_rate_limiter
+
+def shared_rate_limiter():
+	global _shared_rate_limiter
+	with _shared_rate_limiter_lock:
+		if _shared_rate_limiter is None:
+			_shared_rate_limiter = RateLimiter()
+		return _shared_rate_limiter
@@ -0,0 +1,162 @@
+import argparse
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import difflib
+import tempfile
+import artifacts
+import tracing
+import querier
+
+# Parts of debugger output that differ between runs of the same program.
+VOLATILE_PATTERNS = [
+	(re.compile(r'0x[0-9a-fA-F]+'), '0x…'),
+	(re.compile(r'\b(Process|pid =|tid =)\s*\d+'), r'\1 …'),
+	# Workspaces are created in a new temporary directory for every session, so only file names are kept.
+	(re.compile(r'''(?<![\w.~])/(?:[^/\s:'"`()]+/)+'''), ''),
+]
+
+def normalize_output(output):
+	for pattern, replacement in VOLATILE_PATTERNS:
+		output = pattern.sub(replacement, output)
+	return output
+
+def tool_outputs(messages):
+	"""
+	Return the outputs the session fed back to the model, in order, as (key, name, content) tuples.
+	Tool messages are keyed by their call identifier and the debugger's stop reports by their position.
+	"""
+	outputs = []
+	user_messages = 0
+	for message in messages:
+		if message.get("role") == "tool":
+			outputs.append((message.get("tool_call_id"), message.get("name"), message.get("content") or ""))
+		elif message.get("role") == "user":
+			user_messages += 1
+			outputs.append((f"user-{user_messages}", "user", message.get("content") or ""))
+	return outputs
+
+def compare_outputs(recorded_messages, replayed_messages, normalize=True):
+	"""
+	Compare the outputs of a replayed session with the recorded ones.
+
+	:return: A dictionary with the number of outputs that matched, the diffs of those that differed, and the
+	keys of recorded outputs that the replay never produced and of replayed outputs that weren't recorded.
+	"""
+	clean = normalize_output if normalize else (lambda output: output)
+	recorded = {key: (name, content) for key, name, content in tool_outputs(recorded_messages)}
+	replayed = {key: (name, content) for key, name, content in tool_outputs(replayed_messages)}
+	matched = 0
+	diffs = []
+	for key, (name, content) in recorded.items():
+		if key not in replayed:
+			continue
+		recorded_content, replayed_content = clean(content), clean(replayed[key][1])
+		if recorded_content == replayed_content:
+			matched += 1
+			continue
+		diff = difflib.unified_diff(recorded_content.splitlines(), replayed_content.splitlines(), "recorded", "replayed", lineterm="")
+		diffs.append({"key": key, "name": name, "diff": "\n".join(diff)})
+	return {
+		"matched": matched,
+		"differed": diffs,
+		"missing": [key for key in recorded if key not in replayed],
+		"extra": [key for key in replayed if key not in recorded],
+	}
+
+def replay(conversation_directory, code_path, compile_command, executable, output_path=None, normalize=True):
+	"""
+	Re-execute the tool calls of a recorded conversation against a fresh workspace of its program, and
+	compare the new outputs with the recorded ones. The model's turns are taken from the recording, so
+	later calls are made as recorded even if an earlier output differs.
+
+	:param output_path: Where to keep the replayed session's results. By default they are discarded.
+	:return: A dictionary with the recorded and replayed statuses, the comparison, the wall time and the time per phase.
+	"""
+	# Imported here so that comparing outputs doesn't need lldb.
+	import debug_program
+
+	recorded_messages = artifacts.load_conversation(conversation_directory)
+	model_querier = querier.ReplayModelQuerier(recorded_messages)
+	session_output_path = output_path or tempfile.mkdtemp(prefix="replay-")
+	tracing.reset()
+	start_time = time.perf_counter()
+	try:
+		status = debug_program.debug_executable(code_path, compile_command, executable, ["replay"], None, session_output_path, model_querier=model_querier)
+	finally:
+		wall_time = time.perf_counter() - start_time
+		if output_path is None:
+			shutil.rmtree(session_output_path, ignore_errors=True)
+	phases = tracing.snapshot()
+	return {
+		"status": status,
+		"recorded_status": "exited" if os.path.exists(os.path.join(conversation_directory, 'succeeded.txt')) else "gave_up",
+		"turns": len(model_querier.turn_metrics),
+		"comparison": compare_outputs(recorded_messages, model_querier.messages, normalize),
+		"wall_time": wall_time,
+		"phases": phases,
+		"untraced": wall_time - sum(phase["seconds"] for phase in phases.values()),
+	}
+
+def find_cases(results_paths, programs_path):
+	"""Yield (results name, case name, conversation directory, program directory) for every recorded conversation with a matching program."""
+	for results_path in results_paths:
+		for root, files in sorted(artifacts.find_conversations(results_path)):
+			case_name = os.path.basename(os.path.normpath(root))
+			code_path = os.path.join(programs_path, case_name)
+			if not os.path.isdir(code_path):
+				print(f"Skipping {root}: no program at {code_path}", file=sys.stderr)
+				continue
+			yield os.path.basename(os.path.normpath(results_path)), case_name, root, code_path
+
+def main():
+	parser = argparse.ArgumentParser(description="Re-execute the tool calls of recorded conversations against fresh workspaces and report where the new outputs differ from the recorded ones.")
+	parser.add_argument('paths', nargs='+', help=f"Results directories, or directories of them, containing recorded conversations.")
+	parser.add_argument('--programs_path', default="juliet", help=f"The directory containing one directory per program, named like the results directories.")
+	parser.add_argument('--compile_command', nargs='*', default=["make"], help=f"The command to run to compile each program.")
+	parser.add_argument('--executable', default="main", help=f"The executable to run, relative to the program directory.")
+	parser.add_argument('--output_path', required=False, help=f"A directory in which to keep the replayed sessions' results, one directory per case. By default they are discarded.")
+	parser.add_argument('--exact', action='store_true', help=f"Compare outputs exactly, instead of ignoring addresses, process ids and directories.")
+	parser.add_argument('--report', required=False, help=f"The path to write the report to as JSON.")
+	args = parser.parse_args()
+
+	# Keep the replayed sessions out of the real session database.
+	database_directory = tempfile.mkdtemp(prefix="replay-database-")
+	os.environ["GENERATIVE_DEBUGGING_DATABASE"] = os.path.join(database_directory, "sessions.sqlite3")
+
+	cases = []
+	try:
+		for results_name, case_name, conversation_directory, code_path in find_cases(args.paths, args.programs_path):
+			print(f"Replaying {conversation_directory}…", file=sys.stderr)
+			case = {"results": results_name, "case": case_name}
+			output_path = os.path.join(args.output_path, results_name, case_name) if args.output_path else None
+			try:
+				case.update(replay(conversation_directory, code_path, args.compile_command, args.executable, output_path, not args.exact))
+			except Exception as e:
+				case["error"] = str(e)
+			cases.append(case)
+	finally:
+		shutil.rmtree(database_directory, ignore_errors=True)
+
+	for case in cases:
+		if "error" in case:
+			print(f"{case['results']}/{case['case']}: error: {case['error']}")
+			continue
+		comparison = case["comparison"]
+		print(f"{case['results']}/{case['case']}: {case['status']} (recorded {case['recorded_status']}), {comparison['matched']} matched, {len(comparison['differed'])} differed, {len(comparison['missing'])} missing, {len(comparison['extra'])} extra")
+		for difference in comparison["differed"]:
+			print(f"\t{difference['name']} {difference['key']}:\n{difference['diff']}")
+
+	if args.report:
+		with open(args.report, 'w') as f:
+			f.write(json.dumps(cases, indent=2))
+
+	# Exit with an error if any replay diverged, so replays can gate changes.
+	diverged = [case for case in cases if "error" in case or case["comparison"]["differed"] or case["comparison"]["missing"] or case["status"] != case["recorded_status"]]
+	sys.exit(1 if diverged else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+import concurrent.futures
+from termcolor import colored
+
+def gprint(input_str):
+	print(colored(input_str, 'light_grey'))
+
+def initialize_worker(requests_per_minute, tokens_per_minute, max_concurrent_requests, scratch_root, scratch_size_limit):
+	import rate_limiter
+	import workspace
+
+	rate_limiter.configure(requests_per_minute, tokens_per_minute, max_concurrent_requests)
+	workspace.configure_scratch_root(scratch_root, scratch_size_limit)
+
+def run_logged_session(entry, log_path, arguments):
+	"""
+	Run debug_executable with everything the session prints, including output from lldb and the
+	compiler, redirected to `log_path`.
+
+	:return: A tuple containing the entry, the status returned by debug_executable or 'failed', its duration and the error, if any.
+	"""
+	import debug_program
+
+	start_time = time.time()
+	with open(log_path, 'a') as log:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		saved_descriptors = os.dup(1), os.dup(2)
+		os.dup2(log.fileno(), 1)
+		os.dup2(log.fileno(), 2)
+		try:
+			status = debug_program.debug_executable(*arguments)
+			return entry, status, time.time() - start_time, None
+		except Exception as e:
+			traceback.print_exc()
+			return entry, "failed", time.time() - start_time, f"{type(e).__name__}: {e}"
+		finally:
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os.dup2(saved_descriptors[0], 1)
+			os.dup2(saved_descriptors[1], 2)
+			os.close(saved_descriptors[0])
+			os.close(saved_descriptors[1])
+
+def run_sessions(sessions, jobs, log_directory, requests_per_minute=None, tokens_per_minute=None, max_concurrent_requests=8, scratch_root=None, scratch_size_limit=None, on_started=None, on_finished=None, idle_wait=30):
+	"""
+	Run sessions in a pool of `jobs` worker processes, each with its own lldb instance and workspaces.
+	Every session writes its output to its own log file and only progress is printed here.
+
+	:param sessions: An iterable of (entry, debug_executable arguments) tuples. It is consumed as workers
+	become free, and may yield None when no session is available yet.
+	:param on_started: Called with the entry as each session is handed to a worker.
+	:param on_finished: Called with the entry, its status, its duration and the error, if any, as each session ends.
+	:return: A dictionary mapping the entries that failed to their errors.
+	"""
+	os.makedirs(log_directory, exist_ok=True)
+	# The request and token limits apply to the whole run, so each worker gets an equal share.
+	worker_arguments = (
+		requests_per_minute / jobs if requests_per_minute else None,
+		tokens_per_minute / jobs if tokens_per_minute else None,
+		max_concurrent_requests, scratch_root, scratch_size_limit,
+	)
+	gprint(f"Running sessions in {jobs} processes; logs are in {log_directory}")
+
+	failures = {}
+	finished = 0
+	start_time = time.time()
+	sessions = iter(sessions)
+	exhausted = False
+	# lldb isn't safe to use after a fork, so workers are started fresh.
+	context = multiprocessing.get_context('spawn')
+	with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=initialize_worker, initargs=worker_arguments) as executor:
+		futures = {}
+		try:
+			while futures or not exhausted:
+				while not exhausted and len(futures) < jobs:
+					session = next(sessions, StopIteration)
+					if session is StopIteration:
+						exhausted = True
+					elif session is None:
+						if futures:
+							break
+						time.sleep(idle_wait)
+					else:
+						entry, arguments = session
+						log_path = os.path.join(log_directory, f"{entry}.log")
+						if on_started:
+							on_started(entry)
+						futures[executor.submit(run_logged_session, entry, log_path, arguments)] = entry
+				if not futures:
+					continue
+
+				done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					entry = futures.pop(future)
+					finished += 1
+					try:
+						_, status, duration, error = future.result()
+					except Exception as e:
+						# The worker process died, for example because lldb crashed.
+						status, duration, error = "failed", None, f"{type(e).__name__}: {e}"
+					if status != "failed":
+						# An entry can succeed after an earlier attempt failed when sessions are retried.
+						failures.pop(entry, None)
+						gprint(f"[{finished}] {entry} {status} after {duration:.1f}s")
+					else:
+						failures[entry] = error
+						print(colored(f"[{finished}] {entry} failed: {error}", 'red'))
+					if on_finished:
+						on_finished(entry, status, duration, error)
+		except KeyboardInterrupt:
+			executor.shutdown(wait=False, cancel_futures=True)
+			raise
+
+	gprint(f"Finished {finished} sessions in {time.time() - start_time:.1f}s with {len(failures)} failures")
+	return failures
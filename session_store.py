@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import zlib
+import socket
+import sqlite3
+import hashlib
+import functools
+import threading
+import subprocess
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'generative-debugging')
+DEFAULT_DATABASE_PATH = os.path.join(CACHE_DIR, 'sessions.sqlite3')
+
+# Messages written within this window are never collected, since a concurrent session may not have written the checkpoint that references them yet.
+MESSAGE_GRACE_PERIOD = 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+	id TEXT PRIMARY KEY,
+	test_case TEXT,
+	model TEXT,
+	status TEXT NOT NULL,
+	output_path TEXT,
+	exit_status INTEGER,
+	started_at REAL NOT NULL,
+	updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_test_case ON sessions (test_case);
+CREATE INDEX IF NOT EXISTS sessions_model ON sessions (model);
+CREATE INDEX IF NOT EXISTS sessions_status ON sessions (status);
+
+CREATE TABLE IF NOT EXISTS messages (
+	hash TEXT PRIMARY KEY,
+	codec TEXT NOT NULL,
+	payload BLOB NOT NULL,
+	created_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS checkpoints (
+	id TEXT PRIMARY KEY,
+	session_id TEXT,
+	created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS checkpoints_session_id ON checkpoints (session_id);
+
+CREATE TABLE IF NOT EXISTS checkpoint_messages (
+	checkpoint_id TEXT NOT NULL,
+	position INTEGER NOT NULL,
+	message_hash TEXT NOT NULL,
+	PRIMARY KEY (checkpoint_id, position)
+);
+CREATE INDEX IF NOT EXISTS checkpoint_messages_hash ON checkpoint_messages (message_hash);
+
+CREATE TABLE IF NOT EXISTS runs (
+	test_case TEXT NOT NULL,
+	model TEXT NOT NULL,
+	config_hash TEXT NOT NULL,
+	status TEXT NOT NULL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	started_at REAL,
+	finished_at REAL,
+	duration REAL,
+	output_path TEXT,
+	error TEXT,
+	turns INTEGER,
+	total_tokens INTEGER,
+	owner_host TEXT,
+	owner_pid INTEGER,
+	owner_started TEXT,
+	PRIMARY KEY (test_case, model, config_hash)
+);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (model, config_hash, status);
+
+CREATE TABLE IF NOT EXISTS run_configs (
+	config_hash TEXT PRIMARY KEY,
+	config TEXT NOT NULL,
+	created_at REAL NOT NULL
+);
+"""
+
+# Run statuses that mean a case doesn't need to be run again. Failed runs are only retried on request,
+# runs left 'running' were interrupted, and 'triage_inconclusive' runs timed out or couldn't be run in triage.
+FINISHED_RUN_STATUSES = {"exited", "gave_up", "skipped", "compile_failed", "not_crashing"}
+# Run statuses whose output, if any, is from an attempt that didn't finish and can be discarded when the run starts again.
+UNFINISHED_RUN_STATUSES = {"running", "failed"}
+
+def config_hash(config):
+	"""Hash the settings that affect a run's outcome, given as a JSON-serializable dictionary."""
+	return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=None)
+def _own_start_time(pid):
+	return process_start_time(pid)
+
+def process_start_time(pid):
+	"""Return when a process started, as reported by ps, or None if there is no such process."""
+	try:
+		result = subprocess.run(["ps", "-o", "lstart=", "-p", str(pid)], capture_output=True, text=True)
+	except OSError:
+		return None
+	if result.returncode != 0:
+		return None
+	return result.stdout.strip() or None
+
+def current_owner():
+	"""Return the host, process id and process start time that identify this process as the owner of a run."""
+	return socket.gethostname(), os.getpid(), _own_start_time(os.getpid())
+
+def owner_is_running(host, pid, started):
+	"""
+	Return whether the process that owns a run may still be running it. Processes on other hosts can't be
+	checked, so they're assumed to be running. Runs recorded without an owner predate owners and are never live.
+	"""
+	if host is None or pid is None:
+		return False
+	if host != socket.gethostname():
+		return True
+	if started is None:
+		try:
+			os.kill(pid, 0)
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			pass
+		return True
+	# The start time tells a reused process id apart from the owner.
+	return process_start_time(pid) == started
+
+def compress(data):
+	"""
+	Compress with zstd when the zstandard package is installed, and with zlib otherwise.
+
+	:return: A tuple containing the codec name and the compressed data.
+	"""
+	try:
+		import zstandard
+	except ImportError:
+		return "zlib", zlib.compress(data, 6)
+	return "zstd", zstandard.ZstdCompressor(level=3).compress(data)
+
+def decompress(codec, payload):
+	if codec == "zstd":
+		import zstandard
+		return zstandard.ZstdDecompressor().decompress(payload)
+	if codec == "zlib":
+		return zlib.decompress(payload)
+	return payload
+
+class SessionStore:
+	"""
+	Sessions, messages and checkpoints in a SQLite database. Each message is stored once by the hash
+	of its contents, so a checkpoint is only the ordered list of its message hashes. The database uses
+	write-ahead logging so that sessions in other threads and processes can write at the same time.
+	"""
+	def __init__(self, path=DEFAULT_DATABASE_PATH):
+		self.path = path
+		self._local = threading.local()
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.connection().executescript(SCHEMA)
+		self.add_missing_columns("runs", {"turns": "INTEGER", "total_tokens": "INTEGER", "owner_host": "TEXT", "owner_pid": "INTEGER", "owner_started": "TEXT"})
+
+	def connection(self):
+		# sqlite3 connections can't be shared between threads or forked processes, so each thread opens its own.
+		if getattr(self._local, 'pid', None) != os.getpid():
+			connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+			connection.execute("PRAGMA journal_mode=WAL")
+			connection.execute("PRAGMA synchronous=NORMAL")
+			self._local.connection = connection
+			self._local.pid = os.getpid()
+		return self._local.connection
+
+	def add_missing_columns(self, table, columns):
+		"""Add columns that were introduced after a database was created."""
+		connection = self.connection()
+		existing = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+		for column, column_type in columns.items():
+			if column not in existing:
+				connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+	def store_checkpoint(self, checkpoint_id, messages, session_id=None):
+		"""Store a list of messages under checkpoint_id, replacing any checkpoint with the same identifier."""
+		now = time.time()
+		rows = []
+		message_hashes = []
+		for message in messages:
+			data = json.dumps(message, sort_keys=True, separators=(',', ':')).encode()
+			message_hash = hashlib.sha256(data).hexdigest()
+			message_hashes.append(message_hash)
+			rows.append((message_hash, data))
+
+		connection = self.connection()
+		with connection:
+			connection.execute("BEGIN IMMEDIATE")
+			known_hashes = set()
+			for start in range(0, len(message_hashes), 500):
+				chunk = message_hashes[start:start + 500]
+				known_hashes.update(row[0] for row in connection.execute(f"SELECT hash FROM messages WHERE hash IN ({','.join('?' * len(chunk))})", chunk))
+			for message_hash, data in rows:
+				if message_hash in known_hashes:
+					continue
+				codec, payload = compress(data)
+				connection.execute("INSERT OR IGNORE INTO messages (hash, codec, payload, created_at) VALUES (?, ?, ?, ?)", (message_hash, codec, payload, now))
+				known_hashes.add(message_hash)
+			connection.execute("INSERT OR REPLACE INTO checkpoints (id, session_id, created_at) VALUES (?, ?, ?)", (checkpoint_id, session_id, now))
+			connection.execute("DELETE FROM checkpoint_messages WHERE checkpoint_id = ?", (checkpoint_id,))
+			connection.executemany("INSERT INTO checkpoint_messages (checkpoint_id, position, message_hash) VALUES (?, ?, ?)",
+				[(checkpoint_id, position, message_hash) for position, message_hash in enumerate(message_hashes)])
+
+	def retrieve_checkpoint(self, checkpoint_id):
+		"""Return the messages stored under checkpoint_id, or None if there is no such checkpoint."""
+		connection = self.connection()
+		if connection.execute("SELECT 1 FROM checkpoints WHERE id = ?", (checkpoint_id,)).fetchone() is None:
+			return None
+		rows = connection.execute("""
+			SELECT messages.codec, messages.payload FROM checkpoint_messages
+			JOIN messages ON messages.hash = checkpoint_messages.message_hash
+			WHERE checkpoint_messages.checkpoint_id = ? ORDER BY checkpoint_messages.position""", (checkpoint_id,))
+		return [json.loads(decompress(codec, payload)) for codec, payload in rows]
+
+	def start_session(self, session_id, test_case=None, model=None, output_path=None):
+		now = time.time()
+		with self.connection() as connection:
+			connection.execute("INSERT OR REPLACE INTO sessions (id, test_case, model, status, output_path, started_at, updated_at) VALUES (?, ?, ?, 'running', ?, ?, ?)",
+				(session_id, test_case, model, output_path, now, now))
+
+	def update_session(self, session_id, status, exit_status=None):
+		with self.connection() as connection:
+			connection.execute("UPDATE sessions SET status = ?, exit_status = ?, updated_at = ? WHERE id = ?", (status, exit_status, time.time(), session_id))
+
+	def find_sessions(self, test_case=None, model=None, status=None):
+		"""Return the sessions matching every given filter as dictionaries, oldest first."""
+		filters = [(column, value) for column, value in [("test_case", test_case), ("model", model), ("status", status)] if value is not None]
+		where = f"WHERE {' AND '.join(f'{column} = ?' for column, _ in filters)}" if filters else ""
+		cursor = self.connection().execute(f"SELECT * FROM sessions {where} ORDER BY started_at", [value for _, value in filters])
+		columns = [description[0] for description in cursor.description]
+		return [dict(zip(columns, row)) for row in cursor]
+
+	def start_run(self, test_case, model, config_hash, output_path=None):
+		"""Record that this process started a run, so that other processes can tell whether it's still running."""
+		with self.connection() as connection:
+			connection.execute("""
+				INSERT INTO runs (test_case, model, config_hash, status, attempts, started_at, output_path, owner_host, owner_pid, owner_started) VALUES (?, ?, ?, 'running', 1, ?, ?, ?, ?, ?)
+				ON CONFLICT (test_case, model, config_hash) DO UPDATE SET status = 'running', attempts = attempts + 1,
+				started_at = excluded.started_at, finished_at = NULL, duration = NULL, output_path = excluded.output_path, error = NULL,
+				owner_host = excluded.owner_host, owner_pid = excluded.owner_pid, owner_started = excluded.owner_started""",
+				(test_case, model, config_hash, time.time(), output_path, *current_owner()))
+
+	def finish_run(self, test_case, model, config_hash, status, duration=None, error=None, turns=None, total_tokens=None):
+		"""Record how a run ended. Cases that never started, like those that failed to compile, are recorded too."""
+		with self.connection() as connection:
+			connection.execute("""
+				INSERT INTO runs (test_case, model, config_hash, status, finished_at, duration, error, turns, total_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+				ON CONFLICT (test_case, model, config_hash) DO UPDATE SET status = excluded.status, finished_at = excluded.finished_at,
+				duration = excluded.duration, error = excluded.error, turns = excluded.turns, total_tokens = excluded.total_tokens""",
+				(test_case, model, config_hash, status, time.time(), duration, error, turns, total_tokens))
+
+	def run_statuses(self, model, config_hash):
+		"""Return a dictionary mapping each test case recorded for a model and configuration to its run status."""
+		return dict(self.connection().execute("SELECT test_case, status FROM runs WHERE model = ? AND config_hash = ?", (model, config_hash)))
+
+	def live_runs(self, model, config_hash):
+		"""Return a dictionary mapping each test case with a 'running' run whose owner may still be running it to the owner's host and process id."""
+		rows = self.connection().execute("SELECT test_case, owner_host, owner_pid, owner_started FROM runs WHERE model = ? AND config_hash = ? AND status = 'running'", (model, config_hash))
+		return {test_case: (host, pid) for test_case, host, pid, started in rows if owner_is_running(host, pid, started)}
+
+	def record_config(self, config_hash, config):
+		"""Store the settings behind a configuration hash, so that runs can be told apart by what they changed."""
+		with self.connection() as connection:
+			connection.execute("INSERT OR IGNORE INTO run_configs (config_hash, config, created_at) VALUES (?, ?, ?)", (config_hash, json.dumps(config, sort_keys=True), time.time()))
+
+	def retrieve_config(self, config_hash):
+		row = self.connection().execute("SELECT config FROM run_configs WHERE config_hash = ?", (config_hash,)).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def runs_finished_since(self, model, config_hash, since):
+		"""Return the runs for a model and configuration that finished at or after `since`, as dictionaries."""
+		cursor = self.connection().execute("SELECT * FROM runs WHERE model = ? AND config_hash = ? AND finished_at >= ?", (model, config_hash, since))
+		columns = [description[0] for description in cursor.description]
+		return [dict(zip(columns, row)) for row in cursor]
+
+	def collect_garbage(self, max_checkpoint_age=None):
+		"""
+		Delete messages that are no longer referenced by any checkpoint.
+
+		:param max_checkpoint_age: If set, checkpoints older than this many seconds are deleted first.
+		:return: A tuple containing the number of checkpoints and messages deleted.
+		"""
+		now = time.time()
+		connection = self.connection()
+		with connection:
+			connection.execute("BEGIN IMMEDIATE")
+			deleted_checkpoints = 0
+			if max_checkpoint_age is not None:
+				deleted_checkpoints = connection.execute("DELETE FROM checkpoints WHERE created_at < ?", (now - max_checkpoint_age,)).rowcount
+				connection.execute("DELETE FROM checkpoint_messages WHERE checkpoint_id NOT IN (SELECT id FROM checkpoints)")
+			deleted_messages = connection.execute("""
+				DELETE FROM messages WHERE created_at < ?
+				AND NOT EXISTS (SELECT 1 FROM checkpoint_messages WHERE checkpoint_messages.message_hash = messages.hash)""",
+				(now - MESSAGE_GRACE_PERIOD,)).rowcount
+		return deleted_checkpoints, deleted_messages
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+def shared_store():
+	"""Return the store at the path in GENERATIVE_DEBUGGING_DATABASE, or the default path, opening it on first use."""
+	global _shared_store
+	with _shared_store_lock:
+		if _shared_store is None:
+			_shared_store = SessionStore(os.environ.get('GENERATIVE_DEBUGGING_DATABASE', DEFAULT_DATABASE_PATH))
+		return _shared_store
@@ -0,0 +1,224 @@
+import os
+import stat
+import time
+import zlib
+import struct
+import hashlib
+import threading
+
+# Used for commits when the usual git environment variables aren't set.
+DEFAULT_IDENTITY = ("GenerativeDebugging", "generative-debugging@localhost")
+
+class SnapshotRepository:
+	"""
+	Records snapshots of a working directory as commits in a real git repository by writing git
+	objects, refs and the index directly, without running git. A stat cache means that only files
+	that changed since the last snapshot are read and hashed.
+	"""
+	def __init__(self, directory, branch="master"):
+		self.directory = directory
+		self.git_dir = os.path.join(directory, '.git')
+		self.branch = branch
+		self.head = None
+		# The files in the last commit, mapping relative paths to (mode, sha).
+		self.tracked = {}
+		# Maps relative paths to ((mtime_ns, size, inode, mode), sha) for files whose hash is known.
+		self._stat_cache = {}
+		self._lock = threading.Lock()
+		if os.path.exists(os.path.join(self.git_dir, 'HEAD')):
+			self.load()
+
+	def initialize(self):
+		for subdirectory in ['objects', os.path.join('refs', 'heads'), os.path.join('refs', 'tags')]:
+			os.makedirs(os.path.join(self.git_dir, subdirectory), exist_ok=True)
+		self.write_file(os.path.join(self.git_dir, 'HEAD'), f"ref: refs/heads/{self.branch}\n".encode())
+		self.write_file(os.path.join(self.git_dir, 'config'), b"[core]\n\trepositoryformatversion = 0\n\tfilemode = true\n\tbare = false\n")
+
+	def write_file(self, path, data):
+		temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		with open(temp_path, 'wb') as f:
+			f.write(data)
+		os.replace(temp_path, path)
+
+	def object_path(self, sha):
+		return os.path.join(self.git_dir, 'objects', sha[:2], sha[2:])
+
+	def write_object(self, object_type, data, write=True):
+		store = f"{object_type} {len(data)}\0".encode() + data
+		sha = hashlib.sha1(store).hexdigest()
+		path = self.object_path(sha)
+		if write and not os.path.exists(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			self.write_file(path, zlib.compress(store, 1))
+		return sha
+
+	def read_object(self, sha):
+		with open(self.object_path(sha), 'rb') as f:
+			store = zlib.decompress(f.read())
+		header, data = store.split(b'\0', 1)
+		return header.split(b' ')[0].decode(), data
+
+	def load(self):
+		"""Read the branch head and the files it contains from an existing repository."""
+		ref_path = os.path.join(self.git_dir, 'refs', 'heads', self.branch)
+		if not os.path.exists(ref_path):
+			return
+		with open(ref_path, 'r') as f:
+			self.head = f.read().strip()
+		_, commit = self.read_object(self.head)
+		tree_sha = commit.split(b'\n', 1)[0].split(b' ')[1].decode()
+		self.tracked = {}
+		self.read_tree(tree_sha, "")
+
+	def read_tree(self, tree_sha, prefix):
+		_, data = self.read_object(tree_sha)
+		position = 0
+		while position < len(data):
+			name_end = data.index(b'\0', position)
+			mode, name = data[position:name_end].decode().split(' ', 1)
+			sha = data[name_end + 1:name_end + 21].hex()
+			position = name_end + 21
+			path = f"{prefix}{name}"
+			if mode == '40000':
+				self.read_tree(sha, f"{path}/")
+			else:
+				self.tracked[path] = (mode, sha)
+
+	def scan(self, write_blobs=True):
+		"""
+		Hash every file in the working directory, reusing cached hashes for files whose stat is unchanged.
+		Unless `write_blobs` is False, the contents of new and changed files are stored as blobs.
+
+		:return: A dictionary mapping relative paths to (mode, sha) and one mapping them to their stat results.
+		"""
+		entries = {}
+		stats = {}
+		for root, dirs, files in os.walk(self.directory):
+			if root == self.directory and '.git' in dirs:
+				dirs.remove('.git')
+			for file in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+				full_path = os.path.join(root, file)
+				relative_path = os.path.relpath(full_path, self.directory).replace(os.sep, '/')
+				file_stat = os.lstat(full_path)
+				stats[relative_path] = file_stat
+				if stat.S_ISLNK(file_stat.st_mode):
+					mode = '120000'
+				elif file_stat.st_mode & stat.S_IXUSR:
+					mode = '100755'
+				else:
+					mode = '100644'
+
+				key = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino, mode)
+				cached = self._stat_cache.get(relative_path)
+				if cached and cached[0] == key:
+					sha = cached[1]
+				else:
+					if mode == '120000':
+						data = os.readlink(full_path).encode()
+					else:
+						with open(full_path, 'rb') as f:
+							data = f.read()
+					sha = self.write_object('blob', data, write=write_blobs)
+					if write_blobs:
+						self._stat_cache[relative_path] = (key, sha)
+				entries[relative_path] = (mode, sha)
+		return entries, stats
+
+	def write_tree(self, entries):
+		children = {}
+		for path, (mode, sha) in entries.items():
+			name, separator, rest = path.partition('/')
+			if separator:
+				children.setdefault(name, {})[rest] = (mode, sha)
+			else:
+				children[name] = (mode, sha)
+
+		# git sorts tree entries as if directory names ended with a slash.
+		def sort_key(name):
+			return name + '/' if isinstance(children[name], dict) else name
+
+		data = b''
+		for name in sorted(children, key=sort_key):
+			child = children[name]
+			if isinstance(child, dict):
+				data += f"40000 {name}\0".encode() + bytes.fromhex(self.write_tree(child))
+			else:
+				data += f"{child[0]} {name}\0".encode() + bytes.fromhex(child[1])
+		return self.write_object('tree', data)
+
+	def write_index(self, entries, stats):
+		"""Write a version 2 index matching the commit, so that git sees a clean working tree."""
+		body = b''
+		paths = sorted(entries, key=lambda path: path.encode())
+		for path in paths:
+			mode, sha = entries[path]
+			file_stat = stats[path]
+			name = path.encode()
+			fields = [int(file_stat.st_ctime), file_stat.st_ctime_ns % 1000000000, int(file_stat.st_mtime), file_stat.st_mtime_ns % 1000000000,
+				file_stat.st_dev, file_stat.st_ino, int(mode, 8), file_stat.st_uid, file_stat.st_gid, file_stat.st_size]
+			entry = struct.pack('>10I', *[field & 0xFFFFFFFF for field in fields]) + bytes.fromhex(sha) + struct.pack('>H', min(len(name), 0xFFF)) + name
+			# Entries are NUL-padded to a multiple of eight bytes, with at least one NUL.
+			entry += b'\0' * (8 - len(entry) % 8)
+			body += entry
+		index = b'DIRC' + struct.pack('>II', 2, len(paths)) + body
+		self.write_file(os.path.join(self.git_dir, 'index'), index + hashlib.sha1(index).digest())
+
+	def commit(self, message):
+		"""
+		Snapshot the working directory.
+
+		:return: The new commit's sha, or None if nothing changed since the last commit.
+		"""
+		with self._lock:
+			entries, stats = self.scan()
+			if self.head is not None and entries == self.tracked:
+				return None
+
+			tree_sha = self.write_tree(entries)
+			name = os.environ.get('GIT_AUTHOR_NAME', DEFAULT_IDENTITY[0])
+			email = os.environ.get('GIT_AUTHOR_EMAIL', DEFAULT_IDENTITY[1])
+			signature = f"{name} <{email}> {int(time.time())} +0000"
+			parent = f"parent {self.head}\n" if self.head else ""
+			commit_data = f"tree {tree_sha}\n{parent}author {signature}\ncommitter {signature}\n\n{message}\n".encode()
+			self.head = self.write_object('commit', commit_data)
+			self.tracked = entries
+
+			self.write_file(os.path.join(self.git_dir, 'refs', 'heads', self.branch), f"{self.head}\n".encode())
+			self.write_index(entries, stats)
+			return self.head
+
+	def reset(self):
+		"""Restore every tracked file that changed since the last commit. Untracked files are left alone."""
+		with self._lock:
+			current, _ = self.scan(write_blobs=False)
+			for path, (mode, sha) in self.tracked.items():
+				if current.get(path) == (mode, sha):
+					continue
+				full_path = os.path.join(self.directory, path)
+				_, data = self.read_object(sha)
+				if os.path.lexists(full_path):
+					os.remove(full_path)
+				os.makedirs(os.path.dirname(full_path), exist_ok=True)
+				if mode == '120000':
+					os.symlink(data.decode(), full_path)
+				else:
+					with open(full_path, 'wb') as f:
+						f.write(data)
+					os.chmod(full_path, 0o755 if mode == '100755' else 0o644)
+				self._stat_cache.pop(path, None)
+
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+def repository_for(directory):
+	"""Return the repository for a working directory, shared so that its stat cache is reused."""
+	directory = os.path.abspath(directory)
+	with _repositories_lock:
+		if directory not in _repositories:
+			_repositories[directory] = SnapshotRepository(directory)
+		return _repositories[directory]
+
+def release_repository(directory):
+	"""Forget the in-memory state for a working directory that is about to be moved or deleted."""
+	with _repositories_lock:
+		_repositories.pop(os.path.abspath(directory), None)
@@ -0,0 +1,304 @@
+import os
+import shutil
+import threading
+import tracing
+
+class SourceBuffer:
+	"""
+	The contents of a source file along with the offset at which each line starts, so that any
+	range of lines can be sliced out without splitting the whole file.
+	"""
+	def __init__(self, text):
+		self.text = text
+		self.line_offsets = [0]
+		position = text.find('\n')
+		# Lines added by edits use the file's own line ending, so that editing a CRLF file doesn't rewrite every line.
+		self.newline = '\r\n' if position > 0 and text[position - 1] == '\r' else '\n'
+		while position != -1:
+			self.line_offsets.append(position + 1)
+			position = text.find('\n', position + 1)
+		if self.line_offsets[-1] == len(text) and len(self.line_offsets) > 1:
+			# A trailing newline terminates the last line rather than starting a new one.
+			self.line_offsets.pop()
+
+	@classmethod
+	def load(cls, path):
+		# Line endings are kept as they are in the file.
+		with open(path, 'r', newline='') as f:
+			return cls(f.read())
+
+	@property
+	def line_count(self):
+		return len(self.line_offsets) if self.text else 0
+
+	def line_range_text(self, start, end):
+		"""Return the text of lines [start, end), zero-indexed, including line endings."""
+		start = max(0, min(start, self.line_count))
+		end = max(start, min(end, self.line_count))
+		start_offset = self.line_offsets[start] if start < self.line_count else len(self.text)
+		end_offset = self.line_offsets[end] if end < self.line_count else len(self.text)
+		return self.text[start_offset:end_offset]
+
+	def numbered_window(self, line_number, context_lines):
+		"""
+		Return the lines within `context_lines` of the one-indexed `line_number`, each prefixed with its line number.
+		Only the lines in the window are read.
+		"""
+		if line_number < 1 or line_number > self.line_count:
+			return None
+		start = max(0, line_number - 1 - context_lines)
+		end = min(self.line_count, line_number + context_lines)
+		return "\n".join(f"{start + i + 1}: {line}" for i, line in enumerate(self.lines(start, end)))
+
+	def lines(self, start, end):
+		"""Return lines [start, end), zero-indexed, without line endings."""
+		text = self.line_range_text(start, end)
+		if text.endswith('\n'):
+			text = text[:-1]
+		return [line[:-1] if line.endswith('\r') else line for line in text.split('\n')] if text else []
+
+	def validate_changes(self, changes):
+		"""
+		Check that each change is well formed, that its from-file-range matches the file (ignoring
+		leading and trailing whitespace) and that no two changes overlap.
+		"""
+		claimed_ranges = []
+		for change in changes:
+			if not "from-file-range" in change:
+				return False, "from-file-range is missing"
+			from_range = change["from-file-range"]
+			if not "start-line" in from_range:
+				return False, "start-line is missing in from-file-range"
+			if not "code" in from_range:
+				return False, "code is missing in from-file-range"
+
+			if not "to-file-range" in change:
+				return False, "to-file-range missing"
+			to_range = change["to-file-range"]
+			if not "start-line" in to_range:
+				return False, "start-line is missing in to-file-range"
+			if not "code" in to_range:
+				return False, "code is missing in to-file-range"
+
+			start_line = from_range["start-line"] - 1
+			expected_lines = [line.strip() for line in from_range["code"].splitlines()]
+			extracted_lines = [line.strip() for line in self.lines(start_line, start_line + len(expected_lines))]
+
+			# Direct line-by-line comparison
+			if start_line < 0 or extracted_lines != expected_lines:
+				error_message = "Mismatch starting at line {}. Expected: '{}' but found: '{}'".format(
+					start_line + 1, "\n".join(expected_lines), "\n".join(extracted_lines))
+				return False, error_message
+
+			claimed_ranges.append((start_line, start_line + len(expected_lines)))
+
+		# An insertion (an empty from-file-range) that touches another change's range could go before or after it, so it is rejected too.
+		claimed_ranges.sort()
+		for index, (start_line, end_line) in enumerate(claimed_ranges):
+			for other_start, other_end in claimed_ranges[index + 1:]:
+				if start_line == end_line or other_start == other_end:
+					overlaps = start_line <= other_end and other_start <= end_line
+				else:
+					overlaps = start_line < other_end and other_start < end_line
+				if overlaps:
+					return False, f"The change starting at line {other_start + 1} overlaps the change starting at line {start_line + 1}"
+
+		return True, "Changes are valid"
+
+	def apply_changes(self, changes):
+		"""
+		Apply validated changes, whose from-file-ranges refer to lines in this buffer, and return
+		the resulting text along with the hunks as (start, end, replacement lines) tuples.
+		"""
+		hunks = []
+		for change in changes:
+			start_line = change["from-file-range"]["start-line"] - 1
+			end_line = start_line + len(change["from-file-range"]["code"].splitlines())
+			hunks.append((start_line, end_line, change["to-file-range"]["code"].splitlines()))
+		hunks.sort(key=lambda hunk: (hunk[0], hunk[1]))
+
+		pieces = []
+		position = 0
+		for start_line, end_line, replacement in hunks:
+			if start_line > position:
+				pieces.append(self.line_range_text(position, start_line))
+			if replacement:
+				if pieces and pieces[-1] and not pieces[-1].endswith('\n'):
+					# Lines added after a last line without a newline need one in between.
+					pieces[-1] += self.newline
+				replaced_text = self.line_range_text(start_line, end_line)
+				# Keep the file's lack of a trailing newline if the last line is being replaced.
+				newline = self.newline if end_line < self.line_count or not replaced_text or replaced_text.endswith('\n') else ''
+				pieces.append(self.newline.join(replacement) + newline)
+			# Validation rules out overlapping hunks, but never step back and write lines twice.
+			position = max(position, end_line)
+		pieces.append(self.line_range_text(position, self.line_count))
+		return ''.join(pieces), hunks
+
+	def unified_diff(self, file_path, hunks, new_text, context_lines=3):
+		"""
+		Format hunks produced by apply_changes as a unified diff, reading only the lines around each hunk.
+		`new_text` is the text apply_changes returned, which decides whether the new file ends with a newline.
+		"""
+		# Group hunks whose context would overlap into a single diff hunk.
+		groups = []
+		for hunk in hunks:
+			if groups and hunk[0] - groups[-1][-1][1] <= 2 * context_lines:
+				groups[-1].append(hunk)
+			else:
+				groups.append([hunk])
+
+		# Like diff, mark the last line of a file that doesn't end with a newline.
+		old_last_line = self.line_count - 1 if self.text and not self.text.endswith('\n') else None
+		new_line_count = self.line_count + sum(len(replacement) - (end_line - start_line) for start_line, end_line, replacement in hunks)
+		new_last_line = new_line_count - 1 if new_text and not new_text.endswith('\n') else None
+		no_newline = "\\ No newline at end of file"
+
+		output = [f"--- {file_path}", f"+++ {file_path}"]
+		line_delta = 0
+		for group in groups:
+			group_start = max(0, group[0][0] - context_lines)
+			group_end = min(self.line_count, group[-1][1] + context_lines)
+			body = []
+			position = group_start
+			new_position = group_start + line_delta
+			old_count = new_count = 0
+
+			def add_context(start, end):
+				nonlocal new_position
+				for offset, line in enumerate(self.lines(start, end)):
+					old_line, new_line = start + offset, new_position
+					new_position += 1
+					if (old_line == old_last_line) != (new_line == new_last_line):
+						# Only the line ending changed, so the line is removed and added again.
+						body.append(f"-{line}")
+						if old_line == old_last_line:
+							body.append(no_newline)
+						body.append(f"+{line}")
+						if new_line == new_last_line:
+							body.append(no_newline)
+					else:
+						body.append(f" {line}")
+						if old_line == old_last_line:
+							body.append(no_newline)
+
+			for start_line, end_line, replacement in group:
+				add_context(position, start_line)
+				for offset, line in enumerate(self.lines(start_line, end_line)):
+					body.append(f"-{line}")
+					if start_line + offset == old_last_line:
+						body.append(no_newline)
+				for line in replacement:
+					body.append(f"+{line}")
+					if new_position == new_last_line:
+						body.append(no_newline)
+					new_position += 1
+				old_count += end_line - position
+				new_count += start_line - position + len(replacement)
+				position = end_line
+			add_context(position, group_end)
+			old_count += group_end - position
+			new_count += group_end - position
+
+			old_start = group_start + 1 if old_count else group_start
+			new_start = group_start + line_delta + 1 if new_count else group_start + line_delta
+			output.append(f"@@ -{old_start},{old_count} +{new_start},{new_count} @@")
+			output.extend(body)
+			line_delta += new_count - old_count
+		return "\n".join(output)
+
+class SourceCache:
+	"""
+	Buffers for the files of one workspace. A buffer is reused until the file's mtime, size or inode
+	changes, so repeated reads of an unchanged file don't touch its contents.
+	"""
+	def __init__(self):
+		self._entries = {}
+		self._lock = threading.Lock()
+
+	def get(self, path):
+		file_stat = os.stat(path)
+		key = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+		with self._lock:
+			entry = self._entries.get(path)
+			if entry is not None and entry[0] == key:
+				return entry[1]
+		buffer = SourceBuffer.load(path)
+		with self._lock:
+			self._entries[path] = (key, buffer)
+		return buffer
+
+	def invalidate(self, path):
+		with self._lock:
+			self._entries.pop(path, None)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def cache_for(working_directory):
+	working_directory = os.path.abspath(working_directory)
+	with _caches_lock:
+		if working_directory not in _caches:
+			_caches[working_directory] = SourceCache()
+		return _caches[working_directory]
+
+def release_cache(working_directory):
+	with _caches_lock:
+		_caches.pop(os.path.abspath(working_directory), None)
+
+def get_buffer(working_directory, file_path):
+	"""Return the cached buffer for a file in a workspace, or None if it can't be read."""
+	try:
+		return cache_for(working_directory).get(os.path.join(working_directory, file_path))
+	except (OSError, UnicodeDecodeError) as e:
+		print(e)
+		return None
+
+class SourceEdit:
+	"""
+	A validated set of changes to one file, ready to be written.
+	"""
+	def __init__(self, working_directory, file_path, changes, context_lines=3):
+		self.working_directory = working_directory
+		self.file_path = file_path
+		self.full_path = os.path.join(working_directory, file_path)
+		self.changes = changes
+		self.context_lines = context_lines
+		self.prepare(cache_for(working_directory).get(self.full_path))
+
+	def prepare(self, buffer):
+		self.buffer = buffer
+		self.valid, self.message = buffer.validate_changes(self.changes)
+		if self.valid:
+			self.new_text, hunks = buffer.apply_changes(self.changes)
+			# The diff is only used for logging and for showing the model what was applied.
+			self.diff = buffer.unified_diff(self.file_path, hunks, self.new_text, self.context_lines)
+
+	@tracing.traced("patch")
+	def apply(self):
+		"""
+		Write the changed file atomically, keeping its permissions. Edits are prepared before any of a
+		turn's commands run, so if an earlier command changed the file, the changes are checked against
+		its current contents first.
+		"""
+		try:
+			current = cache_for(self.working_directory).get(self.full_path)
+		except (OSError, UnicodeDecodeError) as e:
+			return False, str(e)
+		if current.text != self.buffer.text:
+			self.prepare(current)
+			if not self.valid:
+				return False, f"The file changed after this edit was prepared, and the edit no longer applies: {self.message}"
+
+		temp_path = f"{self.full_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		try:
+			with open(temp_path, 'w', newline='') as f:
+				f.write(self.new_text)
+			shutil.copymode(self.full_path, temp_path)
+			os.replace(temp_path, self.full_path)
+			cache_for(self.working_directory).invalidate(self.full_path)
+		except OSError as e:
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+			return False, str(e)
+		return True, None
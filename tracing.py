@@ -0,0 +1,49 @@
+import time
+import functools
+import threading
+import contextlib
+
+# Exclusive time per phase: the time spent inside a phase that is nested in another counts only
+# towards the inner phase.
+_totals = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+@contextlib.contextmanager
+def phase(name):
+	"""Time a block of code as part of the named phase, like 'launch', 'command', 'patch', 'compile', 'git' or 'serialization'."""
+	stack = getattr(_local, 'stack', None)
+	if stack is None:
+		stack = _local.stack = []
+	frame = [name, time.perf_counter(), 0.0]
+	stack.append(frame)
+	try:
+		yield
+	finally:
+		stack.pop()
+		elapsed = time.perf_counter() - frame[1]
+		if stack:
+			stack[-1][2] += elapsed
+		with _lock:
+			total = _totals.setdefault(name, [0.0, 0])
+			total[0] += elapsed - frame[2]
+			total[1] += 1
+
+def reset():
+	with _lock:
+		_totals.clear()
+
+def snapshot():
+	"""Return a dictionary mapping each phase to its total exclusive time in seconds and the number of times it ran."""
+	with _lock:
+		return {name: {"seconds": seconds, "count": count} for name, (seconds, count) in _totals.items()}
+
+def traced(name):
+	"""Decorate a function so that every call to it is timed as part of the named phase."""
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			with phase(name):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
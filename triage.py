@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import signal
+import hashlib
+import subprocess
+import concurrent.futures
+import file_utilities
+import prebuild
+import workspace
+from termcolor import colored
+
+TRIAGE_MANIFEST_FILE_NAME = "triage.json"
+
+def gprint(input_str):
+	print(colored(input_str, 'light_grey'))
+
+def native_environment():
+	environment = dict(os.environ)
+	if sys.platform == 'darwin':
+		# Sessions launch programs with guard malloc, which turns many heap overflows into crashes.
+		environment["DYLD_INSERT_LIBRARIES"] = "/usr/lib/libgmalloc.dylib"
+	return environment
+
+def summarize_stderr(stderr, max_lines=5, max_characters=500):
+	lines = [line for line in stderr.splitlines() if line.strip()]
+	return "\n".join(lines[-max_lines:])[-max_characters:]
+
+def cache_key(executable, environment):
+	"""Hash how a program is run, so that a cached result is only reused for the same executable, arguments and environment."""
+	invocation = {"command": [executable], "environment": sorted(environment.items())}
+	return hashlib.sha256(json.dumps(invocation).encode()).hexdigest()
+
+def run_native(executable_path, working_directory, timeout, environment=None):
+	"""
+	Run a program without the debugger, in the given environment or the native one.
+
+	:return: A dictionary with the status, which is 'crashed' if the program was killed by a signal,
+	'exited' if it exited, or 'timeout', along with the exit status or signal and a summary of stderr.
+	"""
+	start_time = time.time()
+	try:
+		result = subprocess.run([executable_path], cwd=working_directory, env=environment or native_environment(), stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+	except subprocess.TimeoutExpired:
+		return {"status": "timeout", "duration": timeout}
+	except OSError as e:
+		return {"status": "error", "error": str(e)}
+
+	triage_result = {"duration": time.time() - start_time, "stderr": summarize_stderr(result.stderr.decode(errors='replace'))}
+	if result.returncode < 0:
+		try:
+			signal_name = signal.Signals(-result.returncode).name
+		except ValueError:
+			signal_name = str(-result.returncode)
+		triage_result.update({"status": "crashed", "signal": signal_name})
+	else:
+		triage_result.update({"status": "exited", "exit_status": result.returncode})
+	return triage_result
+
+def triage(code_path, compile_command, executable, timeout, build_directory=None):
+	"""
+	Run a program's cached build natively, building it first if needed. Results are cached next to the
+	build, so a program is only run again if its sources, the way it is run or its environment change,
+	or the timeout is longer.
+	"""
+	if build_directory is None:
+		build_directory, record = prebuild.build(code_path, compile_command)
+		if record["returncode"] != 0:
+			return {"status": "compile_failed", "stderr": summarize_stderr(record["stderr"])}
+
+	environment = native_environment()
+	cache_path = os.path.join(build_directory, f"triage-{cache_key(executable, environment)}.json")
+	try:
+		with open(cache_path, 'r') as f:
+			cached = json.load(f)
+		if cached["status"] != "timeout" or cached["timeout"] >= timeout:
+			return cached
+	except (OSError, ValueError, KeyError):
+		pass
+
+	# Run in a workspace, since programs may write files into their working directory.
+	triage_workspace = workspace.create(code_path)
+	try:
+		prebuild.restore(build_directory, triage_workspace.path)
+		triage_result = run_native(os.path.join(triage_workspace.path, executable), triage_workspace.path, timeout, environment)
+	finally:
+		triage_workspace.cleanup()
+	triage_result["timeout"] = timeout
+	if triage_result["status"] != "error":
+		file_utilities.write_atomically(cache_path, json.dumps(triage_result).encode())
+	return triage_result
+
+def run_status(triage_result):
+	"""
+	Return the run status to record for a program that won't be debugged, or None if it crashed. Programs
+	that timed out or couldn't be run aren't known not to crash, so their status doesn't count as finished.
+	"""
+	if triage_result["status"] == "crashed":
+		return None
+	if triage_result["status"] == "exited":
+		return "not_crashing"
+	if triage_result["status"] == "compile_failed":
+		return "compile_failed"
+	return "triage_inconclusive"
+
+def triage_all(cases, compile_command, executable, manifest_directory, timeout=10, jobs=None, builds=None):
+	"""
+	Triage every case in parallel and record the results in a manifest, merged with those of earlier runs.
+
+	:param cases: A dictionary mapping case names to the directories containing their code.
+	:param builds: An optional dictionary mapping case names to build directories from prebuild.prebuild_all.
+	:return: A dictionary mapping each case name to its triage result.
+	"""
+	builds = builds or {}
+	jobs = jobs or os.cpu_count()
+	gprint(f"Triaging {len(cases)} programs with {jobs} jobs…")
+	manifest = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		futures = {executor.submit(triage, code_path, compile_command, executable, timeout, builds.get(case_name)): case_name for case_name, code_path in cases.items()}
+		for future in concurrent.futures.as_completed(futures):
+			case_name = futures[future]
+			try:
+				manifest[case_name] = future.result()
+			except OSError as e:
+				manifest[case_name] = {"status": "error", "error": str(e)}
+
+	counts = {}
+	for triage_result in manifest.values():
+		counts[triage_result["status"]] = counts.get(triage_result["status"], 0) + 1
+	gprint(f"Triage results: {counts}")
+	# A rerun only triages the pending cases, so the results of earlier runs are kept.
+	file_utilities.update_json_manifest(os.path.join(manifest_directory, TRIAGE_MANIFEST_FILE_NAME), manifest)
+	return manifest
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import zlib
+import socket
+import uuid
+import threading
+
+def parse_shard(shard):
+	"""Parse a shard specification of the form 'i/N', with 0 <= i < N."""
+	index, count = (int(part) for part in shard.split('/'))
+	if count < 1 or not 0 <= index < count:
+		raise ValueError(f"Invalid shard {shard}; expected i/N with 0 <= i < N")
+	return index, count
+
+def in_shard(entry, shard_index, shard_count):
+	# crc32 rather than hash(), which is salted differently in every process.
+	return zlib.crc32(entry.encode()) % shard_count == shard_index
+
+class LeaseQueue:
+	"""
+	Coordinates workers, possibly on several hosts, that share a directory. A worker owns an entry
+	while it holds the entry's current lease, which a background thread renews until the entry is
+	completed or failed. A lease that isn't renewed, because its worker died, expires and can be taken
+	over by another worker. Lease expiry uses wall-clock time, so the hosts' clocks need to be synchronized.
+
+	Each entry's leases are numbered files in its own directory, and the highest number is the current
+	lease. A lease is only ever created with a hard link, which fails if the file exists, so exactly one
+	worker can take each number. Workers only rewrite their own lease, so a renewal can never overwrite
+	a lease that another worker took over, and the current lease never disappears during a takeover.
+	"""
+	def __init__(self, directory, lease_duration=300, max_attempts=3, poll_interval=30):
+		self.directory = directory
+		self.lease_duration = lease_duration
+		self.max_attempts = max_attempts
+		self.poll_interval = poll_interval
+		# The random suffix tells apart queues opened by one process, and a process from an earlier one with the same pid.
+		self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+		self._held = {}
+		self._lock = threading.Lock()
+		for subdirectory in ['leases', 'attempts', 'done', 'failed']:
+			os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+		self._heartbeat = threading.Thread(target=self.renew_leases, daemon=True)
+		self._heartbeat.start()
+
+	def path(self, kind, entry):
+		return os.path.join(self.directory, kind, f"{entry}.json")
+
+	def lease_path(self, entry, generation):
+		return os.path.join(self.directory, 'leases', entry, f"{generation}.json")
+
+	def temp_path(self, path):
+		return f"{path}.{self.owner.replace(':', '.')}.{threading.get_ident()}.tmp"
+
+	def write_json(self, path, data):
+		temp_path = self.temp_path(path)
+		with open(temp_path, 'w') as f:
+			json.dump(data, f)
+		os.replace(temp_path, path)
+
+	def read_json(self, path):
+		try:
+			with open(path, 'r') as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def is_finished(self, entry):
+		return os.path.exists(self.path('done', entry)) or os.path.exists(self.path('failed', entry))
+
+	def lease_generations(self, entry):
+		try:
+			names = os.listdir(os.path.join(self.directory, 'leases', entry))
+		except FileNotFoundError:
+			return []
+		return sorted(int(name[:-len('.json')]) for name in names if name.endswith('.json') and name[:-len('.json')].isdigit())
+
+	def current_lease(self, entry):
+		"""Return the generation and contents of an entry's current lease, or (None, None) if it has none."""
+		generations = self.lease_generations(entry)
+		if not generations:
+			return None, None
+		return generations[-1], self.read_json(self.lease_path(entry, generations[-1]))
+
+	def holds(self, entry):
+		"""Return whether this worker still holds the current lease on an entry."""
+		with self._lock:
+			generation = self._held.get(entry)
+		if generation is None:
+			return False
+		current_generation, lease = self.current_lease(entry)
+		return current_generation == generation and lease is not None and lease.get("owner") == self.owner
+
+	def acquire(self, entry):
+		"""Take the lease for an entry. Return False if another worker holds a live lease on it."""
+		generation, lease = self.current_lease(entry)
+		if generation is not None:
+			if lease is None or lease.get("expires_at", 0) > time.time():
+				# The lease is live, or was released while we read it, in which case we try again later.
+				return False
+		next_generation = 0 if generation is None else generation + 1
+		lease_path = self.lease_path(entry, next_generation)
+		os.makedirs(os.path.dirname(lease_path), exist_ok=True)
+		# The new lease is written next to the entry's directory, which its holder removes on release.
+		temp_path = self.temp_path(os.path.join(self.directory, 'leases', f"{entry}.{next_generation}"))
+		with open(temp_path, 'w') as f:
+			json.dump({"owner": self.owner, "expires_at": time.time() + self.lease_duration}, f)
+		try:
+			# Only one worker can link each generation, so only one of them takes the entry over.
+			os.link(temp_path, lease_path)
+		except (FileExistsError, FileNotFoundError):
+			return False
+		finally:
+			os.remove(temp_path)
+		for old_generation in self.lease_generations(entry):
+			if old_generation < next_generation:
+				try:
+					os.remove(self.lease_path(entry, old_generation))
+				except FileNotFoundError:
+					pass
+		with self._lock:
+			self._held[entry] = next_generation
+		if self.is_finished(entry):
+			# Another worker finished the entry between our check and taking the lease.
+			self.release(entry)
+			return False
+		return True
+
+	def release(self, entry):
+		with self._lock:
+			generation = self._held.pop(entry, None)
+		if generation is None:
+			return
+		current_generation, lease = self.current_lease(entry)
+		if current_generation == generation and lease is not None and lease.get("owner") == self.owner:
+			try:
+				os.remove(self.lease_path(entry, generation))
+				os.rmdir(os.path.dirname(self.lease_path(entry, generation)))
+			except OSError:
+				pass
+
+	def renew_leases(self):
+		while True:
+			time.sleep(self.lease_duration / 3)
+			with self._lock:
+				held = list(self._held.items())
+			for entry, generation in held:
+				if not self.holds(entry):
+					print(f"Lost the lease on {entry}")
+					with self._lock:
+						if self._held.get(entry) == generation:
+							del self._held[entry]
+					continue
+				# Rewriting our own generation can't affect a newer lease that another worker has taken.
+				self.write_json(self.lease_path(entry, generation), {"owner": self.owner, "expires_at": time.time() + self.lease_duration})
+
+	def complete(self, entry):
+		"""Mark an entry as done. Return False without marking it if another worker took over the entry's lease."""
+		if not self.holds(entry):
+			print(f"Lost the lease on {entry}, so its new owner will finish it")
+			self.release(entry)
+			return False
+		self.write_json(self.path('done', entry), {"owner": self.owner, "finished_at": time.time()})
+		self.release(entry)
+		return True
+
+	def fail(self, entry, error):
+		"""
+		Record a failed attempt. The entry is retried until it has failed max_attempts times. Return False
+		without recording the attempt if another worker took over the entry's lease.
+		"""
+		if not self.holds(entry):
+			print(f"Lost the lease on {entry}, so its new owner will finish it")
+			self.release(entry)
+			return False
+		attempts = self.read_json(self.path('attempts', entry)) or []
+		attempts.append({"owner": self.owner, "failed_at": time.time(), "error": error})
+		self.write_json(self.path('attempts', entry), attempts)
+		if len(attempts) >= self.max_attempts:
+			self.write_json(self.path('failed', entry), attempts)
+		self.release(entry)
+		return True
+
+	def claim(self, entries):
+		"""
+		Yield entries as their leases are taken, until every entry is done or has failed for good.
+		Yields None when the remaining entries are all leased by other workers, so the caller can wait
+		for its own work or sleep before asking again.
+		"""
+		while True:
+			remaining = [entry for entry in entries if not self.is_finished(entry)]
+			if not remaining:
+				return
+			claimed = False
+			for entry in remaining:
+				if entry not in self._held and self.acquire(entry):
+					claimed = True
+					yield entry
+			if not claimed:
+				yield None
@@ -0,0 +1,185 @@
+import os
+import sys
+import shutil
+import threading
+import tempfile
+
+# Files that the pipeline only ever replaces (patches, edits and git all write a new file and rename
+# it over the old one) can share an inode with the original program. Anything else, like binaries and
+# object files that compilers may rewrite in place, always gets its own copy.
+LINKABLE_EXTENSIONS = {'.c', '.cc', '.cpp', '.h', '.hpp'}
+LINKABLE_NAMES = {'Makefile', 'makefile'}
+
+# Workspace directories are named after the process that created them, so that workspaces left
+# behind by a process that died can be recognized and evicted.
+WORKSPACE_PREFIX = "gd-"
+
+# The space a workspace needs beyond its sources, for objects, binaries and snapshots.
+WORKSPACE_HEADROOM = 64 * 1024 * 1024
+
+# The FICLONE ioctl from linux/fs.h.
+FICLONE = 0x40049409
+
+def clone_file(source, destination):
+	"""
+	Create `destination` as a copy-on-write clone of `source` if the filesystem supports it.
+
+	:return: True if the clone was created.
+	"""
+	try:
+		if sys.platform == 'darwin':
+			import ctypes
+			libc = ctypes.CDLL(None, use_errno=True)
+			if libc.clonefile(os.fsencode(source), os.fsencode(destination), 0) != 0:
+				return False
+			return True
+		elif sys.platform.startswith('linux'):
+			import fcntl
+			with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+				fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+			shutil.copystat(source, destination)
+			return True
+	except (OSError, AttributeError):
+		if os.path.exists(destination):
+			os.remove(destination)
+	return False
+
+def clone_or_copy(source, destination):
+	if not clone_file(source, destination):
+		shutil.copy2(source, destination)
+
+def is_linkable(path):
+	name = os.path.basename(path)
+	return name in LINKABLE_NAMES or os.path.splitext(name)[1] in LINKABLE_EXTENSIONS
+
+def materialize(path):
+	"""Give a file that shares its inode with another file a private copy, so it can be written in place."""
+	if os.path.isfile(path) and not os.path.islink(path) and os.stat(path).st_nlink > 1:
+		temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.materialize"
+		clone_or_copy(path, temp_path)
+		os.replace(temp_path, path)
+
+def directory_size(path):
+	total = 0
+	for root, dirs, files in os.walk(path):
+		for file in files:
+			try:
+				total += os.lstat(os.path.join(root, file)).st_size
+			except OSError:
+				pass
+	return total
+
+def process_is_running(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	return True
+
+class ScratchRoot:
+	"""
+	A directory, usually on a tmpfs like /dev/shm, that holds workspaces so that compiling, patching and
+	snapshotting don't touch the disk. Workspaces are only placed here while they fit within
+	`size_limit` bytes and the free space of the filesystem.
+	"""
+	def __init__(self, path, size_limit=None):
+		self.path = path
+		self.size_limit = size_limit
+		self._lock = threading.Lock()
+		os.makedirs(path, exist_ok=True)
+
+	def workspaces(self):
+		return [entry for entry in os.scandir(self.path) if entry.is_dir(follow_symlinks=False) and entry.name.startswith(WORKSPACE_PREFIX)]
+
+	def evict_orphans(self):
+		"""Delete workspaces whose process is no longer running and return the number deleted."""
+		evicted = 0
+		for entry in self.workspaces():
+			try:
+				pid = int(entry.name[len(WORKSPACE_PREFIX):].split('-')[0])
+			except ValueError:
+				continue
+			if not process_is_running(pid):
+				shutil.rmtree(entry.path, ignore_errors=True)
+				evicted += 1
+		return evicted
+
+	def has_room(self, required):
+		if shutil.disk_usage(self.path).free < required:
+			return False
+		if self.size_limit is not None and sum(directory_size(entry.path) for entry in self.workspaces()) + required > self.size_limit:
+			return False
+		return True
+
+	def reserve(self, required):
+		"""
+		Return whether a workspace needing `required` bytes fits, evicting orphaned workspaces if it doesn't.
+		"""
+		with self._lock:
+			if self.has_room(required):
+				return True
+			if self.evict_orphans():
+				return self.has_room(required)
+			return False
+
+_scratch_root = None
+
+def configure_scratch_root(path, size_limit=None):
+	"""Place new workspaces under `path` while they fit, or in the default temporary directory if `path` is None."""
+	global _scratch_root
+	_scratch_root = ScratchRoot(path, size_limit) if path else None
+	if _scratch_root is not None:
+		_scratch_root.evict_orphans()
+	return _scratch_root
+
+def create(source_directory):
+	"""Create a workspace on the scratch root if one is configured and has room, and in the default temporary directory otherwise."""
+	if _scratch_root is not None:
+		if _scratch_root.reserve(directory_size(source_directory) + WORKSPACE_HEADROOM):
+			return Workspace(source_directory, _scratch_root.path)
+		print(f"Scratch root {_scratch_root.path} is full; creating the workspace for {source_directory} on disk.")
+	return Workspace(source_directory)
+
+class Workspace:
+	"""
+	A scratch copy of a program's directory. Source files are hard links to the originals and other
+	files are clones where the filesystem supports them, so creating a workspace copies almost nothing.
+	"""
+	def __init__(self, source_directory, root=None):
+		self.source_directory = source_directory
+		self.path = tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{os.getpid()}-", dir=root)
+		self.populate(source_directory, self.path)
+
+	def populate(self, source_directory, destination_directory):
+		for entry in os.scandir(source_directory):
+			destination = os.path.join(destination_directory, entry.name)
+			if entry.is_dir(follow_symlinks=False):
+				os.mkdir(destination)
+				self.populate(entry.path, destination)
+			elif entry.is_symlink():
+				os.symlink(os.readlink(entry.path), destination)
+			elif is_linkable(entry.path):
+				try:
+					os.link(entry.path, destination)
+				except OSError:
+					# Different filesystems, or one that doesn't support hard links.
+					clone_or_copy(entry.path, destination)
+			else:
+				clone_or_copy(entry.path, destination)
+
+	def export(self, destination_directory):
+		"""
+		Move the contents of the workspace into `destination_directory`. Files still linked to the
+		original program get private copies first, so nothing in the results shares an inode with it.
+		"""
+		os.makedirs(destination_directory, exist_ok=True)
+		for root, dirs, files in os.walk(self.path):
+			for file in files:
+				materialize(os.path.join(root, file))
+		for item in os.listdir(self.path):
+			shutil.move(os.path.join(self.path, item), os.path.join(destination_directory, item))
+
+	def cleanup(self):
+		shutil.rmtree(self.path, ignore_errors=True)